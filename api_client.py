@@ -1,85 +1,409 @@
 """Клиент для работы с OpenAI API через ProxyAPI."""
-from openai import OpenAI
-import logging
+from openai import AsyncOpenAI
+import openai
 import asyncio
-from typing import List, Dict, Optional
+import httpx
+import logging
+import time
+from typing import Any, AsyncIterator, List, Dict, Optional, Sequence, Tuple, Union
 import config
+import metrics
+import tracing
+from model_router import ModelRouter
+from resilience import (
+    CircuitBreaker, CircuitOpenError, LatencyTracker,
+    backoff_delay, is_retryable, retry_after_seconds,
+)
+from usage_ledger import UsageLedger
 
 logger = logging.getLogger(__name__)
 
 
-class OpenAIClient:
-    """Клиент для взаимодействия с OpenAI API через ProxyAPI."""
+def request_cost(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> Optional[float]:
+    """
+    Стоимость запроса по ценам из MODEL_PRICES.
+    
+    Args:
+        model: Модель
+        prompt_tokens: Токены запроса (включая взятые из кэша)
+        cached_tokens: Токены запроса, взятые из кэша промптов
+        completion_tokens: Токены ответа
+    
+    Returns:
+        Стоимость в долларах или None, если цена модели не задана
+    """
+    prices = config.MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    return (
+        (prompt_tokens - cached_tokens) * prices["input"]
+        + cached_tokens * prices.get("cached", prices["input"])
+        + completion_tokens * prices["output"]
+    ) / 1_000_000
+
+
+def _cache_params(cache_key: Optional[str]) -> Dict[str, Any]:
+    """
+    Параметры запроса с ключом кэша промптов (пустые, если ключ не задан).
+    
+    Ключ передаётся в теле запроса через extra_body: именованного аргумента
+    prompt_cache_key нет в ранних версиях SDK openai 1.x.
+    """
+    return {"extra_body": {"prompt_cache_key": cache_key}} if cache_key else {}
+
+
+class Endpoint:
+    """Адрес API со своим автоматическим выключателем и статистикой задержек."""
     
-    def __init__(self):
-        """Инициализация клиента OpenAI с ProxyAPI."""
-        self.client = OpenAI(
+    def __init__(self, base_url: str, http_client: httpx.AsyncClient):
+        """
+        Инициализация адреса.
+        
+        Args:
+            base_url: Базовый URL API
+            http_client: Общий HTTP-клиент с пулом соединений
+        """
+        self.base_url = base_url
+        # Повторы выполняет OpenAIClient, поэтому встроенные повторы SDK отключены
+        self.client = AsyncOpenAI(
             api_key=config.OPENAI_API_KEY,
-            base_url=config.PROXYAPI_BASE_URL
+            base_url=base_url,
+            http_client=http_client,
+            max_retries=0,
+        )
+        self.breaker = CircuitBreaker(config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_RESET_TIMEOUT)
+        self.latency = LatencyTracker(min_samples=config.HEDGE_MIN_SAMPLES)
+
+
+class OpenAIClient:
+    """Клиент для взаимодействия с OpenAI API через ProxyAPI.
+    
+    Временные ошибки повторяются с экспоненциальной задержкой; если адрес
+    или модель недоступны, запрос переходит к резервным адресам и моделям.
+    """
+    
+    def __init__(self, usage_ledger: Optional[UsageLedger] = None):
+        """
+        Инициализация асинхронного клиента OpenAI с общим пулом соединений.
+        
+        Args:
+            usage_ledger: Учёт расхода токенов по пользователям и промптам (None - только метрики)
+        """
+        self.usage_ledger = usage_ledger
+        # Один HTTP-клиент на весь процесс: keep-alive и HTTP/2 позволяют
+        # обслуживать сотни параллельных запросов без отдельного потока на каждый
+        self.http_client = httpx.AsyncClient(
+            http2=config.OPENAI_HTTP2,
+            limits=httpx.Limits(
+                max_connections=config.OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=config.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=config.OPENAI_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                config.OPENAI_REQUEST_TIMEOUT,
+                connect=config.OPENAI_CONNECT_TIMEOUT,
+            ),
+        )
+        self.endpoints = [Endpoint(url, self.http_client) for url in config.PROXYAPI_BASE_URLS]
+        self.models = [config.OPENAI_MODEL] + [
+            model for model in config.OPENAI_FALLBACK_MODELS if model != config.OPENAI_MODEL
+        ]
+        self.model = self.models[0]
+        # Уровни моделей и статистика пар модель/адрес для выбора порядка перебора
+        self.router = ModelRouter(
+            config.MODEL_TIERS,
+            config.PROXYAPI_BASE_URLS,
+            default_tier=config.ROUTER_DEFAULT_TIER,
+            prompt_default_tier=config.ROUTER_PROMPT_DEFAULT_TIER,
+            fast_max_chars=config.ROUTER_FAST_MAX_CHARS,
+            max_error_rate=config.ROUTER_MAX_ERROR_RATE,
+            slow_factor=config.ROUTER_SLOW_FACTOR,
+            recovery_time=config.ROUTER_RECOVERY_TIME
         )
-        self.model = config.OPENAI_MODEL
     
-    def _get_response_sync(self, messages: List[Dict[str, str]]) -> Optional[str]:
+    async def get_response(self, messages: List[Dict[str, str]],
+                           timeout: Optional[float] = None,
+                           prompt_id: Union[int, str, None] = None,
+                           model: Optional[str] = None,
+                           cache_key: Optional[str] = None,
+                           tier: Optional[str] = None,
+                           user_id: Optional[int] = None) -> Optional[str]:
         """
-        Синхронный метод для получения ответа от OpenAI API.
+        Асинхронный метод для получения ответа от OpenAI API.
         
         Args:
             messages: Список сообщений для отправки в API
-            
+            timeout: Таймаут запроса в секундах (по умолчанию OPENAI_REQUEST_TIMEOUT)
+            prompt_id: ID промпта или назначение запроса, например "summary" (для учёта токенов)
+            model: Модель для этого запроса без перехода к резервным моделям
+                (по умолчанию основная модель с резервными)
+            cache_key: Ключ кэша промптов провайдера (prompt_cache_key): запросы с
+                одинаковым ключом направляются туда, где их общее начало уже в кэше
+            tier: Уровень моделей (см. ModelRouter.classify; по умолчанию ROUTER_DEFAULT_TIER);
+                при заданной model - только метка для учёта задержки и стоимости
+            user_id: ID пользователя, которому засчитывается расход токенов
+        
         Returns:
             Текст ответа от модели или None в случае ошибки
         """
         try:
-            # Подготовка параметров запроса
-            request_params = {
-                "model": self.model,
-                "messages": messages,
-            }
-            
             # Для модели o4-mini-2025-04-16 параметры temperature и max_tokens не поддерживаются
             # API использует значения по умолчанию для этой модели
             # Поэтому не передаем эти параметры
             
+            models = [model] if model else self.router.models_for(tier)
+            tier = tier or self.router.default_tier
             logger.info(
-                f"Отправка запроса к OpenAI API. "
-                f"Модель: {self.model}, "
-                f"Сообщений: {len(messages)}"
+                "Отправка запроса к OpenAI API. Модель: %s (%s), Сообщений: %d",
+                models[0], tier, len(messages)
             )
             
-            response = self.client.chat.completions.create(**request_params)
+            started = time.monotonic()
+            model, response = await self._request(messages, timeout, models=models, **_cache_params(cache_key))
+            elapsed = time.monotonic() - started
+            metrics.API_LATENCY.labels(model).observe(elapsed)
+            metrics.TIER_LATENCY.labels(tier).observe(elapsed)
             
-            # Логируем информацию об использованных токенах
-            if hasattr(response, 'usage'):
-                usage = response.usage
-                prompt_tokens = getattr(usage, 'prompt_tokens', 0)
-                completion_tokens = getattr(usage, 'completion_tokens', 0)
-                total_tokens = getattr(usage, 'total_tokens', 0)
-                
-                logger.info(
-                    f"Использовано токенов - Промпт: {prompt_tokens}, "
-                    f"Ответ: {completion_tokens}, "
-                    f"Всего: {total_tokens}"
-                )
+            # Учитываем и логируем использованные токены
+            self._record_usage(prompt_id, getattr(response, 'usage', None), model, tier, user_id)
             
             answer = response.choices[0].message.content
-            logger.info(f"Получен ответ от OpenAI API. Длина: {len(answer)} символов")
+            logger.info("Получен ответ от OpenAI API (%s). Длина: %d символов", model, len(answer))
             
             return answer
-            
+        
         except Exception as e:
-            logger.error(f"Ошибка при запросе к OpenAI API: {e}", exc_info=True)
+            logger.error("Ошибка при запросе к OpenAI API: %s", e, exc_info=True)
             return None
     
-    async def get_response(self, messages: List[Dict[str, str]]) -> Optional[str]:
+    async def stream_response(self, messages: List[Dict[str, str]],
+                              timeout: Optional[float] = None,
+                              prompt_id: Union[int, str, None] = None,
+                              cache_key: Optional[str] = None,
+                              tier: Optional[str] = None,
+                              user_id: Optional[int] = None) -> AsyncIterator[str]:
         """
-        Асинхронный метод для получения ответа от OpenAI API.
+        Потоковое получение ответа от OpenAI API.
+        
+        В отличие от get_response, ошибки запроса не перехватываются,
+        а пробрасываются вызывающему коду. Повтор и переход к резервному
+        адресу возможны только до получения первого фрагмента ответа.
         
         Args:
             messages: Список сообщений для отправки в API
-            
+            timeout: Таймаут запроса в секундах (по умолчанию OPENAI_REQUEST_TIMEOUT)
+            prompt_id: ID промпта или назначение запроса (для учёта токенов)
+            cache_key: Ключ кэша промптов провайдера (prompt_cache_key)
+            tier: Уровень моделей (по умолчанию ROUTER_DEFAULT_TIER)
+            user_id: ID пользователя, которому засчитывается расход токенов
+        
+        Yields:
+            Фрагменты текста ответа по мере генерации
+        """
+        models = self.router.models_for(tier)
+        tier = tier or self.router.default_tier
+        logger.info(
+            "Отправка потокового запроса к OpenAI API. Модель: %s (%s), Сообщений: %d",
+            models[0], tier, len(messages)
+        )
+        
+        started = time.monotonic()
+        model, stream = await self._request(
+            messages, timeout,
+            models=models,
+            stream=True,
+            stream_options={"include_usage": True},
+            **_cache_params(cache_key),
+        )
+        
+        answer_length = 0
+        try:
+            async for chunk in stream:
+                # Последний фрагмент с include_usage содержит только статистику токенов
+                if chunk.usage is not None:
+                    self._record_usage(prompt_id, chunk.usage, model, tier, user_id)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not answer_length:
+                        metrics.API_TIME_TO_FIRST_TOKEN.labels(model).observe(time.monotonic() - started)
+                    answer_length += len(delta)
+                    yield delta
+        finally:
+            # Освобождаем соединение, даже если потребитель прервал чтение потока
+            await stream.close()
+        
+        elapsed = time.monotonic() - started
+        metrics.API_LATENCY.labels(model).observe(elapsed)
+        metrics.TIER_LATENCY.labels(tier).observe(elapsed)
+        logger.info("Получен потоковый ответ от OpenAI API (%s). Длина: %d символов", model, answer_length)
+    
+    def _record_usage(self, prompt_id: Union[int, str, None], usage: Any, model: str, tier: str,
+                      user_id: Optional[int]) -> None:
+        """Учитывает токены и стоимость запроса в метриках и учёте расхода и записывает их в лог."""
+        if usage is None:
+            return
+        prompt_tokens = usage.prompt_tokens or 0
+        completion_tokens = usage.completion_tokens or 0
+        metrics.TOKENS.labels(prompt_id, "prompt").inc(prompt_tokens)
+        metrics.TOKENS.labels(prompt_id, "completion").inc(completion_tokens)
+        # Токены начала запроса, взятые провайдером из кэша промптов
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", None) if details is not None else None) or 0
+        if cached_tokens:
+            metrics.TOKENS.labels(prompt_id, "cached").inc(cached_tokens)
+        cost = request_cost(model, prompt_tokens, cached_tokens, completion_tokens)
+        if cost is not None:
+            metrics.API_COST.labels(tier, model).inc(cost)
+        if self.usage_ledger is not None:
+            self.usage_ledger.record(
+                user_id, prompt_id, model, prompt_tokens, cached_tokens, completion_tokens, cost
+            )
+        logger.info(
+            "Использовано токенов - Промпт: %d (из кэша: %d), Ответ: %d, Всего: %d, стоимость: %s (%s, %s)",
+            prompt_tokens, cached_tokens, completion_tokens, usage.total_tokens or 0,
+            f"${cost:.6f}" if cost is not None else "неизвестна", tier, model
+        )
+    
+    async def close(self) -> None:
+        """Закрывает клиент и все соединения пула."""
+        await self.http_client.aclose()
+    
+    async def _request(self, messages: List[Dict[str, str]], timeout: Optional[float],
+                       models: Optional[Sequence[str]] = None, **params: Any) -> Tuple[str, Any]:
+        """
+        Выполнить запрос с повторами и переходом к резервным адресам и моделям.
+        
+        Args:
+            messages: Список сообщений для отправки в API
+            timeout: Таймаут одной попытки в секундах
+            models: Модели в порядке перебора (по умолчанию основная и резервные)
+            **params: Дополнительные параметры chat.completions.create
+        
         Returns:
-            Текст ответа от модели или None в случае ошибки
+            Кортеж (использованная модель, ответ API)
+        
+        Raises:
+            CircuitOpenError: Все адреса временно отключены
+            Exception: Последняя ошибка API, если ни одна попытка не удалась
+        """
+        timeout = timeout if timeout is not None else config.OPENAI_REQUEST_TIMEOUT
+        models = models or self.models
+        last_error: Optional[Exception] = None
+        
+        for model in models:
+            for endpoint in self.router.order_endpoints(model, self.endpoints):
+                for attempt in range(config.RETRY_MAX_ATTEMPTS):
+                    if not endpoint.breaker.allow():
+                        break
+                    try:
+                        response = await self._send(endpoint, model, messages, timeout, params)
+                    except openai.NotFoundError as e:
+                        # Модель недоступна на этом адресе - пробуем следующий вариант
+                        logger.warning("Модель %s недоступна на %s: %s", model, endpoint.base_url, e)
+                        last_error = e
+                        break
+                    except Exception as e:
+                        if not is_retryable(e):
+                            raise
+                        last_error = e
+                        delay = backoff_delay(
+                            attempt, config.RETRY_BASE_DELAY, config.RETRY_MAX_DELAY,
+                            retry_after_seconds(e)
+                        )
+                        if attempt + 1 >= config.RETRY_MAX_ATTEMPTS or delay > config.RETRY_MAX_DELAY:
+                            logger.warning("Запрос к %s (%s) не удался: %s", endpoint.base_url, model, e)
+                            break
+                        logger.warning(
+                            "Временная ошибка %s (%s): %s. Повтор через %.2f сек",
+                            endpoint.base_url, model, e, delay
+                        )
+                        await asyncio.sleep(delay)
+                        continue
+                    
+                    if model != models[0] or endpoint is not self.endpoints[0]:
+                        logger.info("Ответ получен через резервный вариант: %s (%s)", endpoint.base_url, model)
+                    return model, response
+        
+        raise last_error if last_error is not None else CircuitOpenError()
+    
+    async def _send(self, endpoint: Endpoint, model: str, messages: List[Dict[str, str]],
+                    timeout: float, params: Dict[str, Any]) -> Any:
+        """Отправляет запрос, при необходимости дублируя его, если ответ задерживается."""
+        if config.HEDGE_ENABLED and not params.get("stream"):
+            p95 = endpoint.latency.percentile(0.95)
+            if p95 is not None:
+                return await self._hedged(endpoint, model, messages, timeout, params,
+                                          max(p95, config.HEDGE_MIN_DELAY))
+        return await self._attempt(endpoint, model, messages, timeout, params)
+    
+    async def _attempt(self, endpoint: Endpoint, model: str, messages: List[Dict[str, str]],
+                       timeout: float, params: Dict[str, Any]) -> Any:
+        """Выполняет одну попытку запроса и обновляет выключатель и статистику адреса."""
+        started = time.monotonic()
+        try:
+            with tracing.span("openai.request", kind="client", model=model, endpoint=endpoint.base_url,
+                              stream=bool(params.get("stream"))):
+                response = await endpoint.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    timeout=timeout,
+                    **params,
+                )
+        except asyncio.CancelledError:
+            endpoint.breaker.record_cancel()
+            raise
+        except Exception as e:
+            metrics.API_ERRORS.labels(model).inc()
+            if is_retryable(e):
+                endpoint.breaker.record_failure()
+                self.router.record(model, endpoint.base_url, None, ok=False)
+            else:
+                # Сервер ответил осмысленной ошибкой - сам адрес работает
+                endpoint.breaker.record_success()
+            raise
+        
+        endpoint.breaker.record_success()
+        # Для потоковых ответов время до заголовков не сравнимо с полным временем ответа
+        latency = None if params.get("stream") else time.monotonic() - started
+        if latency is not None:
+            endpoint.latency.record(latency)
+        self.router.record(model, endpoint.base_url, latency, ok=True)
+        return response
+    
+    async def _hedged(self, endpoint: Endpoint, model: str, messages: List[Dict[str, str]],
+                      timeout: float, params: Dict[str, Any], delay: float) -> Any:
+        """
+        Выполнить запрос с дублированием: если ответа нет за delay секунд,
+        отправляется копия на другой исправный адрес (или тот же, если другого нет)
+        и возвращается первый успешный ответ.
         """
-        # Выполняем синхронный вызов в отдельном потоке
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self._get_response_sync, messages)
+        primary = asyncio.ensure_future(self._attempt(endpoint, model, messages, timeout, params))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return primary.result()
+            
+            backup = next(
+                (e for e in self.endpoints if e is not endpoint and e.breaker.state == "closed"),
+                endpoint
+            )
+            logger.info(
+                "Ответ от %s задерживается дольше %.2f сек, дублируем запрос на %s",
+                endpoint.base_url, delay, backup.base_url
+            )
+            pending.add(asyncio.ensure_future(self._attempt(backup, model, messages, timeout, params)))
+            
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,473 @@
+"""Пакетный прогон промптов без Telegram: файл запросов JSONL, выполнение и отчёт.
+
+Запросы строятся так же, как в боте (PromptsManager.build_messages_with_prompt),
+и записываются в формате входного файла пакетных заданий OpenAI. Выполняются
+они через пакетный API (/v1/batches) или напрямую с ограничением числа
+одновременных запросов. Результаты дописываются в JSONL по мере получения,
+поэтому прерванный прогон продолжается с того же места. Конфигурация бота
+(config.py) не используется: адрес и ключ API берутся из аргументов или
+переменных окружения. Запускается из корня проекта:
+    
+    python batch_runner.py generate --inputs corpus.txt --output batch_requests.jsonl
+    python batch_runner.py run batch_requests.jsonl --output batch_results.jsonl --concurrency 16
+    python batch_runner.py run batch_requests.jsonl --output batch_results.jsonl --mode batch
+    python batch_runner.py report batch_results.jsonl
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+import openai
+from dotenv import load_dotenv
+
+from prompts_manager import PromptsManager
+
+# Адрес API по умолчанию (как в config.py)
+DEFAULT_BASE_URL = "https://api.proxyapi.ru/openai/v1"
+# Модель по умолчанию (как в config.py)
+DEFAULT_MODEL = "o4-mini-2025-04-16"
+# Адрес запросов в строках пакетного задания
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Максимальное количество запросов в одном пакетном задании OpenAI
+BATCH_MAX_REQUESTS = 50000
+# Терминальные состояния пакетного задания
+BATCH_FINAL_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+def read_jsonl(path: str) -> Iterator[Dict]:
+    """
+    Прочитать JSONL-файл построчно.
+    
+    Args:
+        path: Путь к файлу
+    
+    Yields:
+        Объекты из непустых строк файла
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_inputs(path: str) -> List[Tuple[str, str]]:
+    """
+    Загрузить корпус входных текстов.
+    
+    JSONL-файл содержит в каждой строке строку или объект с полями
+    "input" (или "text") и необязательным "id"; в остальных файлах
+    каждая непустая строка - отдельный текст.
+    
+    Args:
+        path: Путь к файлу корпуса
+    
+    Returns:
+        Список пар (ID текста, текст)
+    """
+    inputs = []
+    if path.endswith(".jsonl"):
+        for index, item in enumerate(read_jsonl(path), 1):
+            if isinstance(item, str):
+                inputs.append((str(index), item))
+            else:
+                inputs.append((str(item.get("id", index)), item.get("input", item.get("text", ""))))
+    else:
+        with open(path, encoding="utf-8") as f:
+            lines = [line.strip() for line in f]
+        inputs = [(str(index), line) for index, line in enumerate(lines, 1) if line]
+    return [(input_id, text) for input_id, text in inputs if text]
+
+
+def generate_requests(prompts_manager: PromptsManager, inputs: Sequence[Tuple[str, str]], model: str,
+                      prompt_ids: Optional[Set[int]] = None, test_inputs: bool = True,
+                      cache_key: bool = True) -> Iterator[Dict]:
+    """
+    Сформировать строки входного файла пакетного задания.
+    
+    Args:
+        prompts_manager: Менеджер промптов
+        inputs: Тексты корпуса (ID текста, текст), обрабатываемые каждым промптом
+        model: Модель
+        prompt_ids: ID промптов (None - все)
+        test_inputs: Добавить test_input каждого промпта
+        cache_key: Передавать prompt_cache_key, как бот (запросы промпта попадают в один кэш)
+    
+    Yields:
+        Строки в формате {"custom_id", "method", "url", "body"}
+    """
+    for prompt in prompts_manager.prompts:
+        if prompt_ids is not None and prompt['id'] not in prompt_ids:
+            continue
+        texts = list(inputs)
+        if test_inputs and prompt.get('test_input'):
+            texts.insert(0, ("test", prompt['test_input']))
+        for input_id, text in texts:
+            body = {"model": model, "messages": prompts_manager.build_messages_with_prompt(prompt, text)}
+            if cache_key:
+                body["prompt_cache_key"] = f"prompt:{prompt['id']}"
+            yield {
+                "custom_id": f"prompt-{prompt['id']}-{input_id}",
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": body,
+            }
+
+
+def completed_ids(results_path: str) -> Set[str]:
+    """
+    ID запросов, уже успешно выполненных в прошлых прогонах (контрольная точка).
+    
+    Args:
+        results_path: Файл результатов
+    
+    Returns:
+        Множество custom_id с успешным ответом
+    """
+    if not os.path.exists(results_path):
+        return set()
+    return {result["custom_id"] for result in read_jsonl(results_path) if _succeeded(result)}
+
+
+def _succeeded(result: Dict) -> bool:
+    """Результат содержит успешный ответ модели."""
+    response = result.get("response") or {}
+    return result.get("error") is None and response.get("status_code") == 200
+
+
+def _prompt_of(custom_id: str) -> str:
+    """ID промпта из custom_id вида prompt-<id>-<текст>."""
+    parts = custom_id.split("-", 2)
+    return parts[1] if len(parts) == 3 and parts[0] == "prompt" else "?"
+
+
+def _prompt_order(item: Tuple[str, List[int]]) -> Tuple[int, str]:
+    """Порядок строк отчёта: ID промптов по возрастанию номера."""
+    prompt_id = item[0]
+    return (int(prompt_id), "") if prompt_id.isdigit() else (sys.maxsize, prompt_id)
+
+
+class RunStats:
+    """Итоги прогона: количество запросов, токены и пропускная способность."""
+    
+    def __init__(self):
+        """Инициализация пустой статистики."""
+        self.started = time.monotonic()
+        self.succeeded = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.by_prompt: Dict[str, List[int]] = defaultdict(lambda: [0, 0, 0])  # Запросы, токены, ошибки
+    
+    def add(self, result: Dict) -> None:
+        """Учесть строку результатов."""
+        prompt = self.by_prompt[_prompt_of(result.get("custom_id", ""))]
+        prompt[0] += 1
+        if not _succeeded(result):
+            self.failed += 1
+            prompt[2] += 1
+            return
+        self.succeeded += 1
+        usage = result["response"]["body"].get("usage") or {}
+        details = usage.get("prompt_tokens_details") or {}
+        self.prompt_tokens += usage.get("prompt_tokens") or 0
+        self.cached_tokens += details.get("cached_tokens") or 0
+        self.completion_tokens += usage.get("completion_tokens") or 0
+        prompt[1] += (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+    
+    def format(self, elapsed: Optional[float] = None) -> str:
+        """
+        Текст отчёта.
+        
+        Args:
+            elapsed: Длительность прогона (сек; None - без пропускной способности)
+        
+        Returns:
+            Текст отчёта
+        """
+        total = self.succeeded + self.failed
+        lines = [
+            f"Запросов: {total}, успешно: {self.succeeded}, ошибок: {self.failed}",
+            f"Токенов: запрос {self.prompt_tokens} (из кэша {self.cached_tokens}), "
+            f"ответ {self.completion_tokens}, всего {self.prompt_tokens + self.completion_tokens}",
+        ]
+        if elapsed is not None and elapsed > 0:
+            lines.append(
+                f"Время: {elapsed:.1f} сек, {total / elapsed:.2f} запросов/сек, "
+                f"{(self.prompt_tokens + self.completion_tokens) / elapsed:.0f} токенов/сек"
+            )
+        lines.append("По промптам (запросов, токенов, ошибок):")
+        for prompt_id, (requests, tokens, errors) in sorted(self.by_prompt.items(), key=_prompt_order):
+            lines.append(f"  {prompt_id}: {requests}, {tokens}, {errors}")
+        return "\n".join(lines)
+
+
+def _error_result(custom_id: str, error: Exception) -> Dict:
+    """Строка результатов для неудачного запроса."""
+    status = getattr(error, "status_code", None)
+    return {
+        "id": None,
+        "custom_id": custom_id,
+        "response": {"status_code": status, "body": getattr(error, "body", None)} if status else None,
+        "error": {"code": type(error).__name__, "message": str(error)},
+    }
+
+
+def _create_params(body: Dict) -> Dict:
+    """Аргументы chat.completions.create для тела запроса; prompt_cache_key передаётся через extra_body."""
+    params = dict(body)
+    if "prompt_cache_key" in params:
+        params["extra_body"] = {"prompt_cache_key": params.pop("prompt_cache_key")}
+    return params
+
+
+async def run_direct(client: openai.AsyncOpenAI, requests: Iterable[Dict], output, stats: RunStats,
+                     concurrency: int, timeout: Optional[float] = None) -> None:
+    """
+    Выполнить запросы напрямую, не больше concurrency одновременно.
+    
+    Каждый результат сразу дописывается в файл, поэтому прерванный прогон
+    продолжается с невыполненных запросов.
+    
+    Args:
+        client: Клиент API
+        requests: Строки входного файла
+        output: Открытый на дописывание файл результатов
+        stats: Статистика прогона
+        concurrency: Максимальное количество одновременных запросов
+        timeout: Таймаут запроса (сек)
+    """
+    pending = iter(requests)
+    done = 0
+    
+    async def worker() -> None:
+        nonlocal done
+        for request in pending:
+            try:
+                response = await client.chat.completions.create(**_create_params(request["body"]), timeout=timeout)
+                result = {
+                    "id": response.id,
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": response.model_dump(exclude_none=True)},
+                    "error": None,
+                }
+            except openai.OpenAIError as e:
+                result = _error_result(request["custom_id"], e)
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            stats.add(result)
+            done += 1
+            if done % 100 == 0:
+                print(f"Выполнено запросов: {done}", file=sys.stderr)
+    
+    # Рабочие задачи берут запросы из общего итератора: файл не загружается в память целиком
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def run_batches(client: openai.AsyncOpenAI, requests: List[Dict], output, stats: RunStats,
+                      state_path: str, poll_interval: float, batch_size: int = BATCH_MAX_REQUESTS) -> None:
+    """
+    Выполнить запросы через пакетный API.
+    
+    Идентификатор созданного задания сохраняется в state_path: если прогон
+    прерван, следующий запуск дожидается этого задания, а не создаёт новое.
+    
+    Args:
+        client: Клиент API
+        requests: Строки входного файла, ещё не выполненные
+        output: Открытый на дописывание файл результатов
+        stats: Статистика прогона
+        state_path: Файл с идентификатором текущего задания
+        poll_interval: Интервал проверки состояния задания (сек)
+        batch_size: Максимальное количество запросов в одном задании
+    """
+    if os.path.exists(state_path):
+        with open(state_path, encoding="utf-8") as f:
+            batch_id = json.load(f)["batch_id"]
+        print(f"Продолжение пакетного задания {batch_id}", file=sys.stderr)
+        await _collect_batch(client, batch_id, output, stats, state_path, poll_interval)
+        return
+    
+    for start in range(0, len(requests), batch_size):
+        part = requests[start:start + batch_size]
+        content = "".join(json.dumps(request, ensure_ascii=False) + "\n" for request in part)
+        uploaded = await client.files.create(
+            file=("batch_requests.jsonl", content.encode("utf-8")), purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=uploaded.id, endpoint=BATCH_ENDPOINT, completion_window="24h"
+        )
+        with open(state_path, "w", encoding="utf-8") as f:
+            json.dump({"batch_id": batch.id, "input_file_id": uploaded.id}, f)
+        print(f"Создано пакетное задание {batch.id}: {len(part)} запросов", file=sys.stderr)
+        await _collect_batch(client, batch.id, output, stats, state_path, poll_interval)
+
+
+async def _collect_batch(client: openai.AsyncOpenAI, batch_id: str, output, stats: RunStats,
+                         state_path: str, poll_interval: float) -> None:
+    """
+    Дожидается завершения задания и дописывает его результаты и ошибки в файл результатов.
+    
+    Если задание не выполнено, запросы без результата учитываются как ошибки.
+    """
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status in BATCH_FINAL_STATES:
+            break
+        counts = batch.request_counts
+        if counts is not None:
+            print(f"Задание {batch_id}: {batch.status}, выполнено {counts.completed + counts.failed} "
+                  f"из {counts.total}", file=sys.stderr)
+        await asyncio.sleep(poll_interval)
+    
+    print(f"Задание {batch_id} завершено: {batch.status}", file=sys.stderr)
+    received: Set[str] = set()
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        content = await client.files.content(file_id)
+        for line in content.text.splitlines():
+            if line.strip():
+                result = json.loads(line)
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                stats.add(result)
+                received.add(result.get("custom_id"))
+        output.flush()
+    
+    if batch.status != "completed":
+        # Задание не выполнено (например, входной файл не прошёл проверку): запросы без
+        # результата записываются как ошибки и будут повторены следующим запуском
+        errors = [
+            f"{error.code}: {error.message}" + (f" (строка {error.line})" if error.line is not None else "")
+            for error in ((batch.errors.data or []) if batch.errors is not None else [])
+        ]
+        message = "; ".join(errors) or f"задание завершено в состоянии {batch.status}"
+        print(f"Ошибки задания {batch_id}: {message}", file=sys.stderr)
+        content = await client.files.content(batch.input_file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            custom_id = json.loads(line)["custom_id"]
+            if custom_id in received:
+                continue
+            result = {
+                "id": None,
+                "custom_id": custom_id,
+                "response": None,
+                "error": {"code": f"batch_{batch.status}", "message": message},
+            }
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            stats.add(result)
+        output.flush()
+    os.remove(state_path)
+
+
+async def run(args: argparse.Namespace) -> int:
+    """Выполняет файл запросов и выводит отчёт."""
+    if args.restart:
+        for path in (args.output, args.output + ".batch.json"):
+            if os.path.exists(path):
+                os.remove(path)
+    done = completed_ids(args.output)
+    requests = [request for request in read_jsonl(args.requests) if request["custom_id"] not in done]
+    if done:
+        print(f"Уже выполнено запросов: {len(done)}, осталось: {len(requests)}", file=sys.stderr)
+    
+    client = openai.AsyncOpenAI(
+        api_key=args.api_key or os.getenv("OPENAI_API_KEY"),
+        base_url=args.base_url or os.getenv("PROXYAPI_BASE_URL", DEFAULT_BASE_URL),
+        max_retries=args.max_retries,
+    )
+    stats = RunStats()
+    try:
+        with open(args.output, "a", encoding="utf-8") as output:
+            if args.mode == "batch":
+                if requests or os.path.exists(args.output + ".batch.json"):
+                    await run_batches(client, requests, output, stats, args.output + ".batch.json",
+                                      args.poll_interval)
+            else:
+                await run_direct(client, requests, output, stats, args.concurrency, args.timeout)
+    finally:
+        await client.close()
+    print(stats.format(time.monotonic() - stats.started))
+    return 0 if stats.failed == 0 else 1
+
+
+def generate(args: argparse.Namespace) -> int:
+    """Формирует файл запросов из промптов и корпуса текстов."""
+    prompts_manager = PromptsManager(args.prompts)
+    inputs = [item for path in args.inputs for item in load_inputs(path)]
+    prompt_ids = {int(prompt_id) for prompt_id in args.prompt_ids.split(",")} if args.prompt_ids else None
+    count = 0
+    with open(args.output, "w", encoding="utf-8") as f:
+        for request in generate_requests(prompts_manager, inputs, args.model, prompt_ids,
+                                         test_inputs=not args.no_test_inputs, cache_key=not args.no_cache_key):
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            count += 1
+    print(f"Запросов записано: {count} ({args.output})")
+    return 0
+
+
+def report(args: argparse.Namespace) -> int:
+    """Выводит отчёт по файлу результатов (для повторяющихся custom_id учитывается последняя строка)."""
+    latest: Dict[str, Dict] = {}
+    for result in read_jsonl(args.results):
+        latest[result["custom_id"]] = result
+    stats = RunStats()
+    for result in latest.values():
+        stats.add(result)
+    print(stats.format())
+    return 0
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Разбирает аргументы командной строки."""
+    parser = argparse.ArgumentParser(description="Пакетный прогон промптов без Telegram")
+    commands = parser.add_subparsers(dest="command", required=True)
+    
+    generate_parser = commands.add_parser("generate", help="Сформировать файл запросов")
+    generate_parser.add_argument("--prompts", default="prompts.json", help="Файл промптов")
+    generate_parser.add_argument("--inputs", action="append", default=[],
+                                 help="Корпус текстов: JSONL или текст, по строке на запрос (можно несколько)")
+    generate_parser.add_argument("--prompt-ids", help="ID промптов через запятую (по умолчанию все)")
+    generate_parser.add_argument("--model", default=DEFAULT_MODEL, help="Модель")
+    generate_parser.add_argument("--no-test-inputs", action="store_true", help="Не добавлять test_input промптов")
+    generate_parser.add_argument("--no-cache-key", action="store_true", help="Не передавать prompt_cache_key")
+    generate_parser.add_argument("--output", default="batch_requests.jsonl", help="Файл запросов")
+    
+    run_parser = commands.add_parser("run", help="Выполнить файл запросов")
+    run_parser.add_argument("requests", help="Файл запросов")
+    run_parser.add_argument("--output", default="batch_results.jsonl", help="Файл результатов")
+    run_parser.add_argument("--mode", choices=("direct", "batch"), default="direct",
+                            help="direct - запросы напрямую, batch - пакетный API")
+    run_parser.add_argument("--concurrency", type=int, default=8, help="Одновременных запросов (direct)")
+    run_parser.add_argument("--timeout", type=float, default=180.0, help="Таймаут запроса (сек, direct)")
+    run_parser.add_argument("--max-retries", type=int, default=2, help="Повторов запроса при временных ошибках")
+    run_parser.add_argument("--poll-interval", type=float, default=30.0, help="Интервал проверки задания (сек, batch)")
+    run_parser.add_argument("--base-url", help="Адрес API (по умолчанию PROXYAPI_BASE_URL)")
+    run_parser.add_argument("--api-key", help="Ключ API (по умолчанию OPENAI_API_KEY)")
+    run_parser.add_argument("--restart", action="store_true", help="Начать заново, удалив прежние результаты")
+    
+    report_parser = commands.add_parser("report", help="Отчёт по файлу результатов")
+    report_parser.add_argument("results", help="Файл результатов")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Точка входа командной строки."""
+    load_dotenv()
+    args = parse_args(argv)
+    if args.command == "generate":
+        return generate(args)
+    if args.command == "run":
+        return asyncio.run(run(args))
+    return report(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,8 @@
+"""Нагрузочное тестирование бота без Telegram и OpenAI.
+
+Состав:
+- stub_openai.py - локальная заглушка API chat completions
+- fake_telegram.py - сессия бота без сети и генератор обновлений
+- scenarios.py - сценарии нагрузки и записанные нагрузки (JSONL)
+- run.py - запуск сценария, замеры и сохранение результатов в JSON
+"""
@@ -0,0 +1,97 @@
+"""Сессия бота без обращения к Telegram и генератор синтетических обновлений."""
+import asyncio
+import datetime
+import itertools
+from collections import Counter
+from typing import Any, AsyncGenerator, Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, GetMe, SendMessage, TelegramMethod
+from aiogram.types import Chat, Message, Update, User
+
+
+class FakeTelegramSession(BaseSession):
+    """Сессия aiogram, отвечающая на запросы бота локально.
+    
+    Отправленные и отредактированные сообщения возвращаются как настоящие
+    объекты Message, остальные методы возвращают True. Задержка имитирует
+    время ответа Telegram.
+    """
+    
+    def __init__(self, latency: float = 0.0):
+        """
+        Инициализация сессии.
+        
+        Args:
+            latency: Задержка ответа на каждый запрос (сек)
+        """
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.sent_chars = 0
+        self._message_ids = itertools.count(1)
+    
+    async def make_request(self, bot: Bot, method: TelegramMethod[Any],
+                           timeout: Optional[int] = None) -> Any:
+        """Выполнить запрос к Telegram без сети."""
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            self.sent_chars += len(method.text)
+            message = Message(
+                message_id=method.message_id if isinstance(method, EditMessageText) else next(self._message_ids),
+                date=datetime.datetime.now(),
+                chat=Chat(id=method.chat_id, type="private" if method.chat_id > 0 else "group"),
+                text=method.text,
+            )
+            return message.as_(bot)
+        if isinstance(method, GetMe):
+            return User(id=bot.id, is_bot=True, first_name="benchmark", username="benchmark_bot")
+        return True
+    
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None,
+                             timeout: int = 30, chunk_size: int = 65536,
+                             raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        """Скачивание файлов в нагрузочных тестах не используется."""
+        raise NotImplementedError("FakeTelegramSession не поддерживает скачивание файлов")
+        yield b""
+    
+    async def close(self) -> None:
+        """Закрытие не требуется."""
+
+
+class UpdateFactory:
+    """Создаёт обновления Telegram с текстовыми сообщениями пользователей."""
+    
+    def __init__(self, bot: Bot):
+        """
+        Инициализация генератора.
+        
+        Args:
+            bot: Бот, к которому привязываются обновления (без повторной сериализации в диспетчере)
+        """
+        self.bot = bot
+        self._ids = itertools.count(1)
+    
+    def message(self, user_id: int, text: str) -> Update:
+        """
+        Создать обновление с сообщением пользователя в личном чате.
+        
+        Args:
+            user_id: ID пользователя (он же ID чата)
+            text: Текст сообщения
+        
+        Returns:
+            Обновление, готовое для Dispatcher.feed_update
+        """
+        update_id = next(self._ids)
+        message = Message(
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            from_user=User(id=user_id, is_bot=False, first_name=f"user{user_id}"),
+            text=text,
+        ).as_(self.bot)
+        return Update(update_id=update_id, message=message).as_(self.bot)
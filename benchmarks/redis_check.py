@@ -0,0 +1,194 @@
+"""Проверка хранилища состояния RedisStateBackend на локальной замене сервера Redis.
+
+Замена - небольшой сервер протокола RESP, который выполняет команды в
+fakeredis в этом же процессе (нужны пакеты fakeredis и lupa для
+Lua-скриптов). Можно указать и настоящий сервер.
+Запускается из корня проекта:
+    
+    pip install fakeredis lupa
+    python -m benchmarks.redis_check
+    python -m benchmarks.redis_check --url redis://127.0.0.1:6379/15
+"""
+import argparse
+import asyncio
+import sys
+import traceback
+from typing import Any, Callable, List, Optional
+
+from state_backend import _LOAD_SCRIPT, RedisStateBackend, _read_reply
+
+# Префикс ключей проверки, чтобы не задеть записи бота на настоящем сервере
+_KEY_PREFIX = "bot-check:"
+
+
+def _encode_reply(value: Any) -> bytes:
+    """Кодирует ответ fakeredis в формате RESP2."""
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, (list, tuple)):
+        return b"*%d\r\n" % len(value) + b"".join(_encode_reply(item) for item in value)
+    if not isinstance(value, bytes):
+        value = str(value).encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class FakeRedisServer:
+    """Сервер протокола Redis поверх fakeredis для проверок без настоящего Redis.
+    
+    Встроенный TCP-сервер fakeredis закрывает соединение после ответа с
+    ошибкой, а клиенту бота нужно продолжать работу после NOSCRIPT,
+    поэтому команды принимаются здесь и выполняются в fakeredis напрямую.
+    """
+    
+    def __init__(self):
+        """Инициализация сервера с пустой базой."""
+        import fakeredis
+        from redis.exceptions import NoScriptError
+        
+        self._redis = fakeredis.FakeRedis()
+        self._no_script_error = NoScriptError
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.commands = 0
+    
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Запустить сервер.
+        
+        Args:
+            host: Адрес сервера
+            port: Порт сервера (0 - свободный)
+        
+        Returns:
+            Адрес вида redis://хост:порт/0
+        """
+        self._server = await asyncio.start_server(self._handle, host, port)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"redis://{host}:{port}/0"
+    
+    async def stop(self) -> None:
+        """Остановить сервер."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+    
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Выполняет команды соединения по порядку (в том числе присланные пачкой)."""
+        try:
+            while True:
+                command = await _read_reply(reader)
+                self.commands += 1
+                writer.write(self._execute(command))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    
+    def _execute(self, command: List[bytes]) -> bytes:
+        """Выполняет команду в fakeredis и кодирует ответ или ошибку."""
+        try:
+            return _encode_reply(self._redis.execute_command(*command))
+        except Exception as e:
+            message = str(e)
+            if isinstance(e, self._no_script_error):
+                message = f"NOSCRIPT {message}"
+            elif not message.split(" ", 1)[0].isupper():
+                message = f"ERR {message}"
+            return f"-{message}\r\n".encode("utf-8")
+
+
+async def run_checks(backend: RedisStateBackend, report: Callable[[str], None] = print) -> None:
+    """
+    Проверить загрузку, сохранение, конфликт версий, удаление и пачки запросов.
+    
+    Args:
+        backend: Хранилище с пустым префиксом ключей на проверяемом сервере
+        report: Функция вывода названия пройденной проверки
+    
+    Raises:
+        AssertionError: Хранилище ведёт себя неправильно
+    """
+    users = [1001, 1002, 1003]
+    record = {"messages": [{"role": "user", "content": "Привет"}], "tokens": [3], "prompt_id": 2}
+    
+    # Скрипты после SCRIPT FLUSH неизвестны серверу: EVALSHA получает NOSCRIPT и повторяется через EVAL
+    await backend.client.execute(("SCRIPT", "FLUSH"))
+    assert await backend.load(users[0]) == (0, None)
+    assert await backend.client.execute(("SCRIPT", "EXISTS", backend._scripts[_LOAD_SCRIPT])) == [[1]]
+    report("NOSCRIPT: скрипты загружены повторной отправкой текста")
+    
+    assert await backend.save_many({users[0]: (0, record)}) == {users[0]: 1}
+    assert await backend.load(users[0]) == (1, record)
+    assert await backend.load(users[0], known_version=1) is None
+    assert await backend.load(users[0], known_version=0) == (1, record)
+    report("Загрузка и сохранение: версия растёт, неизменённая запись не передаётся")
+    
+    assert await backend.save_many({users[0]: (0, {"messages": []})}) == {users[0]: None}
+    assert await backend.load(users[0]) == (1, record)
+    report("Конфликт версий: устаревшее сохранение отклонено, запись не изменилась")
+    
+    assert await backend.save_many({users[0]: (1, None)}) == {users[0]: 2}
+    assert await backend.load(users[0]) == (2, None)
+    assert await backend.load(users[0], known_version=2) is None
+    report("Удаление: запись пуста, версия сохраняется")
+    
+    changes = {user_id: (0, {**record, "prompt_id": user_id}) for user_id in users[1:]}
+    changes[users[0]] = (2, record)
+    assert await backend.save_many(changes) == {users[0]: 3, users[1]: 1, users[2]: 1}
+    loaded = await asyncio.gather(*(backend.load(user_id) for user_id in users))
+    assert loaded == [(3, record)] + [(1, changes[user_id][1]) for user_id in users[1:]]
+    report("Пачки: сохранение нескольких записей и одновременные загрузки через одно соединение")
+    
+    await backend.client.execute(("SCRIPT", "FLUSH"))
+    results = await asyncio.gather(
+        backend.save_many({user_id: (1, None) for user_id in users[1:]}),
+        *(backend.load(user_id) for user_id in users)
+    )
+    assert results[0] == {users[1]: 2, users[2]: 2}
+    assert results[1] == (3, record)
+    report("NOSCRIPT в пачке: все вызовы повторены и выполнены")
+    
+    if backend.ttl:
+        ttl = (await backend.client.execute(("TTL", backend._key(users[0]))))[0]
+        assert 0 < ttl <= backend.ttl, ttl
+        report("Время жизни записи установлено")
+
+
+async def _main(url: Optional[str], ttl: int) -> int:
+    """Запускает проверки и возвращает код завершения."""
+    server = None
+    if url is None:
+        try:
+            server = FakeRedisServer()
+        except ImportError:
+            print("Нужен пакет fakeredis (pip install fakeredis lupa) или адрес сервера в --url")
+            return 2
+        url = await server.start()
+    backend = RedisStateBackend(url, key_prefix=_KEY_PREFIX, ttl=ttl)
+    passed: List[str] = []
+    try:
+        await run_checks(backend, lambda name: (passed.append(name), print(f"OK   {name}")))
+    except Exception:
+        print(f"FAIL после {len(passed)} проверок:")
+        traceback.print_exc(limit=-1)
+        return 1
+    finally:
+        keys = [backend._key(user_id) for user_id in (1001, 1002, 1003)]
+        await backend.client.execute(("DEL", *keys))
+        await backend.close()
+        if server is not None:
+            await server.stop()
+    print(f"Все проверки пройдены ({len(passed)}): {url}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Проверка хранилища состояния Redis")
+    parser.add_argument("--url", help="Адрес сервера Redis (по умолчанию - локальный fakeredis)")
+    parser.add_argument("--ttl", type=int, default=600, help="Время жизни записей проверки (сек)")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(_main(args.url, args.ttl)))
@@ -0,0 +1,371 @@
+"""Запуск сценария нагрузки и замер производительности обработки сообщений.
+
+Бот работает с заглушкой API (stub_openai.py) и сессией Telegram без
+сети (fake_telegram.py), обновления передаются прямо в диспетчер.
+Запускается из корня проекта:
+    
+    python -m benchmarks.run --scenario chat --users 50 --messages 5 --output results.json
+    python -m benchmarks.run --workload benchmarks/workload.jsonl --baseline results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from benchmarks.fake_telegram import FakeTelegramSession, UpdateFactory
+from benchmarks.scenarios import SCENARIOS, Scenario, build_scenario, load_workload, save_workload
+from benchmarks.stub_openai import StubOpenAI
+from profiling import LoopLagMonitor
+
+logger = logging.getLogger(__name__)
+
+# Метрики, сравниваемые с предыдущим запуском: (путь в результатах, True если больше - лучше)
+COMPARED_METRICS = (
+    (("throughput",), True),
+    (("latency", "p50"), False),
+    (("latency", "p95"), False),
+    (("latency", "p99"), False),
+    (("loop_lag", "max"), False),
+    (("memory", "peak_rss_mb"), False),
+)
+
+
+def percentile(ordered: List[float], q: float) -> Optional[float]:
+    """
+    Перцентиль отсортированного списка значений.
+    
+    Args:
+        ordered: Значения по возрастанию
+        q: Квантиль от 0 до 1
+    
+    Returns:
+        Значение перцентиля или None для пустого списка
+    """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """Среднее, p50/p95/p99 и максимум списка значений (в секундах)."""
+    ordered = sorted(values)
+    return {
+        "mean": sum(ordered) / len(ordered) if ordered else None,
+        "p50": percentile(ordered, 0.50),
+        "p95": percentile(ordered, 0.95),
+        "p99": percentile(ordered, 0.99),
+        "max": ordered[-1] if ordered else None,
+    }
+
+
+class _Collector:
+    """Результаты обработки обновлений."""
+    
+    def __init__(self):
+        """Инициализация пустых результатов."""
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.pending: List[asyncio.Task] = []
+
+
+def configure_environment(api_url: str) -> None:
+    """Задаёт переменные окружения, которые config.py читает при импорте."""
+    os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("STATE_BACKEND", "memory")
+    os.environ.setdefault("RESPONSE_CACHE_DB_PATH", "")
+    os.environ.setdefault("USAGE_DB_PATH", ":memory:")
+    os.environ["PROXYAPI_BASE_URL"] = api_url
+    os.environ["PROXYAPI_FALLBACK_URLS"] = ""
+    os.environ["BOT_MODE"] = "polling"
+
+
+def apply_overrides(config, overrides: List[str]) -> Dict[str, object]:
+    """
+    Переопределить параметры конфигурации (NAME=VALUE, значение в формате JSON или строка).
+    
+    Returns:
+        Словарь применённых значений
+    """
+    applied = {}
+    for override in overrides:
+        name, _, raw = override.partition("=")
+        if not hasattr(config, name):
+            raise SystemExit(f"Неизвестный параметр конфигурации: {name}")
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            value = raw
+        setattr(config, name, value)
+        applied[name] = value
+    return applied
+
+
+async def _feed(dp, bot, update, collector: _Collector) -> None:
+    """Передаёт обновление диспетчеру и замеряет время обработки."""
+    started = time.perf_counter()
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        collector.errors += 1
+        logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}", exc_info=collector.errors == 1)
+    collector.latencies.append(time.perf_counter() - started)
+
+
+async def _play_user(events: List[dict], dp, bot, factory: UpdateFactory, collector: _Collector) -> None:
+    """Отправляет сообщения одного пользователя по порядку с паузами из сценария."""
+    for event in events:
+        if event["delay"]:
+            await asyncio.sleep(event["delay"])
+        task = asyncio.create_task(_feed(dp, bot, factory.message(event["user"], event["text"]), collector))
+        if event["wait"]:
+            await task
+        else:
+            collector.pending.append(task)
+
+
+async def run_scenario(scenario: Scenario, stub: StubOpenAI, args: argparse.Namespace) -> dict:
+    """
+    Выполнить сценарий и собрать метрики.
+    
+    Args:
+        scenario: Сценарий нагрузки
+        stub: Заглушка API (сервер запускается и останавливается здесь)
+        args: Параметры командной строки
+    
+    Returns:
+        Результаты запуска
+    """
+    import bot as bot_module
+    
+    await stub.start(args.api_host, args.api_port)
+    session = FakeTelegramSession(latency=args.telegram_latency)
+    bot_module.bot.session = session
+    factory = UpdateFactory(bot_module.bot)
+    background_tasks = bot_module.start_background_tasks()
+    
+    by_user = defaultdict(list)
+    for event in scenario.events:
+        by_user[event["user"]].append(event)
+    
+    collector = _Collector()
+    lag_monitor = LoopLagMonitor()
+    if args.tracemalloc:
+        tracemalloc.start()
+    lag_monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        _play_user(events, bot_module.dp, bot_module.bot, factory, collector)
+        for events in by_user.values()
+    ))
+    await asyncio.gather(*collector.pending)
+    duration = time.perf_counter() - started
+    await lag_monitor.stop()
+    loop_lag = summarize(lag_monitor.samples)
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+    
+    scheduler_stats = bot_module.scheduler.stats()
+    sender_stats = bot_module.telegram_sender.stats()
+    await bot_module.shutdown(background_tasks)
+    await stub.stop()
+    
+    return {
+        "scenario": scenario.name,
+        "users": scenario.users,
+        "updates": len(collector.latencies),
+        "errors": collector.errors,
+        "duration": duration,
+        "throughput": len(collector.latencies) / duration if duration else None,
+        "latency": summarize(collector.latencies),
+        "loop_lag": loop_lag,
+        "memory": {
+            "peak_rss_mb": _peak_rss_mb(),
+            "tracemalloc_peak_mb": traced_peak / 2 ** 20 if traced_peak is not None else None,
+        },
+        "api": stub.stats(),
+        "telegram": dict(session.calls, sent_chars=session.sent_chars, **sender_stats),
+        "scheduler": scheduler_stats,
+    }
+
+
+def _peak_rss_mb() -> Optional[float]:
+    """Пиковый объём памяти процесса (МБ) или None, если недоступен."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux возвращает килобайты, macOS - байты
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def _git_commit() -> Optional[str]:
+    """Текущий коммит репозитория (для сравнения запусков)."""
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip() or None
+
+
+def _metric(results: dict, path: tuple) -> Optional[float]:
+    """Значение метрики по пути в результатах."""
+    value = results
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(results: dict, baseline: dict, max_regression: Optional[float]) -> bool:
+    """
+    Напечатать изменение метрик относительно предыдущего запуска.
+    
+    Args:
+        results: Результаты текущего запуска
+        baseline: Результаты предыдущего запуска
+        max_regression: Допустимое ухудшение метрики (%); None - не проверять
+    
+    Returns:
+        True, если какая-либо метрика ухудшилась больше допустимого
+    """
+    regressed = False
+    print(f"\nСравнение с {baseline.get('git_commit') or 'предыдущим запуском'}:")
+    for path, higher_is_better in COMPARED_METRICS:
+        current, previous = _metric(results, path), _metric(baseline, path)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous * 100
+        worse = -change if higher_is_better else change
+        mark = ""
+        if max_regression is not None and worse > max_regression:
+            regressed = True
+            mark = "  <-- ухудшение"
+        print(f"  {'.'.join(path):24} {previous:12.4f} -> {current:12.4f} ({change:+.1f}%){mark}")
+    return regressed
+
+
+def print_summary(results: dict) -> None:
+    """Печатает основные метрики запуска."""
+    latency, lag = results["latency"], results["loop_lag"]
+    print(f"Сценарий: {results['scenario']} ({results['users']} пользователей, {results['updates']} обновлений)")
+    print(f"Время: {results['duration']:.2f} сек, пропускная способность: {results['throughput']:.1f} сообщений/сек")
+    if latency["p50"] is not None:
+        print(f"Обработка сообщения: p50={latency['p50'] * 1000:.1f} мс, p95={latency['p95'] * 1000:.1f} мс, "
+              f"p99={latency['p99'] * 1000:.1f} мс, max={latency['max'] * 1000:.1f} мс")
+    if lag["max"] is not None:
+        print(f"Задержка цикла событий: p99={lag['p99'] * 1000:.1f} мс, max={lag['max'] * 1000:.1f} мс")
+    memory = results["memory"]
+    if memory["peak_rss_mb"] is not None:
+        print(f"Пиковая память процесса: {memory['peak_rss_mb']:.1f} МБ")
+    if memory["tracemalloc_peak_mb"] is not None:
+        print(f"Пиковая память Python (tracemalloc): {memory['tracemalloc_peak_mb']:.1f} МБ")
+    print(f"Ошибок обработки: {results['errors']}, запросов к API: {results['api']['requests']}, "
+          f"ошибок API: {results['api']['errors']}")
+    api = results["api"]
+    if api.get("models"):
+        print("Запросов по моделям: " + ", ".join(f"{model}: {count}" for model, count in sorted(api["models"].items())))
+    if api.get("prompt_tokens"):
+        print(f"Токенов запросов: {api['prompt_tokens']}, из кэша промптов: {api['cached_tokens']} "
+              f"({api['cached_tokens'] / api['prompt_tokens']:.0%})")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Разбор параметров командной строки."""
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование обработки сообщений бота")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="chat", help="Встроенный сценарий")
+    parser.add_argument("--workload", help="Воспроизвести записанную нагрузку из JSONL-файла")
+    parser.add_argument("--save-workload", help="Сохранить события сценария в JSONL-файл и выйти")
+    parser.add_argument("--users", type=int, default=20, help="Количество пользователей")
+    parser.add_argument("--messages", type=int, default=5, help="Сообщений на пользователя")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Пауза между сообщениями пользователя (сек)")
+    parser.add_argument("--seed", type=int, default=0, help="Начальное значение генератора случайных чисел")
+    parser.add_argument("--api-host", default="127.0.0.1", help="Адрес заглушки API")
+    parser.add_argument("--api-port", type=int, default=18089, help="Порт заглушки API")
+    parser.add_argument("--api-latency", type=float, help="Задержка до первого токена (сек)")
+    parser.add_argument("--api-jitter", type=float, help="Случайная добавка к задержке API (сек)")
+    parser.add_argument("--reply-chars", type=int, help="Длина ответа модели (символов)")
+    parser.add_argument("--chunk-delay", type=float, help="Задержка между фрагментами потокового ответа (сек)")
+    parser.add_argument("--error-rate", type=float, help="Доля ответов API с ошибкой (0.0-1.0)")
+    parser.add_argument("--error-status", type=int, help="HTTP-код ошибок API")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="Задержка ответа Telegram (сек)")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="NAME=VALUE",
+                        help="Переопределить параметр config.py, например --set COALESCE_WINDOW=0")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="Замерять пиковую память Python через tracemalloc (замедляет работу)")
+    parser.add_argument("--output", help="Сохранить результаты в JSON-файл")
+    parser.add_argument("--baseline", help="JSON-файл предыдущего запуска для сравнения")
+    parser.add_argument("--max-regression", type=float,
+                        help="Допустимое ухудшение метрик относительно --baseline (%%); при превышении код выхода 1")
+    parser.add_argument("--log-level", default="WARNING", help="Уровень логирования бота")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Точка входа: запуск сценария, вывод и сохранение результатов."""
+    args = parse_args(argv)
+    scenario = load_workload(args.workload) if args.workload else build_scenario(
+        args.scenario, args.users, args.messages, args.think_time, args.seed
+    )
+    if args.save_workload:
+        save_workload(args.save_workload, scenario.events)
+        print(f"Сохранено событий: {len(scenario.events)} -> {args.save_workload}")
+        return 0
+    
+    stub_options = {"seed": args.seed, **scenario.stub_options}
+    for option, value in (("latency", args.api_latency), ("jitter", args.api_jitter),
+                          ("reply_chars", args.reply_chars), ("chunk_delay", args.chunk_delay),
+                          ("error_rate", args.error_rate), ("error_status", args.error_status)):
+        if value is not None:
+            stub_options[option] = value
+    stub = StubOpenAI(**stub_options)
+    
+    configure_environment(f"http://{args.api_host}:{args.api_port}/v1")
+    import config
+    overrides = apply_overrides(config, args.overrides)
+    # Импорт бота создаёт клиентов и менеджеров с учётом переопределённой конфигурации
+    import bot  # noqa: F401
+    logging.getLogger().setLevel(args.log_level)
+    
+    results = asyncio.run(run_scenario(scenario, stub, args))
+    results.update({
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "parameters": {
+            "users": args.users, "messages": args.messages, "think_time": args.think_time,
+            "seed": args.seed, "telegram_latency": args.telegram_latency,
+            "stub": stub_options, "overrides": overrides,
+        },
+    })
+    print_summary(results)
+    
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены: {args.output}")
+    
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""Сценарии нагрузки и записанные нагрузки в формате JSONL.
+
+Нагрузка - список событий, каждое событие - сообщение пользователя:
+{"user": 1, "text": "...", "delay": 0.5, "wait": true}
+delay - пауза перед отправкой после предыдущего сообщения этого же
+пользователя (сек), wait - дождаться обработки сообщения, прежде чем
+отправлять следующее (false - сообщения идут подряд, как при быстром наборе).
+"""
+import json
+import random
+from typing import Callable, Dict, List, Optional
+
+from prompts_manager import PromptsManager
+
+Event = Dict
+
+# Слова, из которых составляются вопросы пользователей
+_WORDS = (
+    "как", "почему", "что", "объясни", "сравни", "функция", "список", "python",
+    "ошибка", "сервер", "данные", "модель", "пример", "быстрее", "память",
+    "очередь", "запрос", "ответ", "база", "индекс", "кэш", "поток", "сеть",
+)
+
+
+class Scenario:
+    """Сценарий нагрузки: события и параметры заглушки API, при которых он имеет смысл."""
+    
+    __slots__ = ("name", "events", "stub_options")
+    
+    def __init__(self, name: str, events: List[Event], stub_options: Optional[Dict] = None):
+        """
+        Инициализация сценария.
+        
+        Args:
+            name: Название сценария
+            events: События (сообщения пользователей)
+            stub_options: Параметры заглушки API по умолчанию для сценария
+        """
+        self.name = name
+        self.events = events
+        self.stub_options = stub_options or {}
+    
+    @property
+    def users(self) -> int:
+        """Количество пользователей в сценарии."""
+        return len({event["user"] for event in self.events})
+
+
+def _question(rng: random.Random, words: int) -> str:
+    """Случайный вопрос из words слов."""
+    return " ".join(rng.choice(_WORDS) for _ in range(words)) + "?"
+
+
+def _event(user: int, text: str, delay: float = 0.0, wait: bool = True) -> Event:
+    """Событие нагрузки."""
+    return {"user": user, "text": text, "delay": delay, "wait": wait}
+
+
+def chat_scenario(users: int, messages: int, think_time: float, rng: random.Random) -> Scenario:
+    """Обычный диалог: отказ от промптов и последовательные короткие вопросы."""
+    events = []
+    for user in range(1, users + 1):
+        events.append(_event(user, "нет"))
+        for _ in range(messages - 1):
+            events.append(_event(user, _question(rng, rng.randint(4, 12)), think_time))
+    return Scenario("chat", events)
+
+
+def prompt_scenario(users: int, messages: int, think_time: float, rng: random.Random) -> Scenario:
+    """Режим промпта: выбор промпта из prompts.json и вопросы с ним."""
+    prompt_ids = [prompt["id"] for prompt in PromptsManager().get_prompts()]
+    events = []
+    for user in range(1, users + 1):
+        events.append(_event(user, "да"))
+        events.append(_event(user, str(prompt_ids[user % len(prompt_ids)])))
+        for _ in range(messages):
+            events.append(_event(user, _question(rng, rng.randint(8, 30)), think_time))
+    return Scenario("prompt", events)
+
+
+def long_context_scenario(users: int, messages: int, think_time: float, rng: random.Random) -> Scenario:
+    """Длинный контекст: большие сообщения, контекст упирается в бюджет токенов."""
+    events = []
+    for user in range(1, users + 1):
+        events.append(_event(user, "нет"))
+        for _ in range(messages - 1):
+            events.append(_event(user, _question(rng, rng.randint(300, 600)), think_time))
+    return Scenario("long_context", events, {"reply_chars": 2000})
+
+
+def multipart_scenario(users: int, messages: int, think_time: float, rng: random.Random) -> Scenario:
+    """Длинные ответы: каждый ответ делится на несколько сообщений Telegram."""
+    scenario = chat_scenario(users, messages, think_time, rng)
+    return Scenario("multipart", scenario.events, {"reply_chars": 10000, "chunk_chars": 200})
+
+
+def burst_scenario(users: int, messages: int, think_time: float, rng: random.Random) -> Scenario:
+    """Сообщения, отправленные подряд: объединение в один вопрос и отмена устаревших запросов."""
+    events = []
+    for user in range(1, users + 1):
+        events.append(_event(user, "нет"))
+        for _ in range(messages // 3):
+            events.append(_event(user, _question(rng, 5), think_time, wait=False))
+            events.append(_event(user, _question(rng, 5), 0.1, wait=False))
+            events.append(_event(user, _question(rng, 5), 0.1))
+    return Scenario("burst", events)
+
+
+def document_scenario(users: int, messages: int, think_time: float, rng: random.Random) -> Scenario:
+    """Длинные документы в режиме промпта: обработка по частям.
+    
+    Документ приходит несколькими сообщениями по 4000 символов подряд, как
+    Telegram делит длинную вставку, и объединяется в один вопрос.
+    """
+    prompt_ids = [prompt["id"] for prompt in PromptsManager().get_prompts()]
+    events = []
+    for user in range(1, users + 1):
+        events.append(_event(user, "да"))
+        events.append(_event(user, str(prompt_ids[user % len(prompt_ids)])))
+        for _ in range(messages):
+            document = "\n\n".join(
+                " ".join(_question(rng, rng.randint(8, 20)) for _ in range(6)) for _ in range(120)
+            )
+            parts = [document[start:start + 4000] for start in range(0, len(document), 4000)]
+            for index, part in enumerate(parts):
+                last = index == len(parts) - 1
+                events.append(_event(user, part, think_time if index == 0 else 0.05, wait=last))
+    return Scenario("document", events, {"reply_chars": 1500})
+
+
+# Встроенные сценарии по названию
+SCENARIOS: Dict[str, Callable[[int, int, float, random.Random], Scenario]] = {
+    "chat": chat_scenario,
+    "prompt": prompt_scenario,
+    "long_context": long_context_scenario,
+    "multipart": multipart_scenario,
+    "burst": burst_scenario,
+    "document": document_scenario,
+}
+
+
+def build_scenario(name: str, users: int, messages: int, think_time: float = 0.0,
+                   seed: int = 0) -> Scenario:
+    """
+    Создать встроенный сценарий.
+    
+    Args:
+        name: Название сценария (ключ SCENARIOS)
+        users: Количество пользователей
+        messages: Количество сообщений на пользователя
+        think_time: Пауза между сообщениями пользователя (сек)
+        seed: Начальное значение генератора случайных чисел
+    
+    Returns:
+        Сценарий нагрузки
+    """
+    return SCENARIOS[name](users, messages, think_time, random.Random(seed))
+
+
+def load_workload(path: str) -> Scenario:
+    """
+    Загрузить записанную нагрузку из JSONL-файла.
+    
+    Args:
+        path: Путь к файлу
+    
+    Returns:
+        Сценарий с событиями из файла
+    """
+    events = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                event = json.loads(line)
+                events.append(_event(int(event["user"]), event["text"],
+                                     float(event.get("delay", 0.0)), bool(event.get("wait", True))))
+    return Scenario(f"replay:{path}", events)
+
+
+def save_workload(path: str, events: List[Event]) -> None:
+    """
+    Сохранить нагрузку в JSONL-файл для повторного воспроизведения.
+    
+    Args:
+        path: Путь к файлу
+        events: События нагрузки
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        for event in events:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
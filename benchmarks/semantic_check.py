@@ -0,0 +1,84 @@
+"""Проверка семантического кэша: повторы, перефразировки, точные числа и вытеснение.
+
+Запускается из корня проекта:
+    
+    python -m benchmarks.semantic_check
+    python -m benchmarks.semantic_check --inserts 2000 --capacity 500
+"""
+import argparse
+import sys
+import traceback
+from typing import Callable, List
+
+import numpy as np
+
+from semantic_cache import SemanticCache
+
+_NAMESPACE = "check"
+
+
+def _filler(index: int) -> str:
+    """Вопрос, заполняющий пространство имён (разные слова и числа)."""
+    topics = ["погода", "рецепт", "перевод", "история", "налоги", "спорт", "музыка", "код"]
+    return f"Расскажи про {topics[index % len(topics)]} номер {index} и что с этим делать"
+
+
+def run_checks(inserts: int, capacity: int, report: Callable[[str], None] = print) -> None:
+    """
+    Проверить попадания после заполнения кэша и учёт вытесненных записей.
+    
+    Args:
+        inserts: Количество вопросов, добавляемых после проверяемого
+        capacity: Максимальное количество записей в пространстве имён
+        report: Функция вывода названия пройденной проверки
+    
+    Raises:
+        AssertionError: Кэш ведёт себя неправильно
+    """
+    question = "Как сбросить пароль от личного кабинета?"
+    cache = SemanticCache(threshold=0.95, capacity=capacity)
+    cache.add(_NAMESPACE, question, "ответ")
+    for index in range(inserts):
+        cache.add(_NAMESPACE, _filler(index), f"ответ {index}")
+        # Проверяемый вопрос задают снова, поэтому он не вытесняется
+        if index % 10 == 0:
+            assert cache.lookup(_NAMESPACE, question) == "ответ", f"промах после {index + 1} добавлений"
+    assert cache.lookup(_NAMESPACE, question) == "ответ"
+    report(f"Повтор вопроса: попадание после {inserts} добавлений")
+    
+    assert cache.lookup(_NAMESPACE, "как сбросить пароль от личного кабинета") == "ответ"
+    assert cache.lookup(_NAMESPACE, "Как сбросить пароль от почты?") is None
+    report("Перефразировка: регистр и пунктуация не мешают, другой вопрос не совпадает")
+    
+    cache.add(_NAMESPACE, "Сколько будет 2+2?", "4")
+    assert cache.lookup(_NAMESPACE, "сколько будет 2+2") == "4"
+    assert cache.lookup(_NAMESPACE, "Сколько будет 2*2?") is None
+    assert cache.lookup(_NAMESPACE, "Сколько будет 2+3?") is None
+    report("Числа и знаки операций совпадают точно")
+    
+    space = cache._namespaces[_NAMESPACE]
+    expected = (space.vectors[:space.size] > 0).sum(axis=0)
+    assert space.documents == space.size, (space.documents, space.size)
+    assert np.array_equal(space.doc_freq, expected)
+    report(f"Вытеснение: документная частота соответствует {space.size} записям ({cache.evictions} вытеснено)")
+
+
+def _main(inserts: int, capacity: int) -> int:
+    """Запускает проверки и возвращает код завершения."""
+    passed: List[str] = []
+    try:
+        run_checks(inserts, capacity, lambda name: (passed.append(name), print(f"OK   {name}")))
+    except Exception:
+        print(f"FAIL после {len(passed)} проверок:")
+        traceback.print_exc(limit=-1)
+        return 1
+    print(f"Все проверки пройдены ({len(passed)})")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Проверка семантического кэша")
+    parser.add_argument("--inserts", type=int, default=1000, help="Вопросов после проверяемого")
+    parser.add_argument("--capacity", type=int, default=300, help="Записей в пространстве имён")
+    args = parser.parse_args()
+    sys.exit(_main(args.inserts, args.capacity))
@@ -0,0 +1,322 @@
+"""Локальная заглушка API chat completions с настраиваемой задержкой и ошибками."""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Dict, Optional, Tuple
+
+from aiohttp import web
+
+# Слова, из которых составляются ответы заглушки
+_WORDS = (
+    "модель", "ответ", "контекст", "запрос", "данные", "пример", "результат",
+    "анализ", "текст", "вопрос", "решение", "задача", "код", "значение",
+)
+
+
+class StubOpenAI:
+    """HTTP-сервер, отвечающий на POST /v1/chat/completions как API OpenAI.
+    
+    Поддерживает обычные и потоковые ответы (SSE), задержку до первого
+    токена, скорость генерации и случайные ошибки с заданным кодом.
+    Пакетные задания (/v1/files и /v1/batches) выполняются сразу после
+    создания теми же обработчиками, что и обычные запросы.
+    Кэш промптов провайдера имитируется по целым сообщениям: начало
+    запроса, уже встречавшееся раньше, учитывается в cached_tokens.
+    """
+    
+    def __init__(self, latency: float = 0.2, jitter: float = 0.0, reply_chars: int = 400,
+                 chunk_chars: int = 24, chunk_delay: float = 0.005, error_rate: float = 0.0,
+                 error_status: int = 503, seed: Optional[int] = None):
+        """
+        Инициализация заглушки.
+        
+        Args:
+            latency: Задержка до первого токена (сек)
+            jitter: Случайная добавка к задержке, равномерно от 0 до jitter (сек)
+            reply_chars: Примерная длина ответа (символов)
+            chunk_chars: Примерная длина одного фрагмента потокового ответа (символов)
+            chunk_delay: Задержка между фрагментами ответа (сек)
+            error_rate: Доля запросов, на которые возвращается ошибка (0.0-1.0)
+            error_status: HTTP-код ошибки
+            seed: Начальное значение генератора случайных чисел
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.reply_chars = reply_chars
+        self.chunk_chars = chunk_chars
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+        self._prefixes = set()  # Начала запросов (по целым сообщениям), уже попавшие в кэш
+        
+        self.requests = 0
+        self.streamed = 0
+        self.errors = 0
+        self.active = 0
+        self.max_active = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.models: Dict[str, int] = {}  # Количество запросов по моделям
+        self._files: Dict[str, bytes] = {}  # Загруженные и созданные файлы пакетных заданий
+        self._batches: Dict[str, dict] = {}
+        self._batch_tasks = set()
+    
+    async def start(self, host: str = "127.0.0.1", port: int = 18089) -> str:
+        """
+        Запустить сервер.
+        
+        Args:
+            host: Адрес сервера
+            port: Порт сервера
+        
+        Returns:
+            Базовый адрес API для клиента OpenAI
+        """
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self._handle)
+        app.router.add_post("/v1/files", self._upload_file)
+        app.router.add_get("/v1/files/{file_id}/content", self._file_content)
+        app.router.add_post("/v1/batches", self._create_batch)
+        app.router.add_get("/v1/batches/{batch_id}", self._get_batch)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}/v1"
+    
+    async def stop(self) -> None:
+        """Остановить сервер."""
+        for task in self._batch_tasks:
+            task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+    
+    def stats(self) -> Dict[str, object]:
+        """
+        Получить статистику запросов.
+        
+        Returns:
+            Словарь с количеством запросов, потоковых запросов, ошибок,
+            максимальным числом одновременных запросов, токенами и
+            количеством запросов по моделям
+        """
+        return {
+            "requests": self.requests,
+            "streamed": self.streamed,
+            "errors": self.errors,
+            "max_active": self.max_active,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "models": dict(self.models),
+        }
+    
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        """Обрабатывает запрос chat completions."""
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            body = await request.json()
+            if body.get("stream"):
+                error, chunks, usage = await self._generate(body)
+                if error is not None:
+                    return web.json_response(error, status=self.error_status)
+                self.streamed += 1
+                return await self._stream(request, body["model"], chunks, usage)
+            status, payload = await self._complete(body)
+            return web.json_response(payload, status=status)
+        finally:
+            self.active -= 1
+    
+    async def _generate(self, body: dict) -> Tuple[Optional[dict], list, dict]:
+        """Ждёт задержку и составляет ответ: (ошибка или None, фрагменты ответа, статистика токенов)."""
+        self.requests += 1
+        self.models[body["model"]] = self.models.get(body["model"], 0) + 1
+        await asyncio.sleep(self.latency + self._random.uniform(0, self.jitter))
+        if self._random.random() < self.error_rate:
+            self.errors += 1
+            return {"error": {"message": "Ошибка, внесённая заглушкой", "type": "server_error"}}, [], {}
+        
+        prompt_chars, cached_chars = self._prompt_chars(body["messages"])
+        usage = {
+            "prompt_tokens": prompt_chars // 4,
+            "completion_tokens": self.reply_chars // 4,
+            "total_tokens": (prompt_chars + self.reply_chars) // 4,
+            "prompt_tokens_details": {"cached_tokens": cached_chars // 4},
+        }
+        self.prompt_tokens += usage["prompt_tokens"]
+        self.cached_tokens += cached_chars // 4
+        return None, self._reply_chunks(), usage
+    
+    async def _complete(self, body: dict) -> Tuple[int, dict]:
+        """Выполняет непотоковый запрос: (HTTP-код, тело ответа)."""
+        error, chunks, usage = await self._generate(body)
+        if error is not None:
+            return self.error_status, error
+        await asyncio.sleep(self.chunk_delay * len(chunks))
+        return 200, {
+            "id": f"stub-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(chunks)},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        }
+    
+    def _store_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        """Сохраняет файл и возвращает его описание."""
+        file_id = f"file-stub-{len(self._files) + 1}"
+        self._files[file_id] = content
+        return {
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed",
+        }
+    
+    async def _upload_file(self, request: web.Request) -> web.Response:
+        """Принимает файл пакетного задания (multipart/form-data)."""
+        form = await request.post()
+        upload = form["file"]
+        return web.json_response(self._store_file(upload.file.read(), upload.filename, form.get("purpose", "batch")))
+    
+    async def _file_content(self, request: web.Request) -> web.Response:
+        """Отдаёт содержимое файла."""
+        content = self._files.get(request.match_info["file_id"])
+        if content is None:
+            return web.json_response({"error": {"message": "Файл не найден"}}, status=404)
+        return web.Response(body=content, content_type="application/jsonl")
+    
+    async def _create_batch(self, request: web.Request) -> web.Response:
+        """Создаёт пакетное задание и запускает его выполнение в фоне."""
+        body = await request.json()
+        batch_id = f"batch-stub-{len(self._batches) + 1}"
+        batch = self._batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"], "completion_window": body["completion_window"],
+            "status": "in_progress", "created_at": int(time.time()),
+            "output_file_id": None, "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        task = asyncio.create_task(self._run_batch(batch))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+        return web.json_response(batch)
+    
+    async def _get_batch(self, request: web.Request) -> web.Response:
+        """Отдаёт состояние пакетного задания."""
+        batch = self._batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"error": {"message": "Задание не найдено"}}, status=404)
+        return web.json_response(batch)
+    
+    async def _run_batch(self, batch: dict) -> None:
+        """Выполняет строки входного файла задания и сохраняет результаты и ошибки."""
+        lines = [json.loads(line) for line in self._files[batch["input_file_id"]].splitlines() if line.strip()]
+        batch["request_counts"]["total"] = len(lines)
+        semaphore = asyncio.Semaphore(8)
+        
+        async def run_line(index: int, line: dict) -> Tuple[bool, str]:
+            async with semaphore:
+                status, payload = await self._complete(line["body"])
+            ok = status == 200
+            batch["request_counts"]["completed" if ok else "failed"] += 1
+            result = {
+                "id": f"batch_req_{index}", "custom_id": line["custom_id"],
+                "response": {"status_code": status, "request_id": f"req-{index}", "body": payload},
+                "error": None,
+            }
+            return ok, json.dumps(result, ensure_ascii=False)
+        
+        results = await asyncio.gather(*(run_line(index, line) for index, line in enumerate(lines)))
+        outputs = "\n".join(text for ok, text in results if ok)
+        errors = "\n".join(text for ok, text in results if not ok)
+        if outputs:
+            batch["output_file_id"] = self._store_file(outputs.encode("utf-8"), "output.jsonl", "batch_output")["id"]
+        if errors:
+            batch["error_file_id"] = self._store_file(errors.encode("utf-8"), "errors.jsonl", "batch_output")["id"]
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+    
+    async def _stream(self, request: web.Request, model: str, chunks: list,
+                      usage: dict) -> web.StreamResponse:
+        """Отправляет ответ фрагментами в формате server-sent events."""
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        base = {"id": f"stub-{self.requests}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": model}
+        try:
+            for chunk in chunks:
+                event = dict(base, choices=[{"index": 0, "delta": {"content": chunk}, "finish_reason": None}])
+                await response.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                await asyncio.sleep(self.chunk_delay)
+            event = dict(base, choices=[], usage=usage)
+            await response.write(f"data: {json.dumps(event)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        except ConnectionError:
+            # Клиент прервал поток (например, запрос отменён новым сообщением)
+            pass
+        return response
+    
+    def _prompt_chars(self, messages: list) -> Tuple[int, int]:
+        """Длина запроса и его начала, найденного в кэше (символов)."""
+        prefix, total, cached = (), 0, 0
+        for message in messages:
+            prefix += ((message.get("role"), str(message.get("content", ""))),)
+            total += len(prefix[-1][1])
+            key = hash(prefix)
+            if key in self._prefixes:
+                cached = total
+            else:
+                self._prefixes.add(key)
+        return total, cached
+    
+    def _reply_chunks(self) -> list:
+        """Составляет текст ответа из слов и делит его на фрагменты."""
+        chunks, chunk = [], ""
+        length = 0
+        while length < self.reply_chars:
+            word = self._random.choice(_WORDS)
+            # Перенос строки примерно через каждые 12 слов, чтобы ответ был похож на абзацы
+            chunk += word + ("\n" if self._random.random() < 0.08 else " ")
+            length += len(word) + 1
+            if len(chunk) >= self.chunk_chars:
+                chunks.append(chunk)
+                chunk = ""
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    """Запускает заглушку как отдельный сервер до прерывания."""
+    stub = StubOpenAI(
+        latency=args.latency, jitter=args.jitter, reply_chars=args.reply_chars,
+        chunk_delay=args.chunk_delay, error_rate=args.error_rate, error_status=args.error_status
+    )
+    url = await stub.start(args.host, args.port)
+    print(f"Заглушка API запущена: {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка API chat completions")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18089)
+    parser.add_argument("--latency", type=float, default=0.2, help="Задержка до первого токена (сек)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Случайная добавка к задержке (сек)")
+    parser.add_argument("--reply-chars", type=int, default=400, help="Длина ответа (символов)")
+    parser.add_argument("--chunk-delay", type=float, default=0.005, help="Задержка между фрагментами (сек)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов с ошибкой")
+    parser.add_argument("--error-status", type=int, default=503, help="HTTP-код ошибки")
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -1,41 +1,206 @@
 """Основной файл Telegram-бота с интеграцией OpenAI через ProxyAPI."""
 import asyncio
+import contextlib
+import json
 import logging
+import signal
+from typing import List, Optional
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.types import FSInputFile, Message
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 
 import config
+from coalescer import MessageCoalescer, RequestSuperseded
 from context_manager import ContextManager
+from fsm_storage import ContextFSMStorage, UserStateLoader
+from lifecycle import InflightTracker, run_until_terminated
+from map_reduce import MapReduceProcessor
 from api_client import OpenAIClient
+import metrics
+from profiling import LoopLagMonitor, SamplingProfiler, top_functions
 from prompts_manager import PromptsManager
+from response_cache import ResponseCache
+from scheduler import RequestExpiredError, RequestScheduler, SchedulerBusyError
+from semantic_cache import SemanticCache
+from state_backend import MemoryStateBackend, RedisStateBackend, SQLiteStateBackend, StateBackend
+from streaming import ProgressMessage, StreamingReply
+from summarizer import ConversationSummarizer
+from structured_logging import set_correlation_id, setup_logging
+from telegram_sender import TelegramSender
+import tracing
+import webhook
+from token_counter import count_message_tokens, count_tokens
+from usage_ledger import UsageLedger, format_usage_report
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Настройка логирования: запись в поток вывода идёт в фоне и не задерживает обработчики
+log_pipeline = setup_logging(
+    config.LOG_LEVEL,
+    json_format=config.LOG_JSON,
+    queue_size=config.LOG_QUEUE_SIZE,
+    sample_rates=config.LOG_SAMPLE_RATES
 )
 logger = logging.getLogger(__name__)
+# Трассировка этапов обработки обновлений (выключена, если не задано TRACING_ENABLED=1)
+tracer = tracing.setup_tracing(
+    config.TRACING_ENABLED,
+    path=config.TRACE_FILE,
+    endpoint=config.TRACE_OTLP_ENDPOINT,
+    sample_rate=config.TRACE_SAMPLE_RATE,
+    max_pending=config.TRACE_MAX_PENDING
+)
+
+
+def create_state_backend() -> StateBackend:
+    """Создаёт хранилище состояния пользователей, выбранное в конфигурации."""
+    if config.STATE_BACKEND == "redis":
+        return RedisStateBackend(config.STATE_REDIS_URL, key_prefix=config.STATE_KEY_PREFIX, ttl=config.STATE_TTL)
+    if config.STATE_BACKEND == "memory":
+        return MemoryStateBackend()
+    return SQLiteStateBackend(config.CONTEXT_DB_PATH)
+
+
+# Инициализация менеджеров
+context_manager = ContextManager(
+    max_messages=config.MAX_CONTEXT_MESSAGES,
+    max_tokens=config.MAX_CONTEXT_TOKENS,
+    backend=create_state_backend(),
+    max_active_users=config.MAX_ACTIVE_CONTEXTS,
+    idle_ttl=config.CONTEXT_IDLE_TTL
+)
 
 # Инициализация бота и диспетчера
 bot = Bot(
     token=config.BOT_TOKEN,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
-dp = Dispatcher(storage=MemoryStorage())
+# Состояние FSM хранится в записи пользователя вместе с контекстом; запись
+# подгружается один раз перед обработкой каждого события
+dp = Dispatcher(
+    storage=ContextFSMStorage(context_manager),
+    events_isolation=UserStateLoader(context_manager)
+)
+# Обновления в обработке: при остановке бот дожидается их завершения
+inflight = InflightTracker()
+# Задержка цикла событий отражает синхронную работу, которая задерживает все обработчики
+loop_lag_monitor = LoopLagMonitor(
+    config.LOOP_LAG_INTERVAL,
+    observer=metrics.EVENT_LOOP_LAG.observe,
+    warning_threshold=config.LOOP_LAG_WARNING,
+    keep_samples=False
+)
+profiler = SamplingProfiler(config.PROFILE_INTERVAL, output_dir=config.PROFILE_DIR)
+usage_ledger = UsageLedger(
+    config.USAGE_DB_PATH,
+    daily_user_tokens=config.USAGE_DAILY_USER_TOKENS or None,
+    exempt_users=config.ADMIN_IDS
+) if config.USAGE_LEDGER_ENABLED else None
+openai_client = OpenAIClient(usage_ledger)
+prompts_manager = PromptsManager(
+    config.PROMPTS_FILE,
+    page_size=config.PROMPTS_PAGE_SIZE,
+    search_limit=config.PROMPTS_SEARCH_LIMIT,
+    tiers=config.MODEL_TIERS
+)
+scheduler = RequestScheduler(
+    max_concurrency=config.SCHEDULER_MAX_CONCURRENCY,
+    max_queue_size=config.SCHEDULER_MAX_QUEUE,
+    max_queue_per_user=config.SCHEDULER_MAX_QUEUE_PER_USER,
+    queue_deadline=config.SCHEDULER_QUEUE_DEADLINE
+)
+coalescer = MessageCoalescer(window=config.COALESCE_WINDOW)
+response_cache = ResponseCache(
+    max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=config.RESPONSE_CACHE_TTL,
+    disk_path=config.RESPONSE_CACHE_DB_PATH or None
+) if config.RESPONSE_CACHE_ENABLED else None
+telegram_sender = TelegramSender(
+    global_rate=config.TELEGRAM_GLOBAL_RATE,
+    chat_rate=config.TELEGRAM_CHAT_RATE,
+    group_rate=config.TELEGRAM_GROUP_RATE,
+    chat_burst=config.TELEGRAM_CHAT_BURST,
+    max_retries=config.TELEGRAM_SEND_MAX_RETRIES
+)
+semantic_cache = SemanticCache(
+    threshold=config.SEMANTIC_CACHE_THRESHOLD,
+    capacity=config.SEMANTIC_CACHE_CAPACITY,
+    dim=config.SEMANTIC_CACHE_DIM
+) if config.SEMANTIC_CACHE_ENABLED else None
+summarizer = ConversationSummarizer(
+    context_manager,
+    openai_client,
+    model=config.SUMMARY_MODEL,
+    trigger_messages=config.SUMMARY_TRIGGER_MESSAGES,
+    trigger_tokens=config.SUMMARY_TRIGGER_TOKENS,
+    keep_messages=config.SUMMARY_KEEP_MESSAGES,
+    max_words=config.SUMMARY_MAX_WORDS,
+    max_concurrency=config.SUMMARY_MAX_CONCURRENCY,
+    timeout=config.SUMMARY_TIMEOUT
+) if config.SUMMARY_ENABLED else None
+map_reducer = MapReduceProcessor(
+    openai_client,
+    prompts_manager,
+    chunk_tokens=config.MAP_REDUCE_CHUNK_TOKENS,
+    reduce_tokens=config.MAP_REDUCE_REDUCE_TOKENS,
+    max_concurrency=config.MAP_REDUCE_MAX_CONCURRENCY,
+    max_total=config.MAP_REDUCE_MAX_TOTAL,
+    scheduler=scheduler
+) if config.MAP_REDUCE_ENABLED else None
 
-# Инициализация менеджеров
-context_manager = ContextManager(max_messages=config.MAX_CONTEXT_MESSAGES)
-openai_client = OpenAIClient()
-prompts_manager = PromptsManager()
 
-# Хранение выбранных промптов для пользователей
-user_selected_prompts = {}
+def register_metrics() -> None:
+    """Подключает счётчики планировщика, кэшей и очереди отправки к метрикам."""
+    metrics.REQUESTS_IN_FLIGHT.set_function(lambda: scheduler.in_flight)
+    metrics.REQUESTS_QUEUED.set_function(lambda: scheduler.queued)
+    metrics.REQUESTS_REJECTED.labels("queue_full").set_function(lambda: scheduler.rejected)
+    metrics.REQUESTS_REJECTED.labels("expired").set_function(lambda: scheduler.expired)
+    metrics.TELEGRAM_FLOOD_WAITS.labels().set_function(lambda: telegram_sender.flood_waits)
+    metrics.LOG_RECORDS_DROPPED.labels("queue_full").set_function(lambda: log_pipeline.dropped)
+    metrics.LOG_RECORDS_DROPPED.labels("sampled").set_function(lambda: log_pipeline.sampled_out)
+    metrics.SPANS_DROPPED.labels().set_function(lambda: tracer.dropped)
+    if usage_ledger is not None:
+        metrics.REQUESTS_REJECTED.labels("quota").set_function(lambda: usage_ledger.rejected)
+    if response_cache is not None:
+        metrics.CACHE_LOOKUPS.labels("response", "hit").set_function(lambda: response_cache.hits)
+        metrics.CACHE_LOOKUPS.labels("response", "miss").set_function(lambda: response_cache.misses)
+    if semantic_cache is not None:
+        metrics.CACHE_LOOKUPS.labels("semantic", "hit").set_function(lambda: semantic_cache.hits)
+        metrics.CACHE_LOOKUPS.labels("semantic", "miss").set_function(lambda: semantic_cache.misses)
+
+
+register_metrics()
+
+
+def get_selected_prompt(user_id: int) -> Optional[dict]:
+    """
+    Получить промпт, выбранный пользователем.
+    
+    Args:
+        user_id: ID пользователя Telegram
+        
+    Returns:
+        Словарь с данными промпта или None, если промпт не выбран
+    """
+    prompt_id = context_manager.get_selected_prompt_id(user_id)
+    return prompts_manager.get_prompt_by_id(prompt_id) if prompt_id is not None else None
+
+
+@dp.update.outer_middleware()
+async def correlation_middleware(handler, event: types.Update, data: dict):
+    """
+    Помечает записи лога номером обновления, открывает корневой интервал трассы
+    и учитывает обновление, пока оно обрабатывается.
+    """
+    set_correlation_id(f"upd-{event.update_id}")
+    user = data.get("event_from_user")
+    with inflight.track(), tracing.span(
+        "telegram.update", kind="server", update_id=event.update_id, update_type=event.event_type,
+        user_id=user.id if user else 0
+    ):
+        return await handler(event, data)
 
 
 class PromptStates(StatesGroup):
@@ -49,8 +214,7 @@ async def cmd_start(message: Message, state: FSMContext):
     user_id = message.from_user.id
     # Очищаем контекст и выбранный промпт
     context_manager.clear_context(user_id)
-    if user_id in user_selected_prompts:
-        del user_selected_prompts[user_id]
+    coalescer.reset(user_id)
     await state.clear()
     
     # Проверяем наличие промптов и предлагаем их использовать
@@ -81,7 +245,9 @@ async def cmd_help(message: Message):
         "<b>Команды бота:</b>\n\n"
         "/start - Начать работу с ботом\n"
         "/help - Показать это сообщение\n"
-        "/clear - Очистить контекст диалога\n\n"
+        "/clear - Очистить контекст диалога\n"
+        "/usage [дней] - Расход токенов (для администраторов)\n"
+        "/profile [секунд] - Профиль производительности (для администраторов)\n\n"
         "Просто напишите мне любое сообщение, и я отвечу!\n"
         "Я помню контекст диалога, так что можете задавать уточняющие вопросы."
     )
@@ -92,49 +258,123 @@ async def cmd_clear(message: Message, state: FSMContext):
     """Обработчик команд /clear и /reset для очистки контекста."""
     user_id = message.from_user.id
     context_manager.clear_context(user_id)
-    if user_id in user_selected_prompts:
-        del user_selected_prompts[user_id]
+    coalescer.reset(user_id)
     await state.clear()
     await message.answer("Контекст диалога очищен. Начнем с чистого листа!")
 
 
+@dp.message(Command("usage"))
+async def cmd_usage(message: Message):
+    """Обработчик команды /usage [дней]: расход токенов по пользователям, промптам и моделям (для администраторов)."""
+    if message.from_user.id not in config.ADMIN_IDS or usage_ledger is None:
+        await message.answer("Команда доступна только администраторам.")
+        return
+    argument = (message.text or "").split(maxsplit=1)[1:]
+    days = int(argument[0]) if argument and argument[0].isdigit() and int(argument[0]) > 0 else 1
+    report = await usage_ledger.report(days, limit=config.USAGE_REPORT_LIMIT)
+    prompt_names = {str(prompt['id']): prompt['name'] for prompt in prompts_manager.get_prompts()}
+    await message.answer(format_usage_report(report, days, prompt_names))
+
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: Message):
+    """Обработчик команды /profile [секунд]: снимает профиль бота и присылает файл для flamegraph (для администраторов)."""
+    if message.from_user.id not in config.ADMIN_IDS:
+        await message.answer("Команда доступна только администраторам.")
+        return
+    if profiler.running:
+        await message.answer("Профиль уже снимается, дождитесь результата.")
+        return
+    argument = (message.text or "").split(maxsplit=1)[1:]
+    seconds = int(argument[0]) if argument and argument[0].isdigit() else config.PROFILE_DEFAULT_SECONDS
+    seconds = max(1, min(seconds, config.PROFILE_MAX_SECONDS))
+    await message.answer(f"⏱ Снимаю профиль {seconds} сек...")
+    path, stacks = await profiler.profile(seconds)
+    if not stacks:
+        await message.answer("Не удалось снять ни одного замера.")
+        return
+    lines = [f"{share:.1%} {label}" for label, share in top_functions(stacks, limit=config.PROFILE_TOP_FUNCTIONS)]
+    caption = f"Замеров: {sum(stacks.values())}. Чаще всего на вершине стека:\n" + "\n".join(lines)
+    # Подпись к файлу в Telegram ограничена 1024 символами
+    await message.answer_document(FSInputFile(path), caption=caption[:1024], parse_mode=None)
+
+
+# Подсказка под меню выбора промпта
+PROMPT_CHOICE_HINT = (
+    "Введите <b>номер</b> промпта, название или слово для поиска, "
+    "<b>отмена</b> - для обычного режима."
+)
+# Подсказка о листании меню (если промпты не помещаются на одну страницу)
+PROMPT_PAGES_HINT = "\n<b>далее</b> / <b>назад</b> - другие страницы списка."
+
+
+async def show_prompt_menu(message: Message, state: FSMContext, page: int = 0) -> None:
+    """Показывает страницу меню промптов и запоминает её номер в состоянии."""
+    page = max(0, min(page, prompts_manager.page_count - 1))
+    await state.update_data(prompt_page=page)
+    hint = PROMPT_CHOICE_HINT + (PROMPT_PAGES_HINT if prompts_manager.page_count > 1 else "")
+    await message.answer(f"{prompts_manager.format_prompt_short(page)}\n\n{hint}")
+
+
+async def select_prompt(message: Message, state: FSMContext, prompt: dict) -> None:
+    """Сохраняет выбранный промпт пользователя и завершает выбор."""
+    context_manager.set_selected_prompt_id(message.from_user.id, prompt['id'])
+    await state.clear()
+    await message.answer(
+        f"✅ Выбран промпт: <b>{prompt['name']}</b>\n\n"
+        f"Роль: {prompt.get('role', '')}\n"
+        f"Контекст: {prompt.get('context', '')}\n\n"
+        f"Теперь задайте ваш вопрос, и я отвечу с использованием этого промпта."
+    )
+
+
 @dp.message(PromptStates.waiting_for_prompt_choice)
 async def handle_prompt_choice(message: Message, state: FSMContext):
-    """Обработчик выбора промпта по номеру."""
+    """Обработчик выбора промпта: по номеру, названию или поиску, с листанием меню."""
     user_id = message.from_user.id
     user_text = message.text.strip()
+    user_text_lower = user_text.lower()
     
     # Проверка на отмену
-    if user_text.lower() in ["отмена", "cancel", "нет", "no", "0"]:
+    if user_text_lower in ["отмена", "cancel", "нет", "no", "0"]:
         await state.clear()
-        if user_id in user_selected_prompts:
-            del user_selected_prompts[user_id]
+        context_manager.set_selected_prompt_id(user_id, None)
         await message.answer("Выбор промпта отменен. Работаю в обычном режиме.")
         return
     
-    # Пытаемся распарсить номер промпта
-    try:
-        prompt_id = int(user_text)
-        prompt = prompts_manager.get_prompt_by_id(prompt_id)
-        
+    # Листание меню
+    if user_text_lower in ["далее", "дальше", "next", ">"]:
+        page = (await state.get_data()).get("prompt_page", 0)
+        await show_prompt_menu(message, state, page + 1)
+        return
+    if user_text_lower in ["назад", "back", "prev", "<"]:
+        page = (await state.get_data()).get("prompt_page", 0)
+        await show_prompt_menu(message, state, page - 1)
+        return
+    
+    # Выбор по номеру
+    if user_text.isdigit():
+        prompt = prompts_manager.get_prompt_by_id(int(user_text))
         if prompt:
-            user_selected_prompts[user_id] = prompt
-            await state.clear()
+            await select_prompt(message, state, prompt)
+        else:
             await message.answer(
-                f"✅ Выбран промпт: <b>{prompt['name']}</b>\n\n"
-                f"Роль: {prompt.get('role', '')}\n"
-                f"Контекст: {prompt.get('context', '')}\n\n"
-                f"Теперь задайте ваш вопрос, и я отвечу с использованием этого промпта."
+                f"❌ Промпт с номером {user_text} не найден.\n"
+                f"Введите номер из списка, название или слово для поиска, или 'отмена'."
             )
-        else:
+        return
+    
+    # Выбор по точному названию, иначе поиск
+    prompt = prompts_manager.get_prompt_by_name(user_text)
+    if prompt is None:
+        results = prompts_manager.search(user_text)
+        if len(results) != 1:
             await message.answer(
-                f"❌ Промпт с номером {prompt_id} не найден.\n"
-                f"Пожалуйста, введите номер от 1 до {len(prompts_manager.get_prompts())} или 'отмена'."
+                f"{prompts_manager.format_search_results(user_text, results)}\n\n{PROMPT_CHOICE_HINT}"
             )
-    except ValueError:
-        await message.answer(
-            "❌ Пожалуйста, введите номер промпта (цифру) или 'отмена' для отмены."
-        )
+            return
+        prompt = results[0]
+    await select_prompt(message, state, prompt)
 
 
 @dp.message()
@@ -146,14 +386,13 @@ async def handle_message(message: Message, state: FSMContext):
     # Проверка на команду очистки контекста (без использования команды)
     if user_text.lower().strip() in ["очистить контекст", "очистить", "clear"]:
         context_manager.clear_context(user_id)
-        if user_id in user_selected_prompts:
-            del user_selected_prompts[user_id]
+        coalescer.reset(user_id)
         await state.clear()
         await message.answer("Контекст диалога очищен. Начнем с чистого листа!")
         return
     
     # Проверяем, есть ли у пользователя выбранный промпт
-    selected_prompt = user_selected_prompts.get(user_id)
+    selected_prompt = get_selected_prompt(user_id)
     
     # Если промпт не выбран и это первое сообщение в контексте, предлагаем использовать промпты
     if not selected_prompt and context_manager.get_context_length(user_id) == 0:
@@ -164,12 +403,8 @@ async def handle_message(message: Message, state: FSMContext):
             
             if user_text_lower in ["да", "yes", "y", "использовать", "use"]:
                 # Пользователь хочет использовать промпты
-                prompts_list = prompts_manager.format_prompt_short()
-                await message.answer(
-                    f"{prompts_list}\n\n"
-                    "Введите <b>номер</b> промпта для выбора или <b>отмена</b> для обычного режима."
-                )
                 await state.set_state(PromptStates.waiting_for_prompt_choice)
+                await show_prompt_menu(message, state)
                 return
             elif user_text_lower in ["нет", "no", "n", "не использовать"]:
                 # Пользователь не хочет использовать промпты - продолжаем как обычный запрос
@@ -193,97 +428,479 @@ async def handle_message(message: Message, state: FSMContext):
         await handle_prompt_choice(message, state)
         return
     
-    # Показываем индикатор печати
-    await bot.send_chat_action(chat_id=message.chat.id, action="typing")
+    # Дневной лимит токенов проверяется до очереди, чтобы отклонённый запрос не занимал место
+    if usage_ledger is not None and not usage_ledger.check(user_id):
+        await message.answer(
+            "⛔ Дневной лимит запросов исчерпан. Пожалуйста, возвращайтесь завтра."
+        )
+        logger.warning(
+            "Пользователь %s: запрос отклонен, дневной лимит исчерпан (%d токенов)",
+            user_id, usage_ledger.used_today(user_id)
+        )
+        return
     
-    # Получаем текущий контекст пользователя
-    existing_context = context_manager.get_context(user_id)
+    # Быстро идущие подряд сообщения объединяем в один вопрос
+    with tracing.span("coalescer.collect"):
+        turn = await coalescer.collect(user_id, user_text)
+    if turn is None:
+        # Сообщение будет обработано вместе со следующим сообщением пользователя
+        return
+    user_text = turn.text
+    
+    # Токены, которые промпт добавляет к запросу сверх контекста
+    prompt_overhead = prompts_manager.count_prompt_tokens(selected_prompt) if selected_prompt else 0
+    prompt_id = selected_prompt['id'] if selected_prompt else None
+    # Версия текста промпта: после правки промпта в файле прежние ответы из кэшей не выдаются
+    prompt_version = prompts_manager.get_prompt_version(selected_prompt) if selected_prompt else ""
+    # Запросы одного промпта начинаются одинаково - направляем их к одному кэшу провайдера
+    prompt_cache_key = (
+        f"prompt:{prompt_id}" if prompt_id is not None and config.PROMPT_CACHE_KEY_ENABLED else None
+    )
+    # Уровень модели по сложности запроса: короткие реплики - быстрой модели,
+    # уточнения в обычном диалоге - модели, на которой идёт диалог
+    dialog_tier = context_manager.get_dialog_tier(user_id) if prompt_id is None else None
+    tier = openai_client.router.classify(user_text, selected_prompt, dialog_tier) if config.ROUTER_ENABLED else None
+    # Кэши ответов разделены по модели уровня: ответ быстрой модели не выдаётся вместо ответа модели с рассуждениями
+    cache_model = openai_client.router.primary_model(tier)
+    
+    # Слишком длинный текст в режиме промпта обрабатывается по частям без контекста диалога
+    long_input = (
+        map_reducer is not None and selected_prompt is not None
+        and count_tokens(user_text) > config.MAP_REDUCE_THRESHOLD_TOKENS
+    )
     
-    # Формируем сообщения для API
-    if selected_prompt:
+    # Ключ кэша ответов (только для запросов с промптом без предыдущего контекста)
+    cache_key = None
+    # Пространство имён семантического кэша (только для первого сообщения диалога)
+    semantic_namespace = None
+    
+    # Формируем сообщения для API. Сообщение пользователя попадает в контекст
+    # только вместе с ответом, чтобы отменённый запрос не оставлял следов в истории
+    if long_input:
+        # Запросы частей не зависят от контекста, поэтому ответ можно кэшировать всегда
+        if response_cache is not None:
+            cache_key = response_cache.make_key(
+                selected_prompt['id'], cache_model, user_text, prompt_version
+            )
+        messages = None
+    elif selected_prompt:
+        # Сокращаем контекст, чтобы запрос с промптом и новым текстом уложился в бюджет токенов
+        existing_context = context_manager.fit_to_budget(user_id, prompt_overhead + count_tokens(user_text))
+        
+        if not existing_context:
+            if response_cache is not None:
+                cache_key = response_cache.make_key(
+                    selected_prompt['id'], cache_model, user_text, prompt_version
+                )
+            semantic_namespace = f"{cache_model}:prompt:{selected_prompt['id']}:{prompt_version}"
+        
         # Используем промпт для формирования запроса
         messages = prompts_manager.build_messages_with_prompt(
             selected_prompt, 
             user_text, 
             existing_context
         )
-        # Добавляем сообщение пользователя в контекст (для истории)
-        context_manager.add_message(user_id, "user", user_text)
     else:
         # Обычный режим без промпта
-        context_manager.add_message(user_id, "user", user_text)
-        messages = context_manager.get_context(user_id)
+        existing_context = context_manager.fit_to_budget(user_id, count_message_tokens(user_text))
+        if not existing_context and config.SEMANTIC_CACHE_CHAT:
+            semantic_namespace = f"{cache_model}:chat"
+        messages = existing_context.to_messages()
+        messages.append({"role": "user", "content": user_text})
     
     # Отправляем запрос к OpenAI API
     try:
-        response_text = await openai_client.get_response(messages)
+        with tracing.span("cache.lookup") as lookup_span:
+            cached_response = await response_cache.get(cache_key) if cache_key else None
+            if not cached_response and semantic_cache is not None and semantic_namespace:
+                # Похожий вопрос уже задавался - ответ на него подходит и для этого
+                cached_response = semantic_cache.lookup(semantic_namespace, user_text)
+            lookup_span.set_attribute("hit", bool(cached_response))
+        
+        if cached_response:
+            # Запрос уже обрабатывался - отвечаем без обращения к API
+            response_text = cached_response
+            coalescer.commit(user_id, turn)
+            await send_response(message, response_text)
+            logger.info("Пользователь %s: ответ из кэша", user_id)
+        elif long_input:
+            # Части текста обрабатываются одновременно, ход обработки показывается в чате;
+            # запрос каждой части сам проходит через планировщик и занимает в нём слот
+            response_text = await coalescer.run(
+                user_id, process_long_input(message, selected_prompt, user_text, prompt_cache_key, tier)
+            )
+            coalescer.commit(user_id, turn)
+            if response_text:
+                await send_response(message, response_text)
+        elif config.STREAMING_ENABLED:
+            # Ответ показывается по мере генерации; новое сообщение пользователя отменяет запрос
+            response_text = await coalescer.run(user_id, scheduler.submit(
+                user_id, lambda: stream_response(message, messages, prompt_id, prompt_cache_key, tier)
+            ))
+            coalescer.commit(user_id, turn)
+        else:
+            # Показываем индикатор печати
+            with tracing.span("telegram.send_chat_action", kind="client"):
+                await bot.send_chat_action(chat_id=message.chat.id, action="typing")
+            response_text = await coalescer.run(user_id, scheduler.submit(
+                user_id, lambda: openai_client.get_response(
+                    messages, prompt_id=prompt_id, cache_key=prompt_cache_key, tier=tier, user_id=user_id
+                )
+            ))
+            coalescer.commit(user_id, turn)
+            if response_text:
+                await send_response(message, response_text)
         
         if response_text:
-            # Добавляем ответ ассистента в контекст
-            context_manager.add_message(user_id, "assistant", response_text)
+            # Добавляем вопрос и ответ в контекст одновременно (от длинного текста - только начало)
+            context_text = shorten_for_context(user_text) if long_input else user_text
+            context_manager.add_message(user_id, "user", context_text, reserve_tokens=prompt_overhead)
+            context_manager.add_message(user_id, "assistant", response_text, reserve_tokens=prompt_overhead)
+            if tier is not None and prompt_id is None:
+                context_manager.set_dialog_tier(user_id, openai_client.router.next_dialog_tier(dialog_tier, tier))
+            if summarizer is not None:
+                # Старая часть длинного диалога сжимается в фоне, ответ не ждёт
+                summarizer.maybe_compact(user_id)
             
-            # Отправляем ответ пользователю без HTML-парсинга, чтобы избежать ошибок парсинга
-            # Если ответ слишком длинный, разбиваем на части
-            max_length = 4096  # Максимальная длина сообщения в Telegram
-            if len(response_text) > max_length:
-                # Разбиваем на части
-                parts = []
-                current_part = ""
-                for line in response_text.split('\n'):
-                    if len(current_part) + len(line) + 1 > max_length:
-                        if current_part:
-                            parts.append(current_part)
-                        current_part = line
-                    else:
-                        current_part += '\n' + line if current_part else line
-                if current_part:
-                    parts.append(current_part)
-                
-                for part in parts:
-                    await message.answer(part, parse_mode=None)
-            else:
-                await message.answer(response_text, parse_mode=None)
+            if not cached_response:
+                if cache_key:
+                    await response_cache.set(cache_key, response_text)
+                if semantic_cache is not None and semantic_namespace:
+                    semantic_cache.add(semantic_namespace, user_text, response_text)
             
             # Логируем статистику
             context_length = context_manager.get_context_length(user_id)
+            context_tokens = context_manager.get_context_tokens(user_id)
+            metrics.CONTEXT_MESSAGES.observe(context_length)
+            metrics.CONTEXT_TOKENS.observe(context_tokens)
             prompt_name = selected_prompt['name'] if selected_prompt else "обычный режим"
             logger.info(
-                f"Пользователь {user_id}: отправлен ответ. "
-                f"Контекст: {context_length} сообщений. "
-                f"Промпт: {prompt_name}"
+                "Пользователь %s: отправлен ответ. Контекст: %d сообщений (%d токенов). Промпт: %s",
+                user_id, context_length, context_tokens, prompt_name
             )
         else:
             await message.answer(
                 "Извините, произошла ошибка при обработке вашего запроса. "
                 "Попробуйте еще раз позже."
             )
-            logger.error(f"Ошибка: не удалось получить ответ от OpenAI для пользователя {user_id}")
+            logger.error("Ошибка: не удалось получить ответ от OpenAI для пользователя %s", user_id)
+    
+    except RequestSuperseded:
+        # Пользователь дописал вопрос: ответ на объединенный текст даст обработчик нового сообщения
+        logger.info("Пользователь %s: ответ отменен, вопрос будет дополнен новым сообщением", user_id)
+    
+    except (SchedulerBusyError, RequestExpiredError) as e:
+        coalescer.commit(user_id, turn)
+        # Сервис перегружен: быстро сообщаем об этом, не дожидаясь очереди
+        await message.answer(
+            "⏳ Сейчас слишком много запросов. Пожалуйста, повторите вопрос через минуту."
+        )
+        logger.warning(
+            "Пользователь %s: запрос отклонен планировщиком (%s). В очереди: %d, выполняется: %d",
+            user_id, type(e).__name__, scheduler.queued, scheduler.in_flight
+        )
     
     except Exception as e:
-        logger.error(f"Ошибка при обработке сообщения от пользователя {user_id}: {e}", exc_info=True)
+        coalescer.commit(user_id, turn)
+        logger.error("Ошибка при обработке сообщения от пользователя %s: %s", user_id, e, exc_info=True)
         await message.answer(
             "Произошла непредвиденная ошибка. Пожалуйста, попробуйте еще раз."
         )
 
 
+async def stream_response(message: Message, messages: list,
+                          prompt_id: Optional[int] = None, cache_key: Optional[str] = None,
+                          tier: Optional[str] = None) -> Optional[str]:
+    """
+    Получает ответ модели в потоковом режиме, редактируя сообщение по мере генерации.
+    
+    Args:
+        message: Сообщение пользователя, на которое отвечаем
+        messages: Список сообщений для отправки в API
+        prompt_id: ID выбранного промпта (для учёта токенов)
+        cache_key: Ключ кэша промптов провайдера
+        tier: Уровень моделей
+        
+    Returns:
+        Полный текст ответа или None в случае ошибки
+    """
+    reply = StreamingReply(
+        message,
+        telegram_sender,
+        edit_interval=config.STREAM_EDIT_INTERVAL,
+        placeholder=config.STREAM_PLACEHOLDER
+    )
+    await reply.start()
+    try:
+        with tracing.span("openai.stream") as stream_span:
+            chunks = 0
+            async for delta in openai_client.stream_response(
+                messages, prompt_id=prompt_id, cache_key=cache_key, tier=tier, user_id=message.from_user.id
+            ):
+                chunks += 1
+                await reply.append(delta)
+            stream_span.set_attribute("chunks", chunks)
+    except asyncio.CancelledError:
+        # Запрос отменен новым сообщением пользователя
+        await reply.abort("⚠️ Ответ прерван: вопрос дополнен новым сообщением")
+        raise
+    except Exception as e:
+        logger.error("Ошибка при потоковом запросе к OpenAI API: %s", e, exc_info=True)
+        await reply.abort()
+        return None
+    
+    response_text = await reply.finish()
+    if not response_text:
+        await reply.abort()
+        return None
+    return response_text
+
+
+async def process_long_input(message: Message, prompt: dict, text: str,
+                             cache_key: Optional[str] = None, tier: Optional[str] = None) -> Optional[str]:
+    """
+    Обрабатывает длинный текст по частям, показывая ход обработки в чате.
+    
+    Args:
+        message: Сообщение пользователя, на которое отвечаем
+        prompt: Выбранный промпт
+        text: Текст пользователя
+        cache_key: Ключ кэша промптов провайдера
+        tier: Уровень моделей
+        
+    Returns:
+        Объединённый ответ или None в случае ошибки
+    """
+    progress = ProgressMessage(message, telegram_sender, edit_interval=config.STREAM_EDIT_INTERVAL)
+    
+    async def report(done: int, total: int) -> None:
+        if done < total - 1:
+            await progress.update(f"⏳ Обработано частей текста: {done} из {total - 1}")
+        elif done == total - 1:
+            await progress.update("⏳ Объединяю результаты...")
+    
+    await progress.start("⏳ Текст длинный - обрабатываю его по частям...")
+    try:
+        with tracing.span("map_reduce.process", chars=len(text)):
+            return await map_reducer.process(
+                prompt, text, on_progress=report, cache_key=cache_key, tier=tier, user_id=message.from_user.id
+            )
+    finally:
+        await progress.delete()
+
+
+def shorten_for_context(text: str) -> str:
+    """Начало длинного текста для сохранения в контексте диалога."""
+    if len(text) <= config.MAP_REDUCE_CONTEXT_CHARS:
+        return text
+    return f"{text[:config.MAP_REDUCE_CONTEXT_CHARS]}… (текст сокращён, всего {len(text)} символов)"
+
+
+async def send_response(message: Message, response_text: str) -> None:
+    """
+    Отправляет ответ пользователю, разбивая его на части при необходимости.
+    
+    Части отправляются по порядку через очередь с ограничением частоты Telegram.
+    
+    Args:
+        message: Сообщение пользователя, на которое отвечаем
+        response_text: Текст ответа модели
+    """
+    # Отправляем ответ пользователю без HTML-парсинга, чтобы избежать ошибок парсинга
+    with tracing.span("telegram.send_response", kind="client", chars=len(response_text)):
+        await telegram_sender.send_text(message, response_text)
+
+
 async def main():
     """Основная функция запуска бота."""
     logger.info("Запуск бота...")
     
+    if config.BOT_MODE == "webhook" and config.BOT_WORKERS > 1:
+        # Этот процесс только принимает обновления, обработка - в дочерних процессах
+        await run_webhook_ingress()
+        return
+    
+    snapshot = snapshot_path()
+    if snapshot:
+        context_manager.load_snapshot(snapshot)
+    background_tasks = start_background_tasks()
+    metrics_runner = await start_metrics_server(config.METRICS_PORT)
+    
     try:
         # Проверка подключения к боту
         me = await bot.get_me()
         logger.info(f"Бот успешно запущен: @{me.username} ({me.first_name})")
         
-        # Запуск polling
-        await dp.start_polling(bot)
+        if config.BOT_MODE == "webhook":
+            # Обновления принимаются webhook и обрабатываются в фоне этого процесса
+            updates = webhook.BackgroundUpdates(bot, dp, max_pending=config.WEBHOOK_MAX_PENDING)
+            metrics.UPDATES_PENDING.set_function(lambda: updates.pending)
+            # По SIGTERM сервер перестаёт принимать обновления, принятые дорабатываются при остановке
+            await run_until_terminated(run_webhook_server(lambda body: updates.submit(json.loads(body))))
+        else:
+            # Запуск polling: aiogram прекращает получать обновления по SIGTERM/SIGINT,
+            # а сессия закрывается при остановке, после ответа на уже принятые
+            await dp.start_polling(bot, close_bot_session=False)
     
     except Exception as e:
         logger.error(f"Критическая ошибка при запуске бота: {e}", exc_info=True)
     finally:
+        await shutdown(background_tasks, metrics_runner, snapshot)
+
+
+def snapshot_path(worker: Optional[int] = None) -> Optional[str]:
+    """
+    Файл снимка контекстов процесса.
+    
+    Args:
+        worker: Номер процесса-обработчика (у каждого свой снимок)
+    
+    Returns:
+        Путь к файлу или None, если снимки отключены
+    """
+    if not config.CONTEXT_SNAPSHOT_PATH:
+        return None
+    if worker is None:
+        return config.CONTEXT_SNAPSHOT_PATH
+    return f"{config.CONTEXT_SNAPSHOT_PATH}.{worker}"
+
+
+def start_background_tasks() -> List[asyncio.Task]:
+    """Запускает фоновые задачи процесса, обрабатывающего обновления."""
+    tasks = [
+        # Запись контекстов в базу и выгрузка неактивных из памяти
+        asyncio.create_task(context_manager.run_maintenance(config.CONTEXT_FLUSH_INTERVAL)),
+        # Перезагрузка промптов при изменении файла
+        asyncio.create_task(prompts_manager.watch(config.PROMPTS_RELOAD_INTERVAL)),
+        # Замер задержки цикла событий
+        asyncio.create_task(loop_lag_monitor.run()),
+    ]
+    if tracer.enabled:
+        # Выгрузка интервалов трассировки
+        tasks.append(asyncio.create_task(tracer.run(config.TRACE_FLUSH_INTERVAL)))
+    if usage_ledger is not None:
+        # Запись счётчиков расхода токенов в базу
+        tasks.append(asyncio.create_task(usage_ledger.run(config.USAGE_FLUSH_INTERVAL)))
+    return tasks
+
+
+async def start_metrics_server(port: int):
+    """
+    Запускает сервер метрик, если он включён в конфигурации.
+    
+    Args:
+        port: Порт сервера (0 - не запускать)
+    
+    Returns:
+        AppRunner сервера или None
+    """
+    if not port:
+        return None
+    try:
+        return await metrics.start_metrics_server(config.METRICS_HOST, port)
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер метрик на порту {port}: {e}")
+        return None
+
+
+async def run_webhook_server(accept) -> None:
+    """Запускает сервер webhook с параметрами из конфигурации."""
+    await webhook.run_webhook_server(
+        bot,
+        accept,
+        url=config.WEBHOOK_URL,
+        path=config.WEBHOOK_PATH,
+        host=config.WEBHOOK_LISTEN_HOST,
+        port=config.WEBHOOK_PORT,
+        secret=config.WEBHOOK_SECRET
+    )
+
+
+async def run_webhook_ingress() -> None:
+    """Принимает обновления через webhook и распределяет их по процессам-обработчикам."""
+    processes, queues = webhook.start_workers(
+        config.BOT_WORKERS, run_worker, config.WEBHOOK_WORKER_QUEUE_SIZE
+    )
+    logger.info(f"Запущено процессов-обработчиков: {len(processes)}")
+    try:
+        me = await bot.get_me()
+        logger.info(f"Бот успешно запущен: @{me.username} ({me.first_name})")
+        await run_until_terminated(run_webhook_server(webhook.route_to_workers(queues)))
+    except Exception as e:
+        logger.error(f"Критическая ошибка при запуске бота: {e}", exc_info=True)
+    finally:
+        # Процессам-обработчикам нужно время дождаться принятых обновлений и записать снимок
+        await asyncio.to_thread(
+            webhook.stop_workers, processes, queues, config.SHUTDOWN_DRAIN_TIMEOUT + 10
+        )
         await bot.session.close()
 
 
+def run_worker(update_queue, index: int) -> None:
+    """
+    Точка входа процесса-обработчика обновлений.
+    
+    Args:
+        update_queue: Очередь обновлений этого процесса
+        index: Номер процесса
+    """
+    # Остановкой управляет основной процесс через сигнал в очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logger.info(f"Процесс-обработчик {index} запущен")
+    asyncio.run(serve_worker(update_queue, index))
+
+
+async def serve_worker(update_queue, index: int) -> None:
+    """Обрабатывает обновления из очереди процесса-обработчика до сигнала остановки."""
+    snapshot = snapshot_path(index)
+    if snapshot:
+        context_manager.load_snapshot(snapshot)
+    background_tasks = start_background_tasks()
+    # Каждый процесс отдаёт свои метрики на отдельном порту, следующем за основным
+    metrics_runner = await start_metrics_server(config.METRICS_PORT + 1 + index if config.METRICS_PORT else 0)
+    try:
+        updates = webhook.BackgroundUpdates(bot, dp, max_pending=config.WEBHOOK_MAX_PENDING)
+        metrics.UPDATES_PENDING.set_function(lambda: updates.pending)
+        await webhook.consume_updates(updates, update_queue)
+    finally:
+        await shutdown(background_tasks, metrics_runner, snapshot)
+
+
+async def shutdown(background_tasks: List[asyncio.Task], metrics_runner=None,
+                   snapshot: Optional[str] = None) -> None:
+    """
+    Дожидается обработки принятых обновлений, останавливает фоновые задачи,
+    сохраняет контексты и закрывает соединения.
+    
+    Args:
+        background_tasks: Фоновые задачи процесса
+        metrics_runner: Сервер метрик или None
+        snapshot: Файл снимка контекстов для быстрого перезапуска (None - не записывать)
+    """
+    # Ответы на уже принятые сообщения доходят до пользователей, пока сессия бота открыта
+    await inflight.wait(config.SHUTDOWN_DRAIN_TIMEOUT)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await scheduler.stop()
+    for task in background_tasks:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    if summarizer is not None:
+        await summarizer.close()
+    if snapshot:
+        await context_manager.save_snapshot(snapshot)
+    await context_manager.close()
+    if usage_ledger is not None:
+        await usage_ledger.close()
+    if response_cache is not None:
+        response_cache.close()
+    await openai_client.close()
+    await tracer.close()
+    await bot.session.close()
+
+
 if __name__ == "__main__":
     try:
         asyncio.run(main())
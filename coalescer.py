@@ -0,0 +1,161 @@
+"""Объединение быстро идущих подряд сообщений пользователя и отмена устаревших запросов."""
+import asyncio
+import logging
+from typing import Awaitable, Dict, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class RequestSuperseded(Exception):
+    """Запрос отменён, потому что пользователь отправил новое сообщение."""
+
+
+class CoalescedTurn:
+    """Объединённый ход пользователя: одно или несколько сообщений, отправляемых одним запросом."""
+    
+    __slots__ = ("text", "size", "committed", "_state")
+    
+    def __init__(self, text: str, size: int, state: "_UserState"):
+        """
+        Инициализация хода.
+        
+        Args:
+            text: Объединённый текст сообщений
+            size: Количество объединённых сообщений
+            state: Состояние пользователя, к которому относится ход
+        """
+        self.text = text
+        self.size = size
+        self.committed = False
+        self._state = state
+
+
+class _UserState:
+    """Незавершённые сообщения и выполняемый запрос одного пользователя."""
+    
+    __slots__ = ("texts", "generation", "turn_generation", "task")
+    
+    def __init__(self):
+        """Инициализация пустого состояния."""
+        self.texts: List[str] = []  # Сообщения, ещё не вошедшие в завершённый ход
+        self.generation = 0  # Номер последнего полученного сообщения
+        self.turn_generation = 0  # Номер последнего сообщения в последнем выданном ходе
+        self.task: Optional[asyncio.Task] = None  # Выполняемый запрос к модели
+
+
+class MessageCoalescer:
+    """Объединяет быстро идущие подряд сообщения пользователя в один ход.
+    
+    Первое сообщение отправляется сразу, без ожидания. Каждое новое
+    сообщение отменяет выполняемый запрос этого пользователя: текст
+    отменённого хода не теряется, а входит в следующий объединённый ход,
+    который ждёт окно объединения, пока серия сообщений не закончится.
+    Контекст диалога при этом не меняется, пока ход не завершён.
+    """
+    
+    def __init__(self, window: float = 0.4):
+        """
+        Инициализация объединителя.
+        
+        Args:
+            window: Время ожидания следующего сообщения, если у пользователя
+                есть неотправленный текст или выполняемый запрос (сек)
+        """
+        self.window = window
+        self._states: Dict[int, _UserState] = {}
+    
+    async def collect(self, user_id: int, text: str) -> Optional[CoalescedTurn]:
+        """
+        Добавить сообщение и, если оно продолжает серию, дождаться окончания окна объединения.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            text: Текст сообщения
+        
+        Returns:
+            Объединённый ход, если это последнее сообщение в окне, иначе None
+            (сообщение будет обработано вместе со следующим)
+        """
+        state = self._states.get(user_id)
+        if state is None:
+            state = self._states[user_id] = _UserState()
+        # Одиночное сообщение отправляется сразу; ждём только продолжения уже начатой серии
+        in_series = bool(state.texts) or (state.task is not None and not state.task.done())
+        state.texts.append(text)
+        state.generation += 1
+        generation = state.generation
+        
+        # Ответ на предыдущий ход больше не нужен: его текст войдёт в новый ход
+        if state.task is not None and not state.task.done():
+            state.task.cancel()
+            logger.info("Пользователь %s: запрос отменен из-за нового сообщения", user_id)
+        
+        if in_series and self.window > 0:
+            await asyncio.sleep(self.window)
+        if self._states.get(user_id) is not state or state.generation != generation:
+            return None
+        state.turn_generation = generation
+        return CoalescedTurn("\n".join(state.texts), len(state.texts), state)
+    
+    async def run(self, user_id: int, request: Awaitable[T]) -> T:
+        """
+        Выполнить запрос, который будет отменён при новом сообщении пользователя.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            request: Корутина запроса к модели
+        
+        Returns:
+            Результат запроса
+        
+        Raises:
+            RequestSuperseded: Пользователь отправил новое сообщение во время выполнения
+        """
+        task = asyncio.ensure_future(request)
+        state = self._states.get(user_id)
+        if state is not None:
+            state.task = task
+            if state.generation != state.turn_generation:
+                # Новое сообщение пришло, пока ход готовился к отправке: он войдёт в следующий ход
+                task.cancel()
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if state is not None and state.task is task:
+                state.task = None
+        
+        if task.cancelled():
+            raise RequestSuperseded()
+        return task.result()
+    
+    def commit(self, user_id: int, turn: CoalescedTurn) -> None:
+        """
+        Отметить ход завершённым: его сообщения больше не входят в следующие ходы.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            turn: Завершённый ход
+        """
+        if turn.committed:
+            return
+        turn.committed = True
+        state = turn._state
+        del state.texts[:turn.size]
+        if not state.texts and state.task is None and self._states.get(user_id) is state:
+            del self._states[user_id]
+    
+    def reset(self, user_id: int) -> None:
+        """
+        Сбросить незавершённые сообщения пользователя и отменить его запрос.
+        
+        Args:
+            user_id: ID пользователя Telegram
+        """
+        state = self._states.pop(user_id, None)
+        if state is not None and state.task is not None:
+            state.task.cancel()
@@ -16,13 +16,201 @@ if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY не найден в .env файле")
 
 # URL ProxyAPI
-PROXYAPI_BASE_URL = "https://api.proxyapi.ru/openai/v1"
+PROXYAPI_BASE_URL = os.getenv("PROXYAPI_BASE_URL", "https://api.proxyapi.ru/openai/v1")
+
+# Резервные адреса API через запятую (используются по порядку, если основной недоступен)
+PROXYAPI_FALLBACK_URLS = [url.strip() for url in os.getenv("PROXYAPI_FALLBACK_URLS", "").split(",") if url.strip()]
+PROXYAPI_BASE_URLS = [PROXYAPI_BASE_URL] + PROXYAPI_FALLBACK_URLS
 
 # Модель OpenAI
 OPENAI_MODEL = "o4-mini-2025-04-16"
 
+# Резервные модели (используются по порядку, если основная модель недоступна на всех адресах)
+OPENAI_FALLBACK_MODELS = ["gpt-4o-mini"]
+
+# Уровни моделей: каждый запрос получает уровень по сложности (длина, промпт, признаки
+# в тексте) и отправляется моделям уровня по порядку
+MODEL_TIERS = {
+    "fast": ["gpt-4o-mini"],  # Быстрая модель: благодарности, короткие реплики и справки
+    "reasoning": [OPENAI_MODEL] + OPENAI_FALLBACK_MODELS,  # Модель с рассуждениями
+}
+ROUTER_ENABLED = True  # Выбирать уровень по сложности запроса (иначе всегда ROUTER_DEFAULT_TIER)
+ROUTER_DEFAULT_TIER = "reasoning"  # Уровень для запросов, сложность которых не определена
+ROUTER_PROMPT_DEFAULT_TIER = "reasoning"  # Уровень для промптов без поля "tier" в prompts.json
+ROUTER_FAST_MAX_CHARS = 200  # Максимальная длина вопроса без признаков сложности для быстрой модели
+ROUTER_MAX_ERROR_RATE = 0.5  # Доля ошибок, при которой пара модель/адрес получает запросы в последнюю очередь
+ROUTER_SLOW_FACTOR = 3.0  # Во сколько раз задержка адреса должна превышать лучшую, чтобы он получал запросы последним
+ROUTER_RECOVERY_TIME = 60.0  # Через сколько секунд деградировавший адрес снова получает запросы первым
+
+# Цены моделей (долларов за 1 млн токенов) для учёта стоимости запросов
+MODEL_PRICES = {
+    "gpt-4o-mini": {"input": 0.15, "cached": 0.075, "output": 0.60},
+    "o4-mini-2025-04-16": {"input": 1.10, "cached": 0.275, "output": 4.40},
+}
+
+# Повторы запросов при временных ошибках (сетевые ошибки, 429, 5xx)
+RETRY_MAX_ATTEMPTS = 3  # Количество попыток на каждую пару модель/адрес
+RETRY_BASE_DELAY = 0.5  # Базовая задержка перед повтором (сек), растет экспоненциально
+RETRY_MAX_DELAY = 10.0  # Максимальная задержка перед повтором (сек); при большем Retry-After переходим к резервному адресу
+
+# Автоматический выключатель: временно не обращаемся к адресу, который подряд возвращает ошибки
+CIRCUIT_FAILURE_THRESHOLD = 5  # Количество ошибок подряд до отключения адреса
+CIRCUIT_RESET_TIMEOUT = 30.0  # Время отключения адреса до пробного запроса (сек)
+
+# Дублирующие запросы: если ответ задерживается дольше p95, отправляется копия запроса
+HEDGE_ENABLED = False  # Включить дублирующие запросы (увеличивают расход токенов)
+HEDGE_MIN_SAMPLES = 20  # Минимальное количество замеров задержки для оценки p95
+HEDGE_MIN_DELAY = 2.0  # Минимальная задержка перед отправкой копии (сек)
+
+# Настройки HTTP-клиента OpenAI (общий пул соединений для всех запросов)
+OPENAI_HTTP2 = True  # Использовать HTTP/2 (несколько запросов в одном соединении)
+OPENAI_MAX_CONNECTIONS = 200  # Максимальное количество одновременных соединений
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 50  # Количество соединений, удерживаемых в пуле
+OPENAI_KEEPALIVE_EXPIRY = 30.0  # Время жизни простаивающего соединения (сек)
+OPENAI_CONNECT_TIMEOUT = 10.0  # Таймаут установки соединения (сек)
+OPENAI_REQUEST_TIMEOUT = 120.0  # Таймаут одного запроса к API (сек)
+
+# Планировщик запросов к модели
+SCHEDULER_MAX_CONCURRENCY = 32  # Максимальное количество одновременных запросов к API
+SCHEDULER_MAX_QUEUE = 500  # Максимальное количество запросов в очереди
+SCHEDULER_MAX_QUEUE_PER_USER = 3  # Максимальное количество запросов одного пользователя в очереди
+SCHEDULER_QUEUE_DEADLINE = 30.0  # Максимальное время ожидания в очереди (сек)
+
+# Объединение сообщений: сообщения, отправленные подряд в пределах окна, обрабатываются одним запросом
+COALESCE_WINDOW = 0.4  # Окно ожидания следующего сообщения, если предыдущее ещё не обработано (сек)
+
+# Кэш ответов для запросов в режиме промпта без предыдущего контекста
+RESPONSE_CACHE_ENABLED = True  # Включить кэш ответов
+RESPONSE_CACHE_MAX_ENTRIES = 1000  # Максимальное количество ответов в памяти
+RESPONSE_CACHE_TTL = 86400  # Время жизни ответа в кэше (сек)
+RESPONSE_CACHE_DB_PATH = os.getenv("RESPONSE_CACHE_DB_PATH", "response_cache.db")  # Дисковый уровень ("" - отключить)
+
+# Семантический кэш: ответы на перефразированные вопросы без предыдущего контекста
+SEMANTIC_CACHE_ENABLED = True  # Включить семантический кэш
+SEMANTIC_CACHE_THRESHOLD = 0.95  # Минимальная косинусная близость вопросов (0.0-1.0)
+SEMANTIC_CACHE_CHAT = False  # Использовать и в обычном режиме без промпта (ответы общие для всех пользователей)
+SEMANTIC_CACHE_CAPACITY = 1000  # Максимальное количество записей на промпт
+SEMANTIC_CACHE_DIM = 1024  # Размерность векторов вопросов
+
+# Потоковая выдача ответов (сообщение редактируется по мере генерации)
+STREAMING_ENABLED = True  # Включить потоковый режим ответов
+STREAM_EDIT_INTERVAL = 1.0  # Минимальный интервал между редактированиями сообщения (сек)
+STREAM_PLACEHOLDER = "⏳"  # Текст сообщения-заглушки до появления первых токенов
+
+# Ограничение частоты отправки сообщений в Telegram (сообщений в секунду)
+TELEGRAM_GLOBAL_RATE = 30.0  # Для всего бота
+TELEGRAM_CHAT_RATE = 1.0  # В один личный чат
+TELEGRAM_GROUP_RATE = 20 / 60  # В одну группу (20 сообщений в минуту)
+TELEGRAM_CHAT_BURST = 3  # Количество сообщений, которое можно отправить в чат без ожидания
+TELEGRAM_SEND_MAX_RETRIES = 5  # Максимальное количество повторов после ответа 429 (flood wait)
+
+# Способ получения обновлений: "polling" или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Настройки webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес сервера (https://example.com)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")  # Путь, на который Telegram отправляет обновления
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Секрет для проверки, что запрос пришёл от Telegram
+WEBHOOK_LISTEN_HOST = os.getenv("WEBHOOK_LISTEN_HOST", "0.0.0.0")  # Адрес, на котором слушает сервер
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))  # Порт сервера
+WEBHOOK_MAX_PENDING = 1000  # Максимальное количество обновлений в обработке в одном процессе
+WEBHOOK_WORKER_QUEUE_SIZE = 1000  # Максимальная очередь обновлений одного процесса-обработчика
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))  # Количество процессов-обработчиков (только для webhook)
+
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    raise ValueError("WEBHOOK_URL не найден в .env файле (обязателен для BOT_MODE=webhook)")
+
+# Сервер метрик в формате Prometheus (GET /metrics); при BOT_WORKERS > 1 процессы-обработчики
+# используют следующие порты: METRICS_PORT + 1, METRICS_PORT + 2, ...
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # Адрес сервера метрик
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))  # Порт сервера метрик (0 - отключить)
+
+# Заготовленные промпты: файл перечитывается при изменении без перезапуска бота
+PROMPTS_FILE = os.getenv("PROMPTS_FILE", "prompts.json")  # Файл с промптами
+PROMPTS_RELOAD_INTERVAL = 2.0  # Интервал проверки изменения файла (сек)
+PROMPTS_PAGE_SIZE = 20  # Количество промптов на странице меню
+PROMPTS_SEARCH_LIMIT = 10  # Максимальное количество результатов поиска промпта
+PROMPT_CACHE_KEY_ENABLED = True  # Передавать prompt_cache_key, чтобы запросы одного промпта попадали в общий кэш провайдера
+
+# Обработка длинных текстов в режиме промпта по частям: части обрабатываются
+# одновременно, затем результаты объединяются отдельным запросом
+MAP_REDUCE_ENABLED = True  # Включить обработку по частям
+MAP_REDUCE_THRESHOLD_TOKENS = 3000  # Текст длиннее (в токенах) обрабатывается по частям
+MAP_REDUCE_CHUNK_TOKENS = 2000  # Максимальный размер части (токенов)
+MAP_REDUCE_REDUCE_TOKENS = 6000  # Максимальный размер результатов в одном запросе на объединение (токенов)
+MAP_REDUCE_MAX_CONCURRENCY = 4  # Одновременных запросов для одного текста
+MAP_REDUCE_MAX_TOTAL = 16  # Одновременных запросов для всех текстов
+MAP_REDUCE_CONTEXT_CHARS = 500  # Сколько символов длинного текста сохранять в контексте диалога
+
 # Настройки для управления контекстом
 MAX_CONTEXT_MESSAGES = 20  # Максимальное количество сообщений в контексте
+MAX_CONTEXT_TOKENS = 6000  # Бюджет токенов на запрос: контекст + служебная часть промпта
+
+# Фоновое сжатие длинных диалогов: старые сообщения заменяются кратким содержанием,
+# которое составляет более дешёвая модель после отправки ответа пользователю
+SUMMARY_ENABLED = True  # Включить сжатие контекста
+SUMMARY_MODEL = "gpt-4o-mini"  # Модель, составляющая краткое содержание
+SUMMARY_TRIGGER_MESSAGES = 14  # Сжимать контекст, в котором больше сообщений
+SUMMARY_TRIGGER_TOKENS = 3600  # Сжимать контекст, размер которого больше (в токенах)
+SUMMARY_KEEP_MESSAGES = 6  # Количество последних сообщений, которые остаются без сжатия
+SUMMARY_MAX_WORDS = 250  # Максимальная длина краткого содержания (слов)
+SUMMARY_MAX_CONCURRENCY = 2  # Максимальное количество одновременных запросов на сжатие
+SUMMARY_TIMEOUT = 60.0  # Таймаут запроса на сжатие (сек)
+
+# Хранилище состояния пользователей (контекст, выбранный промпт, состояние FSM):
+# "sqlite" - локальный файл, "memory" - только память процесса,
+# "redis" - сервер с протоколом Redis, общий для нескольких экземпляров бота
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://127.0.0.1:6379/0")  # Адрес сервера для "redis"
+STATE_KEY_PREFIX = os.getenv("STATE_KEY_PREFIX", "vpf02:")  # Префикс ключей в общем хранилище
+STATE_TTL = 30 * 86400  # Время жизни записи без изменений в общем хранилище (сек, 0 - без ограничения)
+
+# Хранение контекстов: активные диалоги в памяти, остальные в хранилище
+CONTEXT_DB_PATH = os.getenv("CONTEXT_DB_PATH", "contexts.db")  # Файл базы контекстов (для "sqlite")
+MAX_ACTIVE_CONTEXTS = 10000  # Максимальное количество контекстов в памяти
+CONTEXT_IDLE_TTL = 1800  # Время простоя (сек), после которого контекст выгружается из памяти
+# Интервал фоновой записи изменений в хранилище (сек); для общего хранилища короче,
+# чтобы другие экземпляры бота быстрее видели изменения
+CONTEXT_FLUSH_INTERVAL = 0.5 if STATE_BACKEND == "redis" else 5.0
+
+# Плавная остановка по SIGTERM: принятые обновления дорабатываются, затем контексты
+# записываются в снимок, который следующий запуск подключает без загрузки всех диалогов
+SHUTDOWN_DRAIN_TIMEOUT = 20.0  # Максимальное время ожидания обработки принятых обновлений (сек)
+CONTEXT_SNAPSHOT_PATH = os.getenv("CONTEXT_SNAPSHOT_PATH", "contexts.snapshot")  # Файл снимка ("" - отключить)
+
+# Логирование: записи передаются через ограниченную очередь в фоновый поток
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # Уровень логирования
+LOG_JSON = os.getenv("LOG_JSON", "0") == "1"  # Писать записи в JSON (одна строка на запись)
+LOG_QUEUE_SIZE = 10000  # Максимум записей в очереди; при переполнении записи отбрасываются
+LOG_SAMPLE_RATES = {"aiogram.event": 0.1}  # Доля сохраняемых записей ниже WARNING по имени логгера
+
+# Трассировка обработки обновлений: интервалы этапов выгружаются в формате OTLP JSON
+# в файл (по пачке на строку) или в коллектор OpenTelemetry по HTTP
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "0") == "1"  # Включить трассировку
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")  # Файл трасс (если не задан коллектор)
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")  # Адрес коллектора, например http://127.0.0.1:4318/v1/traces
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))  # Доля трассируемых обновлений (0.0-1.0)
+TRACE_FLUSH_INTERVAL = 5.0  # Интервал выгрузки накопленных интервалов (сек)
+TRACE_MAX_PENDING = 10000  # Максимум интервалов, ожидающих выгрузки; лишние отбрасываются
+
+# Диагностика производительности: задержка цикла событий и профилировщик (команда /profile)
+LOOP_LAG_INTERVAL = 0.1  # Период замера задержки цикла событий (сек)
+LOOP_LAG_WARNING = 0.25  # Задержка, при которой в лог пишется предупреждение (сек)
+PROFILE_INTERVAL = 0.005  # Период снятия стека профилировщиком (сек)
+PROFILE_DEFAULT_SECONDS = 10  # Длительность профилирования по умолчанию (сек)
+PROFILE_MAX_SECONDS = 60  # Максимальная длительность профилирования (сек)
+PROFILE_TOP_FUNCTIONS = 8  # Функций в сводке, присылаемой вместе с файлом профиля
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")  # Каталог файлов профилей
+
+# Учёт расхода токенов по пользователям, промптам и моделям и дневные лимиты
+USAGE_LEDGER_ENABLED = True  # Включить учёт расхода и лимиты
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", "usage.db")  # Файл базы расхода
+USAGE_FLUSH_INTERVAL = 10.0  # Интервал записи накопленных счётчиков в базу (сек)
+USAGE_DAILY_USER_TOKENS = int(os.getenv("USAGE_DAILY_USER_TOKENS", "200000"))  # Дневной лимит токенов на пользователя (0 - без ограничения)
+USAGE_REPORT_LIMIT = 10  # Строк в каждом разделе отчёта /usage
+
+# Администраторы бота (ID через запятую): команды /usage и /profile, без дневного лимита
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
 
 # Параметры модели OpenAI (можно настраивать)
 TEMPERATURE = 0.7  # Температура (0.0-2.0), влияет на креативность ответов
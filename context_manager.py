@@ -1,36 +1,310 @@
 """Управление контекстом диалогов пользователей."""
-from typing import Dict, List
+import asyncio
+from collections import OrderedDict
+from itertools import chain, islice
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import logging
+import sys
+import time
+
+from context_snapshot import FLAG_DIRTY, ContextSnapshot, encode_record, write_snapshot
+from state_backend import StateBackend, VersionedRecord
+from token_counter import count_message_tokens
 
 logger = logging.getLogger(__name__)
 
 
+class ContextMessage:
+    """Сообщение контекста: роль, текст и размер в токенах.
+    
+    Роль интернируется: у всех сообщений с одной ролью это один и тот же
+    объект строки, поэтому сообщение занимает три ссылки без словаря.
+    """
+    
+    __slots__ = ("role", "content", "tokens")
+    
+    def __init__(self, role: str, content: str, tokens: int):
+        """
+        Инициализация сообщения.
+        
+        Args:
+            role: Роль отправителя ('system', 'user' или 'assistant')
+            content: Текст сообщения
+            tokens: Размер сообщения в запросе (токенов)
+        """
+        self.role = sys.intern(role)
+        self.content = content
+        self.tokens = tokens
+    
+    def to_dict(self) -> Dict[str, str]:
+        """Сообщение в формате API."""
+        return {"role": self.role, "content": self.content}
+
+
+class MessageRing:
+    """Кольцевой буфер сообщений фиксированной ёмкости.
+    
+    Добавление в конец и удаление из начала не сдвигают остальные
+    сообщения; при заполненном буфере новое сообщение вытесняет самое старое.
+    """
+    
+    __slots__ = ("_items", "_start", "_length")
+    
+    def __init__(self, capacity: int):
+        """
+        Инициализация пустого буфера.
+        
+        Args:
+            capacity: Максимальное количество сообщений
+        """
+        self._items: List[Optional[ContextMessage]] = [None] * max(1, capacity)
+        self._start = 0
+        self._length = 0
+    
+    def __len__(self) -> int:
+        return self._length
+    
+    def __iter__(self) -> Iterator[ContextMessage]:
+        items, start, capacity = self._items, self._start, len(self._items)
+        for offset in range(self._length):
+            yield items[(start + offset) % capacity]
+    
+    def __getitem__(self, index: int) -> ContextMessage:
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("Индекс за пределами буфера")
+        return self._items[(self._start + index) % len(self._items)]
+    
+    def append(self, message: ContextMessage) -> Optional[ContextMessage]:
+        """
+        Добавить сообщение в конец.
+        
+        Returns:
+            Вытесненное самое старое сообщение или None, если место было
+        """
+        evicted = self.popleft() if self._length == len(self._items) else None
+        self._items[(self._start + self._length) % len(self._items)] = message
+        self._length += 1
+        return evicted
+    
+    def popleft(self) -> ContextMessage:
+        """Удалить и вернуть самое старое сообщение."""
+        if not self._length:
+            raise IndexError("Буфер пуст")
+        message = self._items[self._start]
+        self._items[self._start] = None
+        self._start = (self._start + 1) % len(self._items)
+        self._length -= 1
+        return message
+
+
+class UserContext:
+    """Запись пользователя: контекст диалога, выбранный промпт и состояние FSM.
+    
+    Краткое содержание сжатой части диалога хранится отдельно от истории
+    и всегда идёт в начале контекста.
+    """
+    
+    __slots__ = ("summary", "history", "total_tokens", "prompt_id", "tier", "fsm", "version", "last_access")
+    
+    def __init__(self, capacity: int, version: int = 0):
+        """
+        Инициализация пустого контекста.
+        
+        Args:
+            capacity: Максимальное количество сообщений в истории
+            version: Версия записи в хранилище, от которой получен контекст (0 - записи нет)
+        """
+        self.summary: Optional[ContextMessage] = None  # Системное сообщение с кратким содержанием
+        self.history = MessageRing(capacity)
+        self.total_tokens = 0  # Сумма токенов всех сообщений
+        self.prompt_id: Optional[int] = None  # ID выбранного пользователем промпта
+        self.tier: Optional[str] = None  # Уровень модели диалога в обычном режиме (см. ModelRouter.classify)
+        self.fsm: Dict[str, Dict[str, Any]] = {}  # Ключ FSM -> {"state": ..., "data": ...}
+        self.version = version
+        self.last_access = time.monotonic()
+    
+    def __len__(self) -> int:
+        return len(self.history) + (self.summary is not None)
+    
+    def __iter__(self) -> Iterator[ContextMessage]:
+        if self.summary is not None:
+            yield self.summary
+        yield from self.history
+    
+    def append(self, message: ContextMessage) -> None:
+        """Добавляет сообщение в конец истории."""
+        evicted = self.history.append(message)
+        self.total_tokens += message.tokens
+        if evicted is not None:
+            self.total_tokens -= evicted.tokens
+    
+    def pop_oldest(self) -> None:
+        """Удаляет самое старое сообщение истории (краткое содержание остаётся)."""
+        self.total_tokens -= self.history.popleft().tokens
+    
+    def set_summary(self, summary: Optional[ContextMessage]) -> None:
+        """Заменяет краткое содержание в начале контекста."""
+        if self.summary is not None:
+            self.total_tokens -= self.summary.tokens
+        self.summary = summary
+        if summary is not None:
+            self.total_tokens += summary.tokens
+    
+    def to_record(self) -> Dict:
+        """Сериализует контекст для сохранения в хранилище."""
+        record = {
+            "messages": [message.to_dict() for message in self],
+            "tokens": [message.tokens for message in self],
+            "prompt_id": self.prompt_id,
+        }
+        if self.tier is not None:
+            record["tier"] = self.tier
+        if self.fsm:
+            record["fsm"] = self.fsm
+        return record
+    
+    @classmethod
+    def from_record(cls, record: Dict, capacity: int, version: int = 0) -> "UserContext":
+        """Восстанавливает контекст из данных хранилища."""
+        context = cls(capacity, version)
+        for message, tokens in zip(record.get("messages", []), record.get("tokens", [])):
+            entry = ContextMessage(message["role"], message["content"], tokens)
+            if entry.role == "system" and context.summary is None and not context.history:
+                context.set_summary(entry)
+            else:
+                context.append(entry)
+        context.prompt_id = record.get("prompt_id")
+        context.tier = record.get("tier")
+        context.fsm = record.get("fsm", {})
+        return context
+
+
+class ContextView:
+    """Контекст пользователя только для чтения: сообщения перебираются без копирования истории.
+    
+    Вид отражает текущее состояние контекста, поэтому запрос к API
+    формируется из него сразу, до следующего изменения контекста.
+    """
+    
+    __slots__ = ("_context",)
+    
+    def __init__(self, context: Optional[UserContext]):
+        """
+        Инициализация вида.
+        
+        Args:
+            context: Контекст пользователя (None - пустой контекст)
+        """
+        self._context = context
+    
+    def __len__(self) -> int:
+        return len(self._context) if self._context is not None else 0
+    
+    def __iter__(self) -> Iterator[ContextMessage]:
+        return iter(self._context) if self._context is not None else iter(())
+    
+    @property
+    def tokens(self) -> int:
+        """Размер контекста в токенах."""
+        return self._context.total_tokens if self._context is not None else 0
+    
+    def to_messages(self) -> List[Dict[str, str]]:
+        """Сообщения контекста в формате API (краткое содержание первым)."""
+        return [message.to_dict() for message in self]
+
+
 class ContextManager:
-    """Менеджер для хранения и управления контекстом диалогов пользователей."""
+    """Менеджер для хранения и управления контекстом диалогов пользователей.
+    
+    В памяти держится ограниченное количество активных контекстов (LRU).
+    Если задано хранилище, изменения записываются в него пачками в фоне,
+    а вытесненные контексты подгружаются при следующем сообщении пользователя.
+    Запись сохраняется, только если её версия в хранилище не изменилась;
+    при конфликте побеждает версия из хранилища.
+    """
     
-    def __init__(self, max_messages: int = 20):
+    def __init__(self, max_messages: int = 20, max_tokens: Optional[int] = None,
+                 backend: Optional[StateBackend] = None,
+                 max_active_users: Optional[int] = None,
+                 idle_ttl: Optional[float] = None):
         """
         Инициализация менеджера контекста.
         
         Args:
             max_messages: Максимальное количество сообщений в контексте пользователя
+            max_tokens: Максимальный размер контекста пользователя в токенах
+                (None - ограничение только по количеству сообщений)
+            backend: Хранилище записей пользователей (None - только память)
+            max_active_users: Максимальное количество контекстов в памяти (None - без ограничения)
+            idle_ttl: Время простоя в секундах, после которого контекст выгружается из памяти
         """
-        self.contexts: Dict[int, List[Dict[str, str]]] = {}
+        self.contexts: "OrderedDict[int, UserContext]" = OrderedDict()
         self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.backend = backend
+        self.max_active_users = max_active_users
+        self.idle_ttl = idle_ttl
+        
+        # Пользователи, чьи контексты изменились с момента последней записи в хранилище
+        self._dirty: set = set()
+        # Вытесненные из памяти, но ещё не записанные контексты: (версия, данные или None для удаления)
+        self._pending: Dict[int, VersionedRecord] = {}
+        # Пачка, которая записывается в хранилище прямо сейчас
+        self._flushing: Dict[int, VersionedRecord] = {}
+        self._flush_lock = asyncio.Lock()
+        # Снимок, сделанный при прошлой остановке: контексты из него восстанавливаются по одному
+        self._snapshot: Optional[ContextSnapshot] = None
+    
+    async def ensure_loaded(self, user_id: int) -> None:
+        """
+        Подгрузить контекст пользователя из хранилища, если его нет в памяти.
+        
+        Для общего хранилища контекст в памяти сверяется с хранилищем по версии:
+        данные передаются, только если запись изменил другой экземпляр бота.
+        Вызывается перед обработкой каждого сообщения пользователя.
+        
+        Args:
+            user_id: ID пользователя Telegram
+        """
+        if self.backend is None:
+            return
+        context = self._get(user_id)
+        if context is not None and not self.backend.shared:
+            return
+        if context is None and (user_id in self._pending or user_id in self._flushing):
+            # Контекст удалён, а удаление ещё не записано в хранилище
+            return
+        
+        result = await self.backend.load(user_id, context.version if context is not None else None)
+        # Запись не изменилась, либо пока шло чтение, контекст изменился в памяти
+        if result is None or self.contexts.get(user_id) is not context:
+            return
+        version, record = result
+        if context is not None:
+            # Запись изменена другим экземпляром бота: её версия важнее копии в памяти
+            del self.contexts[user_id]
+            self._dirty.discard(user_id)
+            logger.info(f"Контекст пользователя {user_id} обновлён из хранилища (версия {version})")
+        if record is not None:
+            self._insert(user_id, UserContext.from_record(record, self.max_messages, version))
+            logger.debug("Контекст пользователя %s загружен из хранилища", user_id)
     
-    def get_context(self, user_id: int) -> List[Dict[str, str]]:
+    def get_context(self, user_id: int) -> ContextView:
         """
         Получить контекст диалога пользователя.
         
         Args:
             user_id: ID пользователя Telegram
-            
+        
         Returns:
-            Список сообщений в контексте пользователя
+            Вид контекста только для чтения (без копирования сообщений)
         """
-        return self.contexts.get(user_id, [])
+        return ContextView(self._get(user_id))
     
-    def add_message(self, user_id: int, role: str, content: str) -> None:
+    def add_message(self, user_id: int, role: str, content: str,
+                    reserve_tokens: int = 0) -> None:
         """
         Добавить сообщение в контекст пользователя.
         
@@ -38,34 +312,128 @@ class ContextManager:
             user_id: ID пользователя Telegram
             role: Роль отправителя ('user' или 'assistant')
             content: Текст сообщения
+            reserve_tokens: Токены, которые нужно оставить свободными в бюджете
+                (например, под системную часть промпта)
         """
-        if user_id not in self.contexts:
-            self.contexts[user_id] = []
+        context = self._get_or_create(user_id)
         
-        self.contexts[user_id].append({"role": role, "content": content})
+        # Размер сообщения в токенах считается один раз и хранится рядом с ним
+        context.append(ContextMessage(role, content, count_message_tokens(content)))
+        self._trim(context, reserve_tokens)
+        self._dirty.add(user_id)
         
-        # Ограничение размера контекста
-        if len(self.contexts[user_id]) > self.max_messages:
-            # Оставляем системное сообщение (если есть) и последние сообщения
-            messages = self.contexts[user_id]
-            # Если первое сообщение - системное, сохраняем его
-            if messages and messages[0].get("role") == "system":
-                self.contexts[user_id] = [messages[0]] + messages[-(self.max_messages - 1):]
-            else:
-                self.contexts[user_id] = messages[-self.max_messages:]
+        logger.debug(
+            "Контекст пользователя %s: %d сообщений, %d токенов", user_id, len(context), context.total_tokens
+        )
+    
+    def fit_to_budget(self, user_id: int, reserve_tokens: int) -> ContextView:
+        """
+        Сократить контекст так, чтобы вместе с зарезервированными токенами он уложился в бюджет.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            reserve_tokens: Токены, которые будут добавлены к контексту в запросе
+                (системная часть промпта и новое сообщение пользователя)
+        
+        Returns:
+            Вид сокращённого контекста для формирования запроса
+        """
+        context = self._get(user_id)
+        if context is not None:
+            length = len(context)
+            self._trim(context, reserve_tokens, keep_last=False)
+            if len(context) != length:
+                self._dirty.add(user_id)
+        return ContextView(context)
+    
+    def _trim(self, context: UserContext, reserve_tokens: int = 0, keep_last: bool = True) -> None:
+        """
+        Удаляет самые старые сообщения, пока контекст не уложится в ограничения.
+        
+        Args:
+            context: Контекст пользователя
+            reserve_tokens: Токены, которые нужно оставить свободными в бюджете
+            keep_last: Не удалять последнее сообщение, даже если оно одно превышает бюджет
+        """
+        token_limit = self.max_tokens - reserve_tokens if self.max_tokens is not None else None
+        min_length = 1 if keep_last else 0
+        # Краткое содержание в начале контекста не удаляется, но занимает место в лимите сообщений
+        message_limit = self.max_messages - (context.summary is not None)
+        
+        while len(context.history) > min_length and (
+            len(context.history) > message_limit
+            or (token_limit is not None and context.total_tokens > token_limit)
+        ):
+            context.pop_oldest()
+    
+    def get_compaction_candidate(self, user_id: int, keep_messages: int
+                                 ) -> Optional[Tuple[UserContext, List[ContextMessage]]]:
+        """
+        Получить начало контекста, которое можно заменить кратким содержанием.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            keep_messages: Количество последних сообщений, которые остаются без сжатия
+        
+        Returns:
+            Кортеж (контекст, сообщения для сжатия вместе с прежним кратким
+            содержанием) или None, если сжимать нечего
+        """
+        context = self.contexts.get(user_id)
+        if context is None:
+            return None
+        head = list(islice(context, 0, max(0, len(context) - keep_messages)))
+        # Сжатие имеет смысл, если в начале есть хотя бы два сообщения диалога
+        if sum(1 for message in head if message is not context.summary) < 2:
+            return None
+        return context, head
+    
+    def apply_summary(self, user_id: int, context: UserContext,
+                      summarized: List[ContextMessage], summary: str) -> bool:
+        """
+        Заменить сжатые сообщения кратким содержанием в виде системного сообщения в начале контекста.
         
-        logger.debug(f"Контекст пользователя {user_id}: {len(self.contexts[user_id])} сообщений")
+        Сообщения, добавленные после начала сжатия, сохраняются. Если контекст
+        за это время очищен или заменён записью из хранилища, ничего не меняется.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            context: Контекст, из которого взяты сообщения (get_compaction_candidate)
+            summarized: Сжатые сообщения
+            summary: Текст системного сообщения с кратким содержанием
+        
+        Returns:
+            True, если краткое содержание добавлено в контекст
+        """
+        if self.contexts.get(user_id) is not context:
+            return False
+        # Сжатые сообщения, которые ещё не вытеснены из контекста, по-прежнему идут в его начале
+        summarized_ids = {id(message) for message in summarized}
+        while context.history and id(context.history[0]) in summarized_ids:
+            context.pop_oldest()
+        
+        context.set_summary(ContextMessage("system", summary, count_message_tokens(summary)))
+        self._trim(context)
+        self._dirty.add(user_id)
+        return True
     
     def clear_context(self, user_id: int) -> None:
         """
-        Очистить контекст пользователя.
+        Очистить контекст пользователя (вместе с выбранным промптом).
         
         Args:
             user_id: ID пользователя Telegram
         """
-        if user_id in self.contexts:
-            del self.contexts[user_id]
+        context = self.contexts.pop(user_id, None)
+        if context is not None:
             logger.info(f"Контекст пользователя {user_id} очищен")
+        self._dirty.discard(user_id)
+        if self.backend is None:
+            return
+        if context is not None:
+            self._pending[user_id] = (context.version, None)
+        elif user_id in self._pending:
+            self._pending[user_id] = (self._pending[user_id][0], None)
     
     def get_context_length(self, user_id: int) -> int:
         """
@@ -73,8 +441,344 @@ class ContextManager:
         
         Args:
             user_id: ID пользователя Telegram
-            
+        
         Returns:
             Количество сообщений в контексте
         """
-        return len(self.contexts.get(user_id, []))
+        context = self._get(user_id)
+        return len(context) if context is not None else 0
+    
+    def get_context_tokens(self, user_id: int) -> int:
+        """
+        Получить размер контекста пользователя в токенах.
+        
+        Args:
+            user_id: ID пользователя Telegram
+        
+        Returns:
+            Количество токенов в контексте
+        """
+        context = self._get(user_id)
+        return context.total_tokens if context is not None else 0
+    
+    def get_selected_prompt_id(self, user_id: int) -> Optional[int]:
+        """
+        Получить ID промпта, выбранного пользователем.
+        
+        Args:
+            user_id: ID пользователя Telegram
+        
+        Returns:
+            ID промпта или None, если промпт не выбран
+        """
+        context = self._get(user_id)
+        return context.prompt_id if context is not None else None
+    
+    def set_selected_prompt_id(self, user_id: int, prompt_id: Optional[int]) -> None:
+        """
+        Запомнить выбранный пользователем промпт.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            prompt_id: ID промпта (None - сбросить выбор)
+        """
+        if prompt_id is None and user_id not in self.contexts:
+            return
+        context = self._get_or_create(user_id)
+        context.prompt_id = prompt_id
+        self._dirty.add(user_id)
+    
+    def get_dialog_tier(self, user_id: int) -> Optional[str]:
+        """
+        Получить уровень модели текущего диалога.
+        
+        Args:
+            user_id: ID пользователя Telegram
+        
+        Returns:
+            Название уровня или None, если диалога нет или уровень не запомнен
+        """
+        context = self._get(user_id)
+        return context.tier if context is not None and len(context) else None
+    
+    def set_dialog_tier(self, user_id: int, tier: Optional[str]) -> None:
+        """
+        Запомнить уровень модели диалога (сбрасывается вместе с контекстом).
+        
+        Args:
+            user_id: ID пользователя Telegram
+            tier: Название уровня
+        """
+        context = self._get_or_create(user_id)
+        if context.tier != tier:
+            context.tier = tier
+            self._dirty.add(user_id)
+    
+    def get_fsm_value(self, user_id: int, key: str, field: str) -> Any:
+        """
+        Получить поле состояния FSM пользователя.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            key: Ключ FSM (чат, тема и назначение)
+            field: "state" или "data"
+        
+        Returns:
+            Значение поля или None, если оно не задано
+        """
+        context = self._get(user_id)
+        return context.fsm.get(key, {}).get(field) if context is not None else None
+    
+    def set_fsm_value(self, user_id: int, key: str, field: str, value: Any) -> None:
+        """
+        Запомнить поле состояния FSM пользователя.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            key: Ключ FSM (чат, тема и назначение)
+            field: "state" или "data"
+            value: Новое значение (пустое значение удаляет поле)
+        """
+        context = self._get(user_id)
+        if context is None:
+            if not value:
+                return
+            context = self._get_or_create(user_id)
+        entry = context.fsm.get(key, {})
+        if entry.get(field) == value or (not value and field not in entry):
+            return
+        if value:
+            entry[field] = value
+        else:
+            del entry[field]
+        if entry:
+            context.fsm[key] = entry
+        else:
+            context.fsm.pop(key, None)
+        self._dirty.add(user_id)
+    
+    def evict_idle(self) -> int:
+        """
+        Выгрузить из памяти контексты, к которым давно не обращались.
+        
+        Returns:
+            Количество выгруженных контекстов
+        """
+        if self.idle_ttl is None:
+            return 0
+        deadline = time.monotonic() - self.idle_ttl
+        evicted = 0
+        # Контексты упорядочены по времени последнего обращения: самые старые в начале
+        while self.contexts:
+            user_id, context = next(iter(self.contexts.items()))
+            if context.last_access > deadline:
+                break
+            self._evict(user_id)
+            evicted += 1
+        if evicted:
+            logger.info(f"Выгружено неактивных контекстов: {evicted}")
+        return evicted
+    
+    async def flush(self) -> None:
+        """Записать все несохранённые изменения в хранилище одной пачкой."""
+        if self.backend is None:
+            return
+        async with self._flush_lock:
+            batch = self._pending
+            self._pending = {}
+            for user_id in self._dirty:
+                context = self.contexts.get(user_id)
+                if context is not None:
+                    batch[user_id] = (context.version, context.to_record())
+            self._dirty = set()
+            if not batch:
+                return
+            self._flushing = batch
+            try:
+                results = await self.backend.save_many(batch)
+                self._apply_versions(batch, results)
+                logger.debug(f"Сохранено контекстов: {len(batch)}")
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении контекстов: {e}", exc_info=True)
+                # Возвращаем неудачную пачку, не затирая более свежие изменения
+                for user_id, change in batch.items():
+                    if user_id in self.contexts:
+                        self._dirty.add(user_id)
+                    else:
+                        self._pending.setdefault(user_id, change)
+            finally:
+                self._flushing = {}
+    
+    async def run_maintenance(self, interval: float) -> None:
+        """
+        Фоновая задача: выгрузка неактивных контекстов и периодическая запись в хранилище.
+        
+        Args:
+            interval: Интервал между проходами в секундах
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.evict_idle()
+            await self.flush()
+    
+    def load_snapshot(self, path: str) -> int:
+        """
+        Подключить снимок контекстов, сделанный при прошлой остановке.
+        
+        Файл отображается в память, а контекст пользователя раскодируется при
+        его первом сообщении, поэтому время запуска не зависит от количества
+        диалогов в снимке.
+        
+        Args:
+            path: Путь к файлу снимка
+        
+        Returns:
+            Количество записей в снимке (0, если снимка нет)
+        """
+        self._snapshot = ContextSnapshot.open(path)
+        if self._snapshot is None:
+            return 0
+        logger.info(f"Подключён снимок контекстов {path}: {len(self._snapshot)} записей")
+        return len(self._snapshot)
+    
+    async def save_snapshot(self, path: str) -> int:
+        """
+        Записать снимок контекстов при остановке бота.
+        
+        В снимок попадают контексты в памяти (вместе с выбранным промптом и
+        состоянием FSM), вытесненные, но не сохранённые изменения, записи
+        хранилища в памяти процесса и не восстановленные записи прежнего снимка.
+        Изменения, которые не удалось записать в хранилище, помечаются и
+        будут записаны после перезапуска.
+        
+        Args:
+            path: Путь к файлу снимка
+        
+        Returns:
+            Количество записей в снимке
+        """
+        await self.flush()
+        entries = [
+            (user_id, context.version, FLAG_DIRTY if user_id in self._dirty else 0, context.to_record())
+            for user_id, context in self.contexts.items()
+        ]
+        entries.extend(
+            (user_id, version, FLAG_DIRTY, record)
+            for user_id, (version, record) in self._pending.items() if record is not None
+        )
+        if self.backend is not None:
+            entries.extend(
+                (user_id, version, 0, record) for user_id, (version, record) in self.backend.export_records()
+            )
+        previous, self._snapshot = self._snapshot, None
+        # Невосстановленные записи прежнего снимка переносятся, только если их нет в хранилище
+        persistent = self.backend is not None and self.backend.persistent
+        
+        def write() -> int:
+            encoded = ((user_id, version, flags, encode_record(record)) for user_id, version, flags, record in entries)
+            carried = (
+                entry for entry in (previous.remaining() if previous is not None else ())
+                if entry[2] & FLAG_DIRTY or not persistent
+            )
+            try:
+                return write_snapshot(path, chain(encoded, carried))
+            finally:
+                if previous is not None:
+                    previous.close()
+        
+        try:
+            count = await asyncio.to_thread(write)
+        except Exception as e:
+            logger.error(f"Ошибка при записи снимка контекстов {path}: {e}", exc_info=True)
+            return 0
+        logger.info(f"Снимок контекстов записан в {path}: {count} записей")
+        return count
+    
+    async def close(self) -> None:
+        """Записать оставшиеся изменения и закрыть хранилище."""
+        if self.backend is None:
+            return
+        await self.flush()
+        await self.backend.close()
+    
+    def _apply_versions(self, batch: Dict[int, VersionedRecord], results: Dict[int, Optional[int]]) -> None:
+        """Переносит новые версии сохранённых записей на контексты в памяти и обрабатывает конфликты."""
+        for user_id, new_version in results.items():
+            expected = batch[user_id][0]
+            context = self.contexts.get(user_id)
+            # Контекст в памяти, полученный от той же версии, теперь продолжает сохранённую
+            derived = context is not None and context.version == expected
+            if new_version is not None:
+                if derived:
+                    context.version = new_version
+                continue
+            logger.warning(
+                f"Контекст пользователя {user_id} изменён другим экземпляром бота, "
+                f"локальные изменения отброшены"
+            )
+            if derived:
+                # Следующее сообщение загрузит актуальную запись из хранилища
+                del self.contexts[user_id]
+                self._dirty.discard(user_id)
+    
+    def _get(self, user_id: int) -> Optional[UserContext]:
+        """Возвращает контекст из памяти, отмечая обращение к нему."""
+        context = self.contexts.get(user_id)
+        if context is not None:
+            self._touch(user_id)
+            return context
+        
+        # Вытесненный, но ещё не записанный контекст свежее, чем запись в хранилище
+        unsaved = self._pending if user_id in self._pending else self._flushing
+        change = unsaved.get(user_id)
+        if change is not None and change[1] is not None:
+            context = UserContext.from_record(change[1], self.max_messages, change[0])
+            self._insert(user_id, context)
+            self._dirty.add(user_id)
+        elif change is None and self._snapshot is not None:
+            context = self._restore(user_id)
+        return context
+    
+    def _restore(self, user_id: int) -> Optional[UserContext]:
+        """Восстанавливает контекст пользователя из снимка, сделанного при прошлой остановке."""
+        restored = self._snapshot.take(user_id)
+        if restored is None:
+            return None
+        version, flags, record = restored
+        persistent = self.backend is not None and self.backend.persistent
+        # Для хранилища в памяти снимок - единственная копия записи: она записывается заново
+        context = UserContext.from_record(record, self.max_messages, version if persistent else 0)
+        self._insert(user_id, context)
+        if self.backend is not None and (flags & FLAG_DIRTY or not persistent):
+            self._dirty.add(user_id)
+        return context
+    
+    def _get_or_create(self, user_id: int) -> UserContext:
+        """Возвращает контекст из памяти, создавая пустой при отсутствии."""
+        context = self._get(user_id)
+        if context is None:
+            # Новый контекст заменяет запись, удаление которой ещё не сохранено
+            change = self._pending.get(user_id) or self._flushing.get(user_id)
+            context = UserContext(self.max_messages, change[0] if change else 0)
+            self._insert(user_id, context)
+        return context
+    
+    def _touch(self, user_id: int) -> None:
+        """Отмечает обращение к контексту (перемещает его в конец LRU)."""
+        self.contexts[user_id].last_access = time.monotonic()
+        self.contexts.move_to_end(user_id)
+    
+    def _insert(self, user_id: int, context: UserContext) -> None:
+        """Добавляет контекст в память, вытесняя самые давние при превышении лимита."""
+        self._pending.pop(user_id, None)
+        self.contexts[user_id] = context
+        if self.max_active_users is not None:
+            while len(self.contexts) > self.max_active_users:
+                self._evict(next(iter(self.contexts)))
+    
+    def _evict(self, user_id: int) -> None:
+        """Выгружает контекст из памяти, сохраняя несохранённые изменения до записи."""
+        context = self.contexts.pop(user_id)
+        if self.backend is not None and user_id in self._dirty:
+            self._dirty.discard(user_id)
+            self._pending[user_id] = (context.version, context.to_record())
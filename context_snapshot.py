@@ -0,0 +1,234 @@
+"""Снимок контекстов пользователей для быстрого перезапуска: компактный двоичный файл с отображением в память."""
+import json
+import logging
+import mmap
+import os
+import struct
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Заголовок файла: сигнатура, версия формата, количество записей
+_HEADER = struct.Struct("<4sHI")
+_MAGIC = b"VPFS"
+_FORMAT_VERSION = 1
+# Строка индекса: ID пользователя, версия записи, смещение и длина данных, флаги
+_INDEX_ENTRY = struct.Struct("<qqQIB")
+# Флаг: изменения записи не были сохранены в хранилище до остановки
+FLAG_DIRTY = 1
+
+# Начало записи: ID промпта (-1 - не выбран), количество сообщений, длина состояния FSM
+_RECORD_HEAD = struct.Struct("<qII")
+# Начало сообщения: роль, размер в токенах, длина текста в байтах
+_MESSAGE_HEAD = struct.Struct("<BII")
+_ROLES = ("system", "user", "assistant")
+_ROLE_CODES = {role: code for code, role in enumerate(_ROLES)}
+
+# Запись снимка: (ID пользователя, версия, флаги, закодированные данные)
+SnapshotEntry = Tuple[int, int, int, bytes]
+
+
+def encode_record(record: Dict) -> bytes:
+    """
+    Закодировать запись пользователя (UserContext.to_record) в двоичный вид.
+    
+    Уровень модели диалога не сохраняется: после перезапуска он
+    определяется заново по следующему сообщению.
+    
+    Args:
+        record: Данные пользователя: сообщения, их размеры, промпт и состояние FSM
+    
+    Returns:
+        Закодированная запись
+    """
+    messages = record.get("messages", [])
+    fsm = json.dumps(record["fsm"], ensure_ascii=False).encode("utf-8") if record.get("fsm") else b""
+    prompt_id = record.get("prompt_id")
+    parts = [_RECORD_HEAD.pack(-1 if prompt_id is None else prompt_id, len(messages), len(fsm)), fsm]
+    for message, tokens in zip(messages, record.get("tokens", [])):
+        content = message["content"].encode("utf-8")
+        parts.append(_MESSAGE_HEAD.pack(_ROLE_CODES[message["role"]], tokens, len(content)))
+        parts.append(content)
+    return b"".join(parts)
+
+
+def decode_record(data, offset: int = 0) -> Dict:
+    """
+    Раскодировать запись пользователя.
+    
+    Args:
+        data: Буфер с записью (bytes или mmap)
+        offset: Смещение записи в буфере
+    
+    Returns:
+        Данные в формате UserContext.to_record
+    """
+    prompt_id, count, fsm_length = _RECORD_HEAD.unpack_from(data, offset)
+    offset += _RECORD_HEAD.size
+    record = {"messages": [], "tokens": [], "prompt_id": None if prompt_id == -1 else prompt_id}
+    if fsm_length:
+        record["fsm"] = json.loads(bytes(data[offset:offset + fsm_length]).decode("utf-8"))
+        offset += fsm_length
+    for _ in range(count):
+        role, tokens, length = _MESSAGE_HEAD.unpack_from(data, offset)
+        offset += _MESSAGE_HEAD.size
+        record["messages"].append({
+            "role": _ROLES[role],
+            "content": bytes(data[offset:offset + length]).decode("utf-8"),
+        })
+        record["tokens"].append(tokens)
+        offset += length
+    return record
+
+
+def write_snapshot(path: str, entries: Iterable[SnapshotEntry]) -> int:
+    """
+    Записать снимок: заголовок, индекс, отсортированный по ID пользователя, и данные.
+    
+    Файл записывается во временный и переименовывается, поэтому прерванная
+    запись не портит прежний снимок. Для повторяющихся ID сохраняется первая запись.
+    
+    Args:
+        path: Путь к файлу снимка
+        entries: Записи (ID пользователя, версия, флаги, закодированные данные)
+    
+    Returns:
+        Количество записей в снимке
+    """
+    unique: Dict[int, SnapshotEntry] = {}
+    for entry in entries:
+        unique.setdefault(entry[0], entry)
+    ordered = [unique[user_id] for user_id in sorted(unique)]
+    
+    offset = _HEADER.size + _INDEX_ENTRY.size * len(ordered)
+    index = []
+    for user_id, version, flags, data in ordered:
+        index.append(_INDEX_ENTRY.pack(user_id, version, offset, len(data), flags))
+        offset += len(data)
+    
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION, len(ordered)))
+        f.write(b"".join(index))
+        for entry in ordered:
+            f.write(entry[3])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return len(ordered)
+
+
+class ContextSnapshot:
+    """Снимок, открытый для чтения: записи раскодируются по одной при первом обращении.
+    
+    Файл отображается в память, поиск пользователя - двоичный поиск по
+    индексу, поэтому открытие не зависит от количества записей. После
+    открытия файл удаляется с диска: если процесс завершится аварийно,
+    следующий запуск не восстановит устаревшие данные. Каждая запись
+    выдаётся один раз - дальше контекст живёт в менеджере контекста.
+    """
+    
+    def __init__(self, path: str):
+        """
+        Открыть снимок.
+        
+        Args:
+            path: Путь к файлу снимка
+        
+        Raises:
+            ValueError: Файл не является снимком или повреждён
+        """
+        self._file = open(path, "rb")
+        self._data = None
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, self._count = _HEADER.unpack_from(self._data, 0)
+            if magic != _MAGIC or version != _FORMAT_VERSION:
+                raise ValueError(f"неизвестный формат снимка {magic!r} (версия {version})")
+            if len(self._data) < _HEADER.size + _INDEX_ENTRY.size * self._count:
+                raise ValueError("снимок обрезан")
+        except Exception:
+            self.close()
+            raise
+        self._taken: Set[int] = set()
+        try:
+            os.remove(path)
+        except PermissionError:
+            # Windows не удаляет файл, отображённый в память: читаем его целиком
+            data = self._data[:]
+            self.close()
+            self._data = data
+            os.remove(path)
+    
+    @classmethod
+    def open(cls, path: str) -> Optional["ContextSnapshot"]:
+        """
+        Открыть снимок, если он есть.
+        
+        Args:
+            path: Путь к файлу снимка
+        
+        Returns:
+            Снимок или None, если файла нет или он не читается
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            return cls(path)
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"Снимок контекстов {path} не загружен: {e}")
+            return None
+    
+    def __len__(self) -> int:
+        """Количество ещё не выданных записей."""
+        return self._count - len(self._taken)
+    
+    def take(self, user_id: int) -> Optional[Tuple[int, int, Dict]]:
+        """
+        Выдать запись пользователя, если она есть и ещё не выдана.
+        
+        Args:
+            user_id: ID пользователя Telegram
+        
+        Returns:
+            Кортеж (версия, флаги, данные) или None
+        """
+        if user_id in self._taken:
+            return None
+        position = self._find(user_id)
+        if position is None:
+            return None
+        self._taken.add(user_id)
+        _, version, offset, _, flags = self._entry(position)
+        return version, flags, decode_record(self._data, offset)
+    
+    def remaining(self) -> Iterator[SnapshotEntry]:
+        """Невыданные записи в закодированном виде (для переноса в следующий снимок)."""
+        for position in range(self._count):
+            user_id, version, offset, length, flags = self._entry(position)
+            if user_id not in self._taken:
+                yield user_id, version, flags, bytes(self._data[offset:offset + length])
+    
+    def close(self) -> None:
+        """Закрыть отображение и файл."""
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+    
+    def _entry(self, position: int) -> Tuple[int, int, int, int, int]:
+        """Читает строку индекса."""
+        return _INDEX_ENTRY.unpack_from(self._data, _HEADER.size + _INDEX_ENTRY.size * position)
+    
+    def _find(self, user_id: int) -> Optional[int]:
+        """Двоичный поиск строки индекса пользователя."""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            current = self._entry(middle)[0]
+            if current < user_id:
+                low = middle + 1
+            elif current > user_id:
+                high = middle
+            else:
+                return middle
+        return None
@@ -0,0 +1,110 @@
+"""Постоянное хранилище контекстов диалогов в SQLite."""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteConversationStore:
+    """Хранилище контекстов пользователей в локальном файле SQLite (режим WAL)."""
+    
+    def __init__(self, db_path: str = "contexts.db"):
+        """
+        Инициализация хранилища.
+        
+        Args:
+            db_path: Путь к файлу базы данных SQLite
+        """
+        self.db_path = db_path
+        # Соединение используется из пула потоков asyncio, доступ сериализуется блокировкой
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS contexts ("
+            "user_id INTEGER PRIMARY KEY, "
+            "data TEXT NOT NULL, "
+            "updated_at REAL NOT NULL, "
+            "version INTEGER NOT NULL DEFAULT 1)"
+        )
+        # Базы, созданные до появления версий записей
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(contexts)")}
+        if "version" not in columns:
+            self._conn.execute("ALTER TABLE contexts ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+        logger.info(f"Хранилище контекстов открыто: {db_path}")
+    
+    def load(self, user_id: int) -> Optional[Tuple[int, Dict]]:
+        """
+        Загрузить сохранённый контекст пользователя.
+        
+        Args:
+            user_id: ID пользователя Telegram
+        
+        Returns:
+            Кортеж (версия, данные контекста) или None, если контекст не сохранялся
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version, data FROM contexts WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+    
+    def save_many(self, changes: Dict[int, Tuple[int, Optional[Dict]]]) -> Dict[int, Optional[int]]:
+        """
+        Сохранить пачку контекстов одной транзакцией.
+        
+        Каждая запись сохраняется, только если её версия в базе совпадает
+        с ожидаемой (0 - записи ещё нет).
+        
+        Args:
+            changes: Словарь user_id -> (ожидаемая версия, данные контекста или None для удаления)
+        
+        Returns:
+            Словарь user_id -> новая версия (0 после удаления) или None при несовпадении версии
+        """
+        now = time.time()
+        results: Dict[int, Optional[int]] = {}
+        
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for user_id, (expected, data) in changes.items():
+                    if data is None:
+                        cursor = self._conn.execute(
+                            "DELETE FROM contexts WHERE user_id = ? AND version = ?", (user_id, expected)
+                        )
+                        saved = cursor.rowcount == 1 or self._conn.execute(
+                            "SELECT 1 FROM contexts WHERE user_id = ?", (user_id,)
+                        ).fetchone() is None
+                        results[user_id] = 0 if saved else None
+                        continue
+                    
+                    payload = json.dumps(data, ensure_ascii=False)
+                    if expected == 0:
+                        cursor = self._conn.execute(
+                            "INSERT OR IGNORE INTO contexts (user_id, data, updated_at, version) "
+                            "VALUES (?, ?, ?, 1)",
+                            (user_id, payload, now)
+                        )
+                    else:
+                        cursor = self._conn.execute(
+                            "UPDATE contexts SET data = ?, updated_at = ?, version = version + 1 "
+                            "WHERE user_id = ? AND version = ?",
+                            (payload, now, user_id, expected)
+                        )
+                    results[user_id] = expected + 1 if cursor.rowcount == 1 else None
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return results
+    
+    def close(self) -> None:
+        """Закрыть соединение с базой данных."""
+        with self._lock:
+            self._conn.close()
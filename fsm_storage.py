@@ -0,0 +1,77 @@
+"""Хранение состояния FSM aiogram в записи пользователя менеджера контекста."""
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, StateType, StorageKey
+
+from context_manager import ContextManager
+
+
+def _fsm_key(key: StorageKey) -> str:
+    """Ключ состояния FSM внутри записи пользователя (чат, тема, бизнес-подключение и назначение)."""
+    return f"{key.chat_id}:{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
+
+
+class ContextFSMStorage(BaseStorage):
+    """Хранилище FSM, записывающее состояние в запись пользователя вместе с контекстом диалога.
+    
+    Состояние загружается и сохраняется вместе с контекстом и не требует
+    отдельных обращений к хранилищу. Данные FSM должны сериализоваться в JSON.
+    """
+    
+    def __init__(self, context_manager: ContextManager):
+        """
+        Инициализация хранилища.
+        
+        Args:
+            context_manager: Менеджер контекста, в записях которого хранится состояние
+        """
+        self.context_manager = context_manager
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        """Установить состояние FSM."""
+        value = state.state if isinstance(state, State) else state
+        self.context_manager.set_fsm_value(key.user_id, _fsm_key(key), "state", value)
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        """Получить состояние FSM."""
+        return self.context_manager.get_fsm_value(key.user_id, _fsm_key(key), "state")
+    
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        """Установить данные FSM."""
+        self.context_manager.set_fsm_value(key.user_id, _fsm_key(key), "data", dict(data))
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        """Получить копию данных FSM."""
+        return dict(self.context_manager.get_fsm_value(key.user_id, _fsm_key(key), "data") or {})
+    
+    async def close(self) -> None:
+        """Закрытие не требуется: хранилищем управляет менеджер контекста."""
+
+
+class UserStateLoader(BaseEventIsolation):
+    """Подгружает запись пользователя из хранилища перед обработкой каждого события.
+    
+    aiogram входит в lock() один раз на событие, до чтения состояния FSM,
+    поэтому здесь выполняется единственное обращение к хранилищу за сообщение:
+    контекст, выбранный промпт и состояние FSM приходят одной записью.
+    """
+    
+    def __init__(self, context_manager: ContextManager):
+        """
+        Инициализация загрузчика.
+        
+        Args:
+            context_manager: Менеджер контекста
+        """
+        self.context_manager = context_manager
+    
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        """Подгрузить запись пользователя на время обработки события."""
+        await self.context_manager.ensure_loaded(key.user_id)
+        yield
+    
+    async def close(self) -> None:
+        """Закрытие не требуется."""
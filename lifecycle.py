@@ -0,0 +1,107 @@
+"""Плавная остановка: учёт обрабатываемых обновлений и остановка по сигналам SIGTERM/SIGINT."""
+import asyncio
+import contextlib
+import logging
+import signal
+import time
+from typing import Awaitable, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+
+class InflightTracker:
+    """Счётчик обновлений, обработка которых ещё не закончилась.
+    
+    При остановке бота новые обновления больше не принимаются, а уже
+    принятые получают время закончить работу: ответ модели доходит до
+    пользователя, контекст успевает сохраниться.
+    """
+    
+    def __init__(self):
+        """Инициализация пустого счётчика."""
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+    
+    @property
+    def pending(self) -> int:
+        """Количество обновлений в обработке."""
+        return self._pending
+    
+    @contextlib.contextmanager
+    def track(self) -> Iterator[None]:
+        """Учитывать обновление как обрабатываемое до выхода из блока."""
+        self._pending += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._pending -= 1
+            if not self._pending:
+                self._idle.set()
+    
+    async def wait(self, timeout: float) -> int:
+        """
+        Дождаться окончания обработки всех обновлений.
+        
+        Args:
+            timeout: Максимальное время ожидания (сек)
+        
+        Returns:
+            Количество обновлений, не обработанных за отведённое время
+        """
+        # Обновления, принятые перед остановкой, начинают обработку на следующем шаге цикла событий
+        await asyncio.sleep(0)
+        if not self._pending:
+            return 0
+        logger.info(f"Ожидание обработки обновлений: {self._pending} (не дольше {timeout:.0f} сек)")
+        started = time.monotonic()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        if self._pending:
+            logger.warning(f"Не дождались обработки обновлений: {self._pending}")
+        else:
+            logger.info(f"Обработка обновлений завершена за {time.monotonic() - started:.1f} сек")
+        return self._pending
+
+
+async def run_until_terminated(awaitable: Awaitable) -> bool:
+    """
+    Выполнять задачу до её завершения или до сигнала SIGTERM/SIGINT.
+    
+    По сигналу задача отменяется (например, сервер webhook перестаёт
+    принимать обновления), и управление возвращается вызывающему коду
+    для плавной остановки. Там, где обработчики сигналов недоступны
+    (Windows), задача выполняется как обычно.
+    
+    Args:
+        awaitable: Задача, которая работает до отмены
+    
+    Returns:
+        True, если задача остановлена сигналом
+    """
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(awaitable)
+    received: List[signal.Signals] = []
+    
+    def on_signal(sig: signal.Signals) -> None:
+        logger.warning(f"Получен сигнал {sig.name}: приём обновлений остановлен")
+        received.append(sig)
+        task.cancel()
+    
+    installed = []
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, on_signal, sig)
+            installed.append(sig)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not received:
+            raise
+    finally:
+        for sig in installed:
+            loop.remove_signal_handler(sig)
+    return bool(received)
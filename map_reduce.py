@@ -0,0 +1,236 @@
+"""Обработка слишком длинных текстов в режиме промпта по частям (map-reduce)."""
+import asyncio
+import logging
+import re
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, TypeVar
+
+from api_client import OpenAIClient
+from prompts_manager import PromptsManager
+from scheduler import RequestScheduler
+from token_counter import count_tokens
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Уровни естественных границ текста: абзацы, строки, предложения, слова
+_BOUNDARIES = (
+    re.compile(r"(?<=\n)[ \t]*\n"),
+    re.compile(r"(?<=\n)"),
+    re.compile(r"(?<=[.!?…])\s+"),
+    re.compile(r"(?<=\s)"),
+)
+
+# Задание для обработки одной части текста (добавляется к тексту части)
+MAP_TEMPLATE = (
+    "Это часть {index} из {total} длинного текста. Обработай только эту часть; "
+    "результаты всех частей затем будут объединены.\n\n{chunk}"
+)
+# Задание для объединения результатов частей
+REDUCE_TEMPLATE = (
+    "Длинный текст был обработан по частям. Ниже результаты обработки каждой части по порядку. "
+    "Объедини их в один цельный ответ на исходное задание в требуемом формате: убери повторы, "
+    "сохрани все существенные сведения и не упоминай деление на части.\n\n{results}"
+)
+
+ProgressCallback = Callable[[int, int], Awaitable[None]]
+
+
+def split_text(text: str, max_tokens: int) -> List[str]:
+    """
+    Разбить текст на части не больше max_tokens токенов по естественным границам.
+    
+    Текст делится по абзацам; абзац, не помещающийся в часть, - по строкам,
+    затем по предложениям и словам, и только слово длиннее части
+    разрезается посимвольно. Соседние фрагменты собираются в части
+    жадно, каждый фрагмент считается один раз.
+    
+    Args:
+        text: Исходный текст
+        max_tokens: Максимальный размер части (токенов)
+    
+    Returns:
+        Список частей текста
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    
+    def flush() -> None:
+        nonlocal current, current_tokens
+        chunk = "".join(current).strip()
+        if chunk:
+            chunks.append(chunk)
+        current, current_tokens = [], 0
+    
+    def add(piece: str, level: int) -> None:
+        nonlocal current_tokens
+        tokens = count_tokens(piece)
+        if tokens > max_tokens:
+            if level < len(_BOUNDARIES):
+                for part in _BOUNDARIES[level].split(piece):
+                    add(part, level + 1)
+            else:
+                # Граница не найдена: режем по символам с оценкой длины токена
+                step = max(1, len(piece) * max_tokens // tokens)
+                for start in range(0, len(piece), step):
+                    add(piece[start:start + step], level)
+            return
+        if current_tokens + tokens > max_tokens:
+            flush()
+        current.append(piece)
+        current_tokens += tokens
+    
+    add(text, 0)
+    flush()
+    return chunks
+
+
+class MapReduceProcessor:
+    """Обрабатывает длинный текст по частям и объединяет результаты.
+    
+    Части обрабатываются с промптом пользователя одновременно, но не более
+    max_concurrency запросов на один текст и не более max_total запросов
+    на все тексты сразу, поэтому время обработки растёт с количеством
+    частей, делённым на max_concurrency, а не с длиной текста. Каждый
+    запрос проходит через очередь планировщика пользователя и занимает
+    в нём слот, поэтому общий предел одновременных запросов к API
+    соблюдается и для длинных текстов. Если
+    результаты частей не помещаются в один запрос на объединение, они
+    объединяются в несколько уровней.
+    """
+    
+    def __init__(self, client: OpenAIClient, prompts_manager: PromptsManager,
+                 chunk_tokens: int = 2000, reduce_tokens: int = 6000,
+                 max_concurrency: int = 4, max_total: int = 16, timeout: Optional[float] = None,
+                 scheduler: Optional[RequestScheduler] = None):
+        """
+        Инициализация обработки по частям.
+        
+        Args:
+            client: Клиент API
+            prompts_manager: Менеджер промптов (формирует запросы к модели)
+            chunk_tokens: Максимальный размер части текста (токенов)
+            reduce_tokens: Максимальный размер результатов в одном запросе на объединение (токенов)
+            max_concurrency: Максимальное количество одновременных запросов для одного текста
+            max_total: Максимальное количество одновременных запросов для всех текстов
+            timeout: Таймаут одного запроса (сек, по умолчанию таймаут клиента)
+            scheduler: Планировщик запросов к API (None - запросы выполняются без очереди)
+        """
+        self.client = client
+        self.prompts_manager = prompts_manager
+        self.chunk_tokens = chunk_tokens
+        self.reduce_tokens = reduce_tokens
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self._total = asyncio.Semaphore(max_total)
+    
+    async def process(self, prompt: Dict, text: str, on_progress: Optional[ProgressCallback] = None,
+                      cache_key: Optional[str] = None, tier: Optional[str] = None,
+                      user_id: Optional[int] = None) -> Optional[str]:
+        """
+        Обработать длинный текст с промптом.
+        
+        Args:
+            prompt: Словарь с данными промпта
+            text: Текст пользователя
+            on_progress: Вызывается с количеством обработанных частей и общим
+                количеством после каждой части (объединение - последний шаг)
+            cache_key: Ключ кэша промптов провайдера
+            tier: Уровень моделей
+            user_id: ID пользователя, которому засчитывается расход токенов
+        
+        Returns:
+            Объединённый ответ или None, если хотя бы одна часть не обработана
+        
+        Raises:
+            SchedulerBusyError: Очередь планировщика переполнена
+            RequestExpiredError: Запрос части не дождался выполнения в очереди
+        """
+        chunks = split_text(text, self.chunk_tokens)
+        total = len(chunks) + 1
+        done = 0
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        logger.info(f"Обработка текста по частям: {len(chunks)} частей, промпт {prompt['id']}")
+        
+        async def call(user_input: str) -> Optional[str]:
+            async with semaphore, self._total:
+                messages = self.prompts_manager.build_messages_with_prompt(prompt, user_input)
+                
+                def request() -> Awaitable[Optional[str]]:
+                    return self.client.get_response(
+                        messages, timeout=self.timeout, prompt_id=prompt['id'], cache_key=cache_key, tier=tier,
+                        user_id=user_id
+                    )
+                
+                if self.scheduler is None:
+                    return await request()
+                # Части одного текста - один принятый запрос: предел очереди пользователя к ним не применяется
+                return await self.scheduler.submit(user_id or 0, request, limit_per_user=False)
+        
+        async def map_chunk(index: int, chunk: str) -> Optional[str]:
+            nonlocal done
+            result = await call(MAP_TEMPLATE.format(index=index + 1, total=len(chunks), chunk=chunk))
+            done += 1
+            if on_progress is not None:
+                await on_progress(done, total)
+            return result
+        
+        results = await _gather_all(map_chunk(index, chunk) for index, chunk in enumerate(chunks))
+        if not all(results):
+            failed = sum(1 for result in results if not result)
+            logger.warning(f"Не удалось обработать {failed} из {len(chunks)} частей текста")
+            return None
+        
+        # Результаты объединяются группами, пока не останется один ответ
+        while len(results) > 1:
+            groups = self._group(results)
+            results = await _gather_all(
+                call(REDUCE_TEMPLATE.format(results=self._format_results(group))) for group in groups
+            )
+            if not all(results):
+                logger.warning("Не удалось объединить результаты обработки частей текста")
+                return None
+        if on_progress is not None:
+            await on_progress(total, total)
+        
+        logger.info(
+            f"Текст обработан по частям за {time.monotonic() - started:.1f} сек: "
+            f"{len(chunks)} частей, промпт {prompt['id']}"
+        )
+        return results[0]
+    
+    def _group(self, results: List[str]) -> List[List[str]]:
+        """Делит результаты на группы, каждая из которых помещается в один запрос на объединение."""
+        groups: List[List[str]] = [[]]
+        group_tokens = 0
+        for result in results:
+            tokens = count_tokens(result)
+            if groups[-1] and group_tokens + tokens > self.reduce_tokens:
+                groups.append([])
+                group_tokens = 0
+            groups[-1].append(result)
+            group_tokens += tokens
+        if len(groups) == len(results) and len(results) > 1:
+            # Каждый результат сам по себе не меньше бюджета - объединяем попарно, иначе цикл не сойдётся
+            groups = [results[start:start + 2] for start in range(0, len(results), 2)]
+        return groups
+    
+    @staticmethod
+    def _format_results(results: List[str]) -> str:
+        """Текст результатов частей для запроса на объединение."""
+        return "\n\n".join(f"### Часть {index}\n{result}" for index, result in enumerate(results, 1))
+
+
+async def _gather_all(coroutines: Iterable[Awaitable[T]]) -> List[T]:
+    """Выполняет корутины одновременно; при первой ошибке отменяет остальные (в отличие от asyncio.gather)."""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
@@ -0,0 +1,338 @@
+"""Метрики бота в формате Prometheus и HTTP-сервер для их сбора."""
+import logging
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Тип содержимого ответа с метриками
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Границы корзин гистограмм задержек (сек)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+# Границы корзин задержек отправки в Telegram (сек)
+SEND_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 15.0, 60.0)
+# Границы корзин задержки цикла событий (сек)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Границы корзин размера контекста (сообщений и токенов)
+CONTEXT_MESSAGES_BUCKETS = (1, 2, 4, 8, 12, 16, 20, 30, 50)
+CONTEXT_TOKENS_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 6000, 8000, 16000, 32000)
+
+
+class _Value:
+    """Значение метрики с одним набором меток: число или функция, вызываемая при сборе."""
+    
+    __slots__ = ("value", "function")
+    
+    def __init__(self):
+        """Инициализация нулевого значения."""
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+    
+    def inc(self, amount: float = 1.0) -> None:
+        """Увеличить значение."""
+        self.value += amount
+    
+    def dec(self, amount: float = 1.0) -> None:
+        """Уменьшить значение."""
+        self.value -= amount
+    
+    def set(self, value: float) -> None:
+        """Установить значение."""
+        self.value = value
+    
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Получать значение при сборе метрик из функции (например, из счётчиков объекта)."""
+        self.function = function
+    
+    def get(self) -> float:
+        """Текущее значение."""
+        return self.function() if self.function is not None else self.value
+
+
+class _HistogramValue:
+    """Гистограмма с одним набором меток."""
+    
+    __slots__ = ("bounds", "counts", "sum", "count")
+    
+    def __init__(self, bounds: Tuple[float, ...]):
+        """Инициализация пустой гистограммы с заданными границами корзин."""
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Последняя корзина - значения больше всех границ
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float) -> None:
+        """Добавить наблюдение."""
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Metric:
+    """Метрика с набором меток. Значения для каждого набора меток создаются при первом обращении."""
+    
+    kind = "untyped"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """
+        Инициализация метрики.
+        
+        Args:
+            name: Имя метрики
+            documentation: Описание метрики
+            labelnames: Имена меток
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, object] = {}
+    
+    def labels(self, *values):
+        """
+        Значение метрики для набора меток.
+        
+        Значения меток могут быть любыми хэшируемыми объектами: в строки
+        они преобразуются только при сборе метрик.
+        """
+        child = self._values.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}")
+            child = self._values[values] = self._new_value()
+        return child
+    
+    def _new_value(self):
+        """Создаёт значение для нового набора меток."""
+        return _Value()
+    
+    def samples(self) -> Iterable[Tuple[str, tuple, float]]:
+        """Строки метрики: (суффикс имени, пары меток, значение)."""
+        for values, child in list(self._values.items()):
+            yield "", tuple(zip(self.labelnames, values)), child.get()
+
+
+class Counter(_Metric):
+    """Счётчик: только возрастающее значение."""
+    
+    kind = "counter"
+    
+    def inc(self, amount: float = 1.0) -> None:
+        """Увеличить счётчик без меток."""
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    """Текущее значение, которое может расти и уменьшаться."""
+    
+    kind = "gauge"
+    
+    def set(self, value: float) -> None:
+        """Установить значение без меток."""
+        self.labels().set(value)
+    
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Получать значение без меток из функции при сборе метрик."""
+        self.labels().set_function(function)
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам."""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        """
+        Инициализация гистограммы.
+        
+        Args:
+            name: Имя метрики
+            documentation: Описание метрики
+            labelnames: Имена меток
+            buckets: Верхние границы корзин по возрастанию
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, value: float) -> None:
+        """Добавить наблюдение без меток."""
+        self.labels().observe(value)
+    
+    def _new_value(self) -> _HistogramValue:
+        """Создаёт пустую гистограмму для нового набора меток."""
+        return _HistogramValue(self.buckets)
+    
+    def samples(self) -> Iterable[Tuple[str, tuple, float]]:
+        """Строки гистограммы: накопленные корзины, сумма и количество."""
+        for values, child in list(self._values.items()):
+            labels = tuple(zip(self.labelnames, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                yield "_bucket", labels + (("le", bound),), cumulative
+            yield "_sum", labels, child.sum
+            yield "_count", labels, child.count
+
+
+class Registry:
+    """Набор метрик, отдаваемых одним ответом."""
+    
+    def __init__(self):
+        """Инициализация пустого набора."""
+        self._metrics: Dict[str, _Metric] = {}
+    
+    def register(self, metric: _Metric) -> _Metric:
+        """Добавить метрику в набор."""
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def render(self) -> str:
+        """
+        Сформировать текст всех метрик в формате Prometheus.
+        
+        Returns:
+            Текст в формате exposition 0.0.4
+        """
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                if labels:
+                    rendered = ",".join(f'{name}="{_escape_label(label)}"' for name, label in labels)
+                    lines.append(f"{metric.name}{suffix}{{{rendered}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{metric.name}{suffix} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_help(text: str) -> str:
+    """Экранирует описание метрики."""
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_label(value: object) -> str:
+    """Преобразует значение метки в строку и экранирует её."""
+    if value is None:
+        return "none"
+    if isinstance(value, float):
+        return _format_value(value)
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    """Форматирует числовое значение метрики."""
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+# Набор метрик бота
+REGISTRY = Registry()
+
+API_LATENCY = REGISTRY.register(Histogram(
+    "bot_api_request_seconds", "Время запроса к API модели до получения полного ответа", ["model"]
+))
+API_TIME_TO_FIRST_TOKEN = REGISTRY.register(Histogram(
+    "bot_api_time_to_first_token_seconds", "Время до первого фрагмента потокового ответа модели", ["model"]
+))
+API_ERRORS = REGISTRY.register(Counter(
+    "bot_api_errors_total", "Неудачные попытки запроса к API модели", ["model"]
+))
+TIER_LATENCY = REGISTRY.register(Histogram(
+    "bot_api_tier_request_seconds", "Время запроса к API модели по уровню моделей (tier: fast, reasoning, ...)",
+    ["tier"]
+))
+API_COST = REGISTRY.register(Counter(
+    "bot_api_cost_dollars_total", "Стоимость запросов к API по ценам MODEL_PRICES (доллары)", ["tier", "model"]
+))
+TOKENS = REGISTRY.register(Counter(
+    "bot_tokens_total", "Токены запросов к модели по промпту (kind: prompt, completion, cached)",
+    ["prompt_id", "kind"]
+))
+TELEGRAM_SEND_LATENCY = REGISTRY.register(Histogram(
+    "bot_telegram_send_seconds", "Время выполнения запроса к Telegram", buckets=SEND_BUCKETS
+))
+TELEGRAM_SEND_WAIT = REGISTRY.register(Histogram(
+    "bot_telegram_send_wait_seconds", "Ожидание отправки из-за ограничений частоты Telegram",
+    buckets=SEND_BUCKETS
+))
+TELEGRAM_FLOOD_WAITS = REGISTRY.register(Counter(
+    "bot_telegram_flood_waits_total", "Ответы Telegram 429 (flood wait)"
+))
+CONTEXT_MESSAGES = REGISTRY.register(Histogram(
+    "bot_context_messages", "Количество сообщений в контексте после ответа",
+    buckets=CONTEXT_MESSAGES_BUCKETS
+))
+CONTEXT_TOKENS = REGISTRY.register(Histogram(
+    "bot_context_tokens", "Размер контекста в токенах после ответа", buckets=CONTEXT_TOKENS_BUCKETS
+))
+CONTEXT_COMPACTIONS = REGISTRY.register(Counter(
+    "bot_context_compactions_total",
+    "Фоновые сжатия контекста (result: applied, failed, discarded)", ["result"]
+))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "bot_requests_in_flight", "Запросы к модели, выполняемые сейчас"
+))
+REQUESTS_QUEUED = REGISTRY.register(Gauge(
+    "bot_requests_queued", "Запросы к модели, ожидающие в очереди планировщика"
+))
+REQUESTS_REJECTED = REGISTRY.register(Counter(
+    "bot_requests_rejected_total", "Запросы, отклонённые планировщиком (reason: queue_full, expired, quota)",
+    ["reason"]
+))
+UPDATES_PENDING = REGISTRY.register(Gauge(
+    "bot_updates_pending", "Обновления Telegram, принятые webhook и ещё не обработанные"
+))
+LOG_RECORDS_DROPPED = REGISTRY.register(Counter(
+    "bot_log_records_dropped_total",
+    "Записи лога, отброшенные без записи (reason: queue_full, sampled)", ["reason"]
+))
+EVENT_LOOP_LAG = REGISTRY.register(Histogram(
+    "bot_event_loop_lag_seconds", "Опоздание пробуждения периодической задачи цикла событий",
+    buckets=LOOP_LAG_BUCKETS
+))
+SPANS_DROPPED = REGISTRY.register(Counter(
+    "bot_trace_spans_dropped_total", "Интервалы трассировки, отброшенные без выгрузки"
+))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "bot_cache_lookups_total", "Обращения к кэшам ответов (cache: response, semantic; result: hit, miss)",
+    ["cache", "result"]
+))
+
+
+async def start_metrics_server(host: str, port: int, registry: Registry = REGISTRY) -> web.AppRunner:
+    """
+    Запустить HTTP-сервер, отдающий метрики по GET /metrics.
+    
+    Args:
+        host: Адрес, на котором слушает сервер
+        port: Порт сервера
+        registry: Набор метрик
+    
+    Returns:
+        AppRunner сервера (для остановки через cleanup())
+    """
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(
+            body=registry.render().encode("utf-8"),
+            headers={"Content-Type": CONTENT_TYPE},
+        )
+    
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны: http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,258 @@
+"""Выбор модели по сложности запроса и статистика моделей и адресов API."""
+import logging
+import re
+import time
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Уровни моделей по умолчанию
+FAST_TIER = "fast"
+REASONING_TIER = "reasoning"
+
+# Короткие реплики, не требующие рассуждений (благодарность, приветствие, согласие)
+_SMALL_TALK_RE = re.compile(
+    r"^\s*(привет\w*|здравствуй\w*|добр\w+ (утро|день|вечер)|спасибо\w*|благодарю|"
+    r"ок|окей|хорошо|понятно|ясно|отлично|супер|класс|пока|до свидания|"
+    r"hi|hello|hey|thanks?|thank you|ok|okay|bye)[\s!.,)]*$",
+    re.IGNORECASE,
+)
+# Признаки задач, для которых нужна модель с рассуждениями
+_REASONING_RE = re.compile(
+    r"почему|докаж|реши|решени|вычисл|посчитай|рассчитай|объясни|сравни|проанализ|"
+    r"алгоритм|оптимиз|спроектир|архитектур|код|функци|программ|ошибк|отлад|уравнени|задач|"
+    r"\bprove\b|\bwhy\b|\bsolve\b|\bdebug\b|\bcode\b|```|\d+\s*[-+*/^=]\s*\d+",
+    re.IGNORECASE,
+)
+
+
+class _RouteState:
+    """Статистика одной пары модель/адрес: сглаженные задержка и доля ошибок."""
+    
+    __slots__ = ("latency", "error_rate", "requests", "errors", "last_failure_at", "measured_at")
+    
+    def __init__(self):
+        """Инициализация пустой статистики."""
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.last_failure_at = 0.0
+        self.measured_at = 0.0
+
+
+class ModelRouter:
+    """Выбирает уровень модели для запроса и порядок моделей и адресов.
+    
+    Уровень определяется без обращения к API: по промпту, длине текста и
+    признакам в нём. Для каждой пары модель/адрес ведётся сглаженная
+    статистика задержки и ошибок; пары с высокой долей ошибок или
+    задержкой, намного большей, чем у лучшей альтернативы, считаются
+    деградировавшими и получают запросы в последнюю очередь, пока не
+    пройдёт recovery_time с последней ошибки.
+    """
+    
+    def __init__(self, tiers: Mapping[str, Sequence[str]], endpoints: Sequence[str],
+                 default_tier: str = REASONING_TIER, prompt_default_tier: Optional[str] = None,
+                 fast_max_chars: int = 200, smoothing: float = 0.2, min_samples: int = 5,
+                 max_error_rate: float = 0.5, slow_factor: float = 3.0, recovery_time: float = 60.0):
+        """
+        Инициализация маршрутизатора.
+        
+        Args:
+            tiers: Модели каждого уровня в порядке предпочтения
+            endpoints: Адреса API
+            default_tier: Уровень для запросов, сложность которых не определена
+            prompt_default_tier: Уровень для промптов без поля 'tier' (по умолчанию default_tier)
+            fast_max_chars: Максимальная длина вопроса без признаков сложности для быстрой модели
+            smoothing: Вес нового значения в сглаженной статистике (0.0-1.0)
+            min_samples: Минимальное количество запросов для оценки доли ошибок
+            max_error_rate: Доля ошибок, при которой пара модель/адрес считается деградировавшей
+            slow_factor: Во сколько раз задержка должна превышать лучшую, чтобы пара считалась деградировавшей
+            recovery_time: Время после последней ошибки, через которое пара снова получает запросы первой (сек)
+        """
+        if default_tier not in tiers:
+            raise ValueError(f"Уровень по умолчанию {default_tier} не задан в tiers")
+        self.tiers = {tier: list(models) for tier, models in tiers.items()}
+        self.endpoints = list(endpoints)
+        self.default_tier = default_tier
+        self.prompt_default_tier = prompt_default_tier or default_tier
+        self.fast_tier = FAST_TIER if FAST_TIER in tiers else default_tier
+        self.fast_max_chars = fast_max_chars
+        self.smoothing = smoothing
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.slow_factor = slow_factor
+        self.recovery_time = recovery_time
+        self._routes: Dict[Tuple[str, str], _RouteState] = {}
+    
+    def classify(self, text: str, prompt: Optional[Mapping] = None, dialog_tier: Optional[str] = None) -> str:
+        """
+        Определить уровень модели для запроса.
+        
+        Короткие уточнения в продолжающемся диалоге ("а для корня из 3?")
+        остаются на уровне диалога, чтобы модель не менялась посреди
+        рассуждения; быстрой модели уходят только короткие реплики.
+        
+        Args:
+            text: Текст пользователя
+            prompt: Выбранный промпт (None - обычный режим); уровень берётся из его поля 'tier'
+            dialog_tier: Уровень продолжающегося диалога (None - новый диалог)
+        
+        Returns:
+            Название уровня
+        """
+        if prompt is not None:
+            tier = prompt.get('tier')
+            return tier if tier in self.tiers else self.prompt_default_tier
+        if _SMALL_TALK_RE.match(text):
+            return self.fast_tier
+        if _REASONING_RE.search(text):
+            return self.default_tier
+        if dialog_tier in self.tiers:
+            return dialog_tier
+        if len(text) <= self.fast_max_chars:
+            return self.fast_tier
+        return self.default_tier
+    
+    def next_dialog_tier(self, dialog_tier: Optional[str], tier: str) -> str:
+        """
+        Уровень диалога после ответа: диалог, дошедший до модели с рассуждениями, на ней и остаётся.
+        
+        Args:
+            dialog_tier: Уровень диалога до ответа (None - новый диалог)
+            tier: Уровень, на котором получен ответ
+        
+        Returns:
+            Название уровня
+        """
+        if dialog_tier in self.tiers and tier == self.fast_tier:
+            return dialog_tier
+        return tier
+    
+    def primary_model(self, tier: Optional[str]) -> str:
+        """
+        Основная модель уровня без учёта деградации (для ключей кэшей ответов).
+        
+        Args:
+            tier: Название уровня (None - уровень по умолчанию)
+        
+        Returns:
+            Первая модель уровня из настроек
+        """
+        return (self.tiers.get(tier or self.default_tier) or self.tiers[self.default_tier])[0]
+    
+    def models_for(self, tier: Optional[str]) -> List[str]:
+        """
+        Модели уровня в порядке перебора.
+        
+        Модель, у которой все адреса деградировали из-за ошибок, переносится
+        в конец. По задержке модели не сравниваются: модель с рассуждениями
+        всегда медленнее быстрой.
+        
+        Args:
+            tier: Название уровня (None - уровень по умолчанию)
+        
+        Returns:
+            Список моделей
+        """
+        models = self.tiers.get(tier or self.default_tier) or self.tiers[self.default_tier]
+        now = time.monotonic()
+        flags = []
+        for model in models:
+            states = [self._routes.get((model, endpoint)) for endpoint in self.endpoints]
+            flags.append(all(state is not None and self._failing(state, now) for state in states))
+        return _healthy_first(models, flags)
+    
+    def order_endpoints(self, model: str, endpoints: Sequence[T]) -> List[T]:
+        """
+        Адреса API для модели в порядке перебора.
+        
+        Адрес с высокой долей ошибок или задержкой в slow_factor раз больше
+        лучшего адреса этой модели переносится в конец; через recovery_time
+        без новых замеров он снова получает запросы в обычном порядке.
+        
+        Args:
+            model: Модель
+            endpoints: Адреса (объекты с атрибутом base_url) в порядке из конфигурации
+        
+        Returns:
+            Список адресов
+        """
+        if len(endpoints) < 2:
+            return list(endpoints)
+        now = time.monotonic()
+        states = [self._routes.get((model, endpoint.base_url)) for endpoint in endpoints]
+        known = [state.latency for state in states if state is not None and state.latency is not None]
+        best = min(known) if known else None
+        flags = [
+            state is not None and (
+                self._failing(state, now)
+                or (state.latency is not None and state.latency > best * self.slow_factor
+                    and now - state.measured_at < self.recovery_time)
+            )
+            for state in states
+        ]
+        return _healthy_first(endpoints, flags)
+    
+    def record(self, model: str, endpoint: str, latency: Optional[float], ok: bool) -> None:
+        """
+        Учесть результат запроса.
+        
+        Args:
+            model: Модель
+            endpoint: Адрес API
+            latency: Время запроса (сек; None - не учитывать, например для потоковых ответов)
+            ok: Запрос выполнен успешно
+        """
+        state = self._routes.get((model, endpoint))
+        if state is None:
+            state = self._routes[(model, endpoint)] = _RouteState()
+        state.requests += 1
+        state.error_rate += self.smoothing * ((0.0 if ok else 1.0) - state.error_rate)
+        if not ok:
+            state.errors += 1
+            state.last_failure_at = time.monotonic()
+        elif latency is not None:
+            state.measured_at = time.monotonic()
+            state.latency = latency if state.latency is None else (
+                state.latency + self.smoothing * (latency - state.latency)
+            )
+    
+    def stats(self) -> List[Dict[str, object]]:
+        """
+        Статистика пар модель/адрес.
+        
+        Returns:
+            Список словарей: модель, адрес, количество запросов и ошибок,
+            сглаженные задержка и доля ошибок
+        """
+        return [
+            {
+                "model": model,
+                "endpoint": endpoint,
+                "requests": state.requests,
+                "errors": state.errors,
+                "latency": state.latency,
+                "error_rate": state.error_rate,
+            }
+            for (model, endpoint), state in self._routes.items()
+        ]
+    
+    def _failing(self, state: _RouteState, now: float) -> bool:
+        """Пара модель/адрес недавно отвечала ошибками слишком часто."""
+        return (
+            state.requests >= self.min_samples
+            and state.error_rate > self.max_error_rate
+            and now - state.last_failure_at < self.recovery_time
+        )
+
+
+def _healthy_first(candidates: Sequence[T], degraded: List[bool]) -> List[T]:
+    """Сохраняет порядок кандидатов, но переносит деградировавших в конец (если исправен хоть один)."""
+    if not any(degraded) or all(degraded):
+        return list(candidates)
+    return [candidate for candidate, flag in zip(candidates, degraded) if not flag] + \
+        [candidate for candidate, flag in zip(candidates, degraded) if flag]
@@ -0,0 +1,184 @@
+"""Диагностика производительности: задержка цикла событий и выборочный профилировщик стеков."""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """Замер задержки цикла событий: насколько позже срока просыпается периодическая задача.
+    
+    Опоздание показывает, сколько времени цикл был занят синхронным кодом
+    и не мог обслуживать другие обработчики.
+    """
+    
+    def __init__(self, interval: float = 0.01, observer: Optional[Callable[[float], None]] = None,
+                 warning_threshold: Optional[float] = None, keep_samples: bool = True):
+        """
+        Инициализация монитора.
+        
+        Args:
+            interval: Период проверки (сек)
+            observer: Функция, получающая каждый замер (например, гистограмма метрик)
+            warning_threshold: Задержка, при которой в лог пишется предупреждение (None - не писать)
+            keep_samples: Сохранять замеры в списке samples (для коротких прогонов)
+        """
+        self.interval = interval
+        self.observer = observer
+        self.warning_threshold = warning_threshold
+        self.keep_samples = keep_samples
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self) -> None:
+        """Начать замер."""
+        self._task = asyncio.create_task(self.run())
+    
+    async def stop(self) -> None:
+        """Остановить замер, начатый start()."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    async def run(self) -> None:
+        """Периодически засыпает и записывает опоздание пробуждения."""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            if self.keep_samples:
+                self.samples.append(lag)
+            if self.observer is not None:
+                self.observer(lag)
+            if self.warning_threshold is not None and lag >= self.warning_threshold:
+                logger.warning("Цикл событий был занят %.3f сек", lag)
+
+
+class SamplingProfiler:
+    """Выборочный профилировщик: периодически снимает стек потока цикла событий.
+    
+    Стеки снимаются из отдельного потока и не требуют изменений в коде,
+    поэтому профилировщик можно включить на работающем боте. Результат -
+    файл в формате свёрнутых стеков ("f1;f2;f3 N"), который принимают
+    flamegraph.pl, speedscope и inferno.
+    """
+    
+    def __init__(self, interval: float = 0.005, output_dir: str = "profiles"):
+        """
+        Инициализация профилировщика.
+        
+        Args:
+            interval: Период снятия стека (сек)
+            output_dir: Каталог для файлов профилей
+        """
+        self.interval = interval
+        self.output_dir = output_dir
+        self._running = False
+        self._labels: Dict[object, str] = {}
+    
+    @property
+    def running(self) -> bool:
+        """Идёт снятие профиля."""
+        return self._running
+    
+    async def profile(self, seconds: float) -> Tuple[str, Counter]:
+        """
+        Снимать стеки потока цикла событий в течение заданного времени и записать профиль.
+        
+        Args:
+            seconds: Длительность профилирования (сек)
+        
+        Returns:
+            Кортеж (путь к файлу профиля, количество замеров по свёрнутым стекам)
+        
+        Raises:
+            RuntimeError: Профиль уже снимается
+        """
+        if self._running:
+            raise RuntimeError("профиль уже снимается")
+        self._running = True
+        try:
+            logger.info(f"Снятие профиля: {seconds:.0f} сек, период {self.interval * 1000:.0f} мс")
+            stacks = await asyncio.to_thread(self._sample, threading.get_ident(), seconds)
+            path = await asyncio.to_thread(self._write, stacks)
+        finally:
+            self._running = False
+        logger.info(f"Профиль записан в {path}: {sum(stacks.values())} замеров")
+        return path, stacks
+    
+    def _sample(self, thread_id: int, seconds: float) -> Counter:
+        """Снимает стеки потока до истечения времени (выполняется в отдельном потоке)."""
+        stacks: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stacks[self._fold(frame)] += 1
+            del frame
+            time.sleep(self.interval)
+        return stacks
+    
+    def _fold(self, frame) -> str:
+        """Стек кадра одной строкой: функции от внешней к внутренней через ';'."""
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = _code_label(code)
+            labels.append(label)
+            frame = frame.f_back
+        labels.reverse()
+        return ";".join(labels)
+    
+    def _write(self, stacks: Counter) -> str:
+        """Записывает свёрнутые стеки в новый файл каталога профилей."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+def _code_label(code) -> str:
+    """Имя функции с файлом и строкой начала (без ';' - разделителя свёрнутых стеков)."""
+    filename = code.co_filename
+    if filename.startswith(os.getcwd()):
+        filename = os.path.relpath(filename)
+    else:
+        filename = "/".join(filename.replace("\\", "/").split("/")[-2:])
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({filename}:{code.co_firstlineno})".replace(";", ",")
+
+
+def top_functions(stacks: Counter, limit: int = 10) -> List[Tuple[str, float]]:
+    """
+    Функции, чаще всего оказывавшиеся на вершине стека.
+    
+    Args:
+        stacks: Количество замеров по свёрнутым стекам
+        limit: Максимальное количество функций
+    
+    Returns:
+        Список (функция, доля замеров) по убыванию доли
+    """
+    total = sum(stacks.values())
+    if not total:
+        return []
+    leaves: Counter = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+    return [(label, count / total) for label, count in leaves.most_common(limit)]
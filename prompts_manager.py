@@ -1,41 +1,253 @@
 """Управление заготовленными промптами из JSON файла."""
+import asyncio
+import hashlib
 import json
 import logging
-from typing import List, Dict, Optional
+import os
+from typing import TYPE_CHECKING, Collection, Iterable, List, Dict, Optional, Tuple
+
+from token_counter import count_message_tokens
+
+if TYPE_CHECKING:
+    from context_manager import ContextMessage
 
 logger = logging.getLogger(__name__)
 
+# Заголовок формата ответа в системном сообщении промпта
+FORMAT_HEADER = "Формат ответа: "
+
+
+def validate_prompts(data: object, tiers: Optional[Collection[str]] = None) -> List[Dict]:
+    """
+    Проверить содержимое файла промптов.
+    
+    Args:
+        data: Разобранный JSON файла
+        tiers: Допустимые уровни моделей для поля 'tier' (None - не проверять название)
+    
+    Returns:
+        Список промптов
+    
+    Raises:
+        ValueError: Если структура файла или промпта неверна
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('prompts'), list):
+        raise ValueError("ожидается объект с полем 'prompts' (список)")
+    
+    ids, names = set(), set()
+    for index, prompt in enumerate(data['prompts']):
+        if not isinstance(prompt, dict):
+            raise ValueError(f"промпт №{index + 1} не является объектом")
+        prompt_id = prompt.get('id')
+        if not isinstance(prompt_id, int) or isinstance(prompt_id, bool) or prompt_id < 1:
+            raise ValueError(f"промпт №{index + 1}: id должен быть положительным целым числом")
+        if prompt_id in ids:
+            raise ValueError(f"повторяющийся id {prompt_id}")
+        name = prompt.get('name')
+        if not isinstance(name, str) or not name.strip():
+            raise ValueError(f"промпт {prompt_id}: не задано название")
+        if name.strip().lower() in names:
+            raise ValueError(f"повторяющееся название '{name}'")
+        for field in ('role', 'context', 'question', 'format'):
+            if not isinstance(prompt.get(field, ''), str):
+                raise ValueError(f"промпт {prompt_id}: поле '{field}' должно быть строкой")
+        tier = prompt.get('tier')
+        if tier is not None and (not isinstance(tier, str) or (tiers is not None and tier not in tiers)):
+            raise ValueError(f"промпт {prompt_id}: неизвестный уровень моделей '{tier}'")
+        ids.add(prompt_id)
+        names.add(name.strip().lower())
+    return data['prompts']
+
+
+class _PromptLibrary:
+    """Загруженный набор промптов с индексами и заранее подготовленными текстами.
+    
+    Набор не изменяется после создания: при перезагрузке файла создаётся
+    новый набор и заменяет прежний одним присваиванием.
+    """
+    
+    __slots__ = ("prompts", "by_id", "by_name", "search_keys", "system_messages", "versions",
+                 "short_pages", "full_pages", "overhead_tokens")
+    
+    def __init__(self, prompts: List[Dict], page_size: int):
+        """
+        Подготовка индексов, частей запросов и текстов меню.
+        
+        Args:
+            prompts: Проверенный список промптов
+            page_size: Количество промптов на странице меню
+        """
+        self.prompts = prompts
+        self.by_id: Dict[int, Dict] = {prompt['id']: prompt for prompt in prompts}
+        self.by_name: Dict[str, Dict] = {prompt['name'].strip().lower(): prompt for prompt in prompts}
+        # Строки для поиска: название и описание в нижнем регистре
+        self.search_keys: List[Tuple[str, Dict]] = [
+            (f"{prompt['name']} {prompt.get('context', '')}".lower(), prompt) for prompt in prompts
+        ]
+        # Системные сообщения промптов: одинаковое начало запросов для кэша промптов провайдера
+        self.system_messages: Dict[int, Optional[Dict]] = {
+            prompt['id']: _compile_system_message(prompt) for prompt in prompts
+        }
+        # Версии промптов для ключей кэшей ответов: меняются при правке роли, задания или формата
+        self.versions: Dict[int, str] = {
+            prompt_id: _message_version(message) for prompt_id, message in self.system_messages.items()
+        }
+        
+        pages = [prompts[start:start + page_size] for start in range(0, len(prompts), page_size)]
+        self.short_pages = [
+            _format_page("📋 <b>Выберите промпт:</b>\n", page, index, len(pages), describe=False)
+            for index, page in enumerate(pages)
+        ]
+        self.full_pages = [
+            _format_page("📋 <b>Доступные промпты:</b>\n", page, index, len(pages), describe=True)
+            for index, page in enumerate(pages)
+        ]
+        # Кэш размера служебной части промптов в токенах (по id промпта)
+        self.overhead_tokens: Dict[int, int] = {}
+
+
+def _compile_system_message(prompt: Dict) -> Optional[Dict]:
+    """Системное сообщение промпта: роль, задание и формат ответа (None, если все они пусты)."""
+    format_text = prompt.get('format', '')
+    parts = [
+        prompt.get('role', ''),
+        prompt.get('question', ''),
+        f"{FORMAT_HEADER}{format_text}" if format_text else "",
+    ]
+    content = "\n\n".join(part for part in parts if part)
+    return {"role": "system", "content": content} if content else None
+
+
+def _message_version(message: Optional[Dict]) -> str:
+    """Короткий хэш текста системного сообщения промпта."""
+    content = message['content'] if message is not None else ""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+def _format_entry(prompt: Dict, describe: bool) -> List[str]:
+    """Строки меню для одного промпта."""
+    lines = [f"<b>{prompt['id']}.</b> {prompt['name']}"]
+    if describe:
+        context = prompt.get('context', '')
+        if context:
+            lines.append(f"   {context[:80]}{'...' if len(context) > 80 else ''}")
+        lines.append("")
+    return lines
+
+
+def _format_page(title: str, prompts: List[Dict], index: int, total: int, describe: bool) -> str:
+    """Текст одной страницы меню промптов."""
+    lines = [title]
+    for prompt in prompts:
+        lines.extend(_format_entry(prompt, describe))
+    if total > 1:
+        lines.append(f"\nСтраница {index + 1} из {total}")
+    return "\n".join(lines)
+
 
 class PromptsManager:
-    """Менеджер для загрузки и работы с промптами из JSON файла."""
+    """Менеджер для загрузки и работы с промптами из JSON файла.
+    
+    Промпты индексируются по id и названию, тексты меню и части запросов
+    готовятся при загрузке. При изменении файла промпты перезагружаются
+    целиком; если новый файл содержит ошибку, остаются прежние промпты.
+    """
     
-    def __init__(self, prompts_file: str = "prompts.json"):
+    def __init__(self, prompts_file: str = "prompts.json", page_size: int = 20, search_limit: int = 10,
+                 tiers: Optional[Collection[str]] = None):
         """
         Инициализация менеджера промптов.
         
         Args:
             prompts_file: Путь к JSON файлу с промптами
+            page_size: Количество промптов на странице меню
+            search_limit: Максимальное количество результатов поиска
+            tiers: Допустимые уровни моделей для поля 'tier' промпта (None - не проверять)
         """
         self.prompts_file = prompts_file
-        self.prompts: Optional[List[Dict]] = None
+        self.page_size = page_size
+        self.search_limit = search_limit
+        self.tiers = tiers
+        self._library = _PromptLibrary([], page_size)
+        # Время изменения и размер файла, из которого выполнена последняя попытка загрузки
+        self._file_signature: Optional[Tuple[int, int]] = None
         self._load_prompts()
     
+    @property
+    def prompts(self) -> List[Dict]:
+        """Список загруженных промптов."""
+        return self._library.prompts
+    
+    @property
+    def page_count(self) -> int:
+        """Количество страниц меню промптов."""
+        return len(self._library.short_pages)
+    
+    def _file_state(self) -> Optional[Tuple[int, int]]:
+        """Время изменения и размер файла промптов (None, если файла нет)."""
+        try:
+            stat = os.stat(self.prompts_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+    
+    def _read_library(self) -> _PromptLibrary:
+        """Читает и проверяет файл промптов и готовит новый набор."""
+        with open(self.prompts_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return _PromptLibrary(validate_prompts(data, self.tiers), self.page_size)
+    
     def _load_prompts(self) -> None:
         """Загружает промпты из JSON файла."""
+        self._file_signature = self._file_state()
         try:
-            with open(self.prompts_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                self.prompts = data.get('prompts', [])
-                logger.info(f"Загружено {len(self.prompts)} промптов из {self.prompts_file}")
+            self._library = self._read_library()
+            logger.info(f"Загружено {len(self.prompts)} промптов из {self.prompts_file}")
         except FileNotFoundError:
             logger.warning(f"Файл {self.prompts_file} не найден. Промпты недоступны.")
-            self.prompts = []
         except json.JSONDecodeError as e:
             logger.error(f"Ошибка при парсинге JSON файла {self.prompts_file}: {e}")
-            self.prompts = []
         except Exception as e:
             logger.error(f"Ошибка при загрузке промптов: {e}")
-            self.prompts = []
+    
+    async def reload_if_changed(self) -> bool:
+        """
+        Перезагрузить промпты, если файл изменился.
+        
+        Файл читается и проверяется в отдельном потоке; новый набор
+        промптов заменяет прежний, только если проверка прошла успешно.
+        Повторная попытка загрузки ошибочного файла выполняется после
+        его следующего изменения.
+        
+        Returns:
+            True, если промпты перезагружены
+        """
+        signature = self._file_state()
+        if signature is None or signature == self._file_signature:
+            return False
+        self._file_signature = signature
+        try:
+            library = await asyncio.to_thread(self._read_library)
+        except Exception as e:
+            logger.error(
+                f"Ошибка при перезагрузке промптов из {self.prompts_file}: {e}. "
+                f"Оставлены прежние промпты ({len(self.prompts)})"
+            )
+            return False
+        self._library = library
+        logger.info(f"Промпты перезагружены: {len(self.prompts)} из {self.prompts_file}")
+        return True
+    
+    async def watch(self, interval: float) -> None:
+        """
+        Фоновая задача: перезагрузка промптов при изменении файла.
+        
+        Args:
+            interval: Интервал проверки файла в секундах
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await self.reload_if_changed()
     
     def get_prompts(self) -> List[Dict]:
         """
@@ -44,7 +256,7 @@ class PromptsManager:
         Returns:
             Список промптов
         """
-        return self.prompts or []
+        return self._library.prompts
     
     def get_prompt_by_id(self, prompt_id: int) -> Optional[Dict]:
         """
@@ -52,103 +264,174 @@ class PromptsManager:
         
         Args:
             prompt_id: ID промпта (1-based)
-            
+        
         Returns:
             Словарь с данными промпта или None
         """
-        if not self.prompts:
-            return None
+        return self._library.by_id.get(prompt_id)
+    
+    def get_prompt_by_name(self, name: str) -> Optional[Dict]:
+        """
+        Получить промпт по названию (без учёта регистра).
         
-        try:
-            # Ищем промпт по id (1-based)
-            for prompt in self.prompts:
-                if prompt.get('id') == prompt_id:
-                    return prompt
-            return None
-        except Exception as e:
-            logger.error(f"Ошибка при получении промпта по ID {prompt_id}: {e}")
-            return None
+        Args:
+            name: Название промпта
+        
+        Returns:
+            Словарь с данными промпта или None
+        """
+        return self._library.by_name.get(name.strip().lower())
+    
+    def search(self, query: str) -> List[Dict]:
+        """
+        Найти промпты, в названии или описании которых есть все слова запроса.
+        
+        Args:
+            query: Строка поиска
+        
+        Returns:
+            Не более search_limit найденных промптов в порядке файла
+        """
+        words = query.lower().split()
+        if not words:
+            return []
+        results = []
+        for key, prompt in self._library.search_keys:
+            if all(word in key for word in words):
+                results.append(prompt)
+                if len(results) >= self.search_limit:
+                    break
+        return results
     
-    def format_prompts_list(self) -> str:
+    def format_prompts_list(self, page: int = 0) -> str:
         """
         Форматирует список промптов для отображения пользователю.
         
+        Args:
+            page: Номер страницы (с нуля; выходящий за границы приводится к ближайшему)
+        
         Returns:
             Отформатированная строка со списком промптов
         """
-        if not self.prompts:
+        pages = self._library.full_pages
+        if not pages:
             return "❌ Промпты недоступны"
-        
-        lines = ["📋 <b>Доступные промпты:</b>\n"]
-        for prompt in self.prompts:
-            prompt_id = prompt.get('id', 0)
-            name = prompt.get('name', 'Без названия')
-            context = prompt.get('context', '')
-            lines.append(f"<b>{prompt_id}.</b> {name}")
-            if context:
-                lines.append(f"   {context[:80]}{'...' if len(context) > 80 else ''}")
-            lines.append("")
-        
-        return "\n".join(lines)
+        return pages[max(0, min(page, len(pages) - 1))]
     
-    def format_prompt_short(self) -> str:
+    def format_prompt_short(self, page: int = 0) -> str:
         """
         Форматирует краткий список промптов (только ID и название).
         
+        Args:
+            page: Номер страницы (с нуля; выходящий за границы приводится к ближайшему)
+        
         Returns:
             Отформатированная строка с кратким списком
         """
-        if not self.prompts:
+        pages = self._library.short_pages
+        if not pages:
             return "❌ Промпты недоступны"
+        return pages[max(0, min(page, len(pages) - 1))]
+    
+    def format_search_results(self, query: str, results: List[Dict]) -> str:
+        """
+        Форматирует результаты поиска промптов.
         
-        lines = ["📋 <b>Выберите промпт:</b>\n"]
-        for prompt in self.prompts:
-            prompt_id = prompt.get('id', 0)
-            name = prompt.get('name', 'Без названия')
-            lines.append(f"<b>{prompt_id}.</b> {name}")
+        Args:
+            query: Строка поиска
+            results: Найденные промпты
         
+        Returns:
+            Отформатированная строка с найденными промптами
+        """
+        if not results:
+            return f"🔍 По запросу «{query}» промпты не найдены"
+        lines = [f"🔍 <b>Найдено по запросу «{query}»:</b>\n"]
+        for prompt in results:
+            lines.extend(_format_entry(prompt, describe=False))
         return "\n".join(lines)
     
-    def build_messages_with_prompt(self, prompt: Dict, user_input: str, 
-                                   existing_context: Optional[List[Dict]] = None) -> List[Dict]:
+    def build_messages_with_prompt(self, prompt: Dict, user_input: str,
+                                   existing_context: Optional[Iterable["ContextMessage"]] = None) -> List[Dict]:
         """
         Формирует список сообщений для API с использованием промпта.
         
         Args:
             prompt: Словарь с данными промпта
             user_input: Текст пользователя
-            existing_context: Существующий контекст диалога (опционально)
-            
+            existing_context: Существующий контекст диалога, например ContextView (опционально)
+        
         Returns:
             Список сообщений для отправки в API
         """
         messages = []
         
-        # Добавляем системное сообщение с ролью
-        role = prompt.get('role', '')
-        if role:
-            messages.append({"role": "system", "content": role})
+        # Роль, задание и формат ответа не меняются от запроса к запросу и у всех
+        # пользователей промпта, поэтому идут первыми: провайдер кэширует общее
+        # начало запросов, и оно обрабатывается быстрее и дешевле
+        system_message = self._get_system_message(prompt)
+        if system_message is not None:
+            messages.append(system_message)
         
-        # Добавляем существующий контекст (без системного сообщения, если оно уже есть)
+        # Добавляем существующий контекст. Краткое содержание сжатой части диалога
+        # идёт в начале контекста, то есть сразу после роли промпта
         if existing_context:
-            # Пропускаем системные сообщения из существующего контекста
-            for msg in existing_context:
-                if msg.get('role') != 'system':
-                    messages.append(msg)
-        
-        # Формируем полный вопрос с контекстом
-        question = prompt.get('question', '')
-        format_text = prompt.get('format', '')
-        
-        full_question_parts = []
-        if question:
-            full_question_parts.append(question)
-        if user_input:
-            full_question_parts.append(f"\n\nТекст для обработки:\n{user_input}")
-        if format_text:
-            full_question_parts.append(f"\n\nФормат ответа: {format_text}")
-        
-        full_question = "".join(full_question_parts)
-        messages.append({"role": "user", "content": full_question})
+            messages.extend(message.to_dict() for message in existing_context)
+        
+        # Сообщение пользователя - только его текст
+        messages.append({"role": "user", "content": user_input})
         
         return messages
+    
+    def _get_system_message(self, prompt: Dict) -> Optional[Dict]:
+        """Системное сообщение промпта: подготовленное при загрузке или собранное для промпта не из файла."""
+        library = self._library
+        if library.by_id.get(prompt.get('id')) is prompt:
+            return library.system_messages[prompt['id']]
+        return _compile_system_message(prompt)
+    
+    def get_prompt_version(self, prompt: Dict) -> str:
+        """
+        Получить версию промпта - хэш его системного сообщения.
+        
+        Версия входит в ключи кэшей ответов, поэтому после правки промпта
+        в файле ответы, полученные со старым текстом, больше не выдаются.
+        
+        Args:
+            prompt: Словарь с данными промпта
+        
+        Returns:
+            Версия промпта (16 шестнадцатеричных символов)
+        """
+        library = self._library
+        if library.by_id.get(prompt.get('id')) is prompt:
+            return library.versions[prompt['id']]
+        return _message_version(_compile_system_message(prompt))
+    
+    def count_prompt_tokens(self, prompt: Dict) -> int:
+        """
+        Подсчитать, сколько токенов добавляет промпт к запросу помимо контекста и текста пользователя.
+        
+        Учитываются системное сообщение промпта (роль, задание и формат
+        ответа) и служебные токены сообщения пользователя. Результат кэшируется
+        до перезагрузки промптов.
+        
+        Args:
+            prompt: Словарь с данными промпта
+        
+        Returns:
+            Количество токенов служебной части промпта
+        """
+        cache = self._library.overhead_tokens
+        prompt_id = prompt.get('id')
+        if prompt_id in cache:
+            return cache[prompt_id]
+        
+        # Строим запрос с пустым текстом пользователя: всё, что в нём есть, - накладные расходы промпта
+        overhead = sum(
+            count_message_tokens(msg['content'])
+            for msg in self.build_messages_with_prompt(prompt, "")
+        )
+        
+        cache[prompt_id] = overhead
+        return overhead
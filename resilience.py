@@ -0,0 +1,184 @@
+"""Средства устойчивости запросов к API: повторы, автоматический выключатель, статистика задержек."""
+import email.utils
+import logging
+import random
+import time
+from collections import deque
+from typing import Deque, Optional
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+# Коды ответа, при которых запрос имеет смысл повторить
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Все доступные адреса API временно отключены автоматическим выключателем."""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Проверить, является ли ошибка временной (запрос можно повторить).
+    
+    Args:
+        error: Исключение, полученное при запросе к API
+    
+    Returns:
+        True для сетевых ошибок, таймаутов, 429 и 5xx
+    """
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """
+    Получить задержку из заголовков Retry-After ответа с ошибкой.
+    
+    Args:
+        error: Исключение, полученное при запросе к API
+    
+    Returns:
+        Задержка в секундах или None, если заголовок отсутствует
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        # Заголовок может содержать дату в формате HTTP
+        parsed = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, parsed.timestamp() - time.time()) if parsed else None
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float,
+                  retry_after: Optional[float] = None) -> float:
+    """
+    Вычислить задержку перед повтором: экспоненциальный рост со случайным разбросом.
+    
+    Args:
+        attempt: Номер неудачной попытки (с 0)
+        base_delay: Базовая задержка (сек)
+        max_delay: Максимальная задержка (сек)
+        retry_after: Задержка, запрошенная сервером (имеет приоритет)
+    
+    Returns:
+        Задержка в секундах
+    """
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """Автоматический выключатель: временно прекращает запросы к неработающему адресу.
+    
+    После failure_threshold ошибок подряд выключатель размыкается на reset_timeout
+    секунд, затем пропускает один пробный запрос: успех замыкает его обратно.
+    """
+    
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        Инициализация выключателя.
+        
+        Args:
+            failure_threshold: Количество ошибок подряд до размыкания
+            reset_timeout: Время (сек) до пробного запроса после размыкания
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+    
+    @property
+    def state(self) -> str:
+        """Текущее состояние: 'closed', 'open' или 'half_open'."""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+    
+    def allow(self) -> bool:
+        """
+        Проверить, можно ли отправить запрос.
+        
+        Returns:
+            True, если выключатель замкнут или пора отправить пробный запрос
+        """
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+    
+    def record_success(self) -> None:
+        """Отметить успешный запрос."""
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+    
+    def record_cancel(self) -> None:
+        """Отметить отменённый запрос: пробный запрос можно отправить снова."""
+        self._probe_in_flight = False
+    
+    def record_failure(self) -> None:
+        """Отметить неудачный запрос."""
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Скользящее окно последних задержек для оценки перцентилей."""
+    
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        """
+        Инициализация окна.
+        
+        Args:
+            window: Количество хранимых последних значений
+            min_samples: Минимальное количество значений для оценки перцентиля
+        """
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=window)
+    
+    def record(self, latency: float) -> None:
+        """Добавить задержку (сек)."""
+        self._samples.append(latency)
+    
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        Оценить перцентиль задержки.
+        
+        Args:
+            q: Квантиль от 0 до 1 (например, 0.95)
+        
+        Returns:
+            Значение перцентиля или None, если данных недостаточно
+        """
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
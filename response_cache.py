@@ -0,0 +1,206 @@
+"""Кэш ответов модели для запросов в режиме промпта."""
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_input(text: str) -> str:
+    """
+    Нормализовать текст пользователя для построения ключа кэша.
+    
+    Приводит юникод к форме NFKC и схлопывает пробельные символы,
+    чтобы тексты, отличающиеся только переносами строк и пробелами, совпадали.
+    
+    Args:
+        text: Исходный текст пользователя
+    
+    Returns:
+        Нормализованный текст
+    """
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class _DiskTier:
+    """Дисковый уровень кэша в файле SQLite."""
+    
+    # Как часто (в записях) удалять устаревшие и лишние записи
+    PRUNE_EVERY = 100
+    
+    def __init__(self, db_path: str, ttl: float, max_entries: int):
+        """Открывает (или создаёт) файл кэша."""
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, "
+            "response TEXT NOT NULL, "
+            "created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+    
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        """Возвращает (ответ, время создания) или None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ? AND created_at >= ?",
+                (key, time.time() - self.ttl)
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+    
+    def set(self, key: str, response: str, created_at: float) -> None:
+        """Сохраняет ответ и периодически удаляет устаревшие записи."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at) VALUES (?, ?, ?)",
+                (key, response, created_at)
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+    
+    def close(self) -> None:
+        """Закрывает соединение с базой данных."""
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """Кэш ответов с вытеснением по размеру (LRU) и времени жизни и необязательным уровнем на диске."""
+    
+    def __init__(self, max_entries: int = 1000, ttl: float = 86400,
+                 disk_path: Optional[str] = None, max_disk_entries: int = 100000):
+        """
+        Инициализация кэша.
+        
+        Args:
+            max_entries: Максимальное количество ответов в памяти
+            ttl: Время жизни ответа в секундах
+            disk_path: Путь к файлу SQLite для дискового уровня (None - только память)
+            max_disk_entries: Максимальное количество ответов на диске
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Ключ -> (ответ, время создания); порядок отражает давность использования
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._disk = _DiskTier(disk_path, ttl, max_disk_entries) if disk_path else None
+        
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def make_key(prompt_id: int, model: str, user_input: str, prompt_version: str = "") -> str:
+        """
+        Построить ключ кэша.
+        
+        Args:
+            prompt_id: ID промпта
+            model: Название модели
+            user_input: Текст пользователя
+            prompt_version: Версия текста промпта (PromptsManager.get_prompt_version)
+        
+        Returns:
+            Ключ кэша (хэш SHA-256)
+        """
+        raw = f"{prompt_id}\x00{prompt_version}\x00{model}\x00{normalize_input(user_input)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    async def get(self, key: str) -> Optional[str]:
+        """
+        Получить ответ из кэша.
+        
+        Args:
+            key: Ключ кэша
+        
+        Returns:
+            Сохранённый ответ или None при промахе
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.time() - entry[1] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            del self._entries[key]
+            self.evictions += 1
+        
+        if self._disk is not None:
+            try:
+                entry = await asyncio.to_thread(self._disk.get, key)
+            except Exception as e:
+                logger.error(f"Ошибка чтения дискового кэша ответов: {e}")
+                entry = None
+            if entry is not None:
+                self._put(key, entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry[0]
+        
+        self.misses += 1
+        return None
+    
+    async def set(self, key: str, response: str) -> None:
+        """
+        Сохранить ответ в кэш.
+        
+        Args:
+            key: Ключ кэша
+            response: Текст ответа модели
+        """
+        entry = (response, time.time())
+        self._put(key, entry)
+        if self._disk is not None:
+            try:
+                await asyncio.to_thread(self._disk.set, key, *entry)
+            except Exception as e:
+                logger.error(f"Ошибка записи дискового кэша ответов: {e}")
+    
+    def stats(self) -> Dict[str, int]:
+        """
+        Получить счётчики кэша.
+        
+        Returns:
+            Словарь с количеством попаданий, промахов, вытеснений и размером кэша
+        """
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+        }
+    
+    def close(self) -> None:
+        """Закрыть дисковый уровень кэша."""
+        if self._disk is not None:
+            self._disk.close()
+    
+    def _put(self, key: str, entry: Tuple[str, float]) -> None:
+        """Добавляет запись в память, вытесняя самые давно использованные."""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
@@ -0,0 +1,250 @@
+"""Планировщик запросов к модели с ограничением параллелизма и справедливой очередью."""
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SchedulerBusyError(Exception):
+    """Очередь запросов переполнена, запрос не принят."""
+
+
+class RequestExpiredError(Exception):
+    """Запрос слишком долго ждал в очереди и был отброшен."""
+
+
+class _Job:
+    """Запрос, ожидающий выполнения."""
+    
+    __slots__ = ("user_id", "factory", "future", "enqueued_at", "deadline", "context", "started")
+    
+    def __init__(self, user_id: int, factory: Callable[[], Awaitable], future: asyncio.Future,
+                 deadline: float):
+        """Создаёт запрос с моментом постановки в очередь и крайним сроком начала выполнения."""
+        self.user_id = user_id
+        self.factory = factory
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.deadline = deadline
+        # Контекст вызывающей задачи (идентификатор запроса для логов) переносится в выполнение запроса
+        self.context = contextvars.copy_context()
+        self.started = False
+
+
+class RequestScheduler:
+    """Глобальный планировщик запросов к модели.
+    
+    Одновременно выполняется не больше max_concurrency запросов. Ожидающие
+    запросы хранятся в отдельной очереди для каждого пользователя, а очереди
+    обходятся по кругу, поэтому один активный пользователь не задерживает остальных.
+    """
+    
+    def __init__(self, max_concurrency: int = 16, max_queue_size: int = 200,
+                 max_queue_per_user: int = 3, queue_deadline: float = 30.0):
+        """
+        Инициализация планировщика.
+        
+        Args:
+            max_concurrency: Максимальное количество одновременно выполняемых запросов
+            max_queue_size: Максимальное количество ожидающих запросов всего
+            max_queue_per_user: Максимальное количество ожидающих запросов одного пользователя
+            queue_deadline: Максимальное время ожидания в очереди (сек), после которого запрос отбрасывается
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.max_queue_per_user = max_queue_per_user
+        self.queue_deadline = queue_deadline
+        
+        self._queues: Dict[int, Deque[_Job]] = {}
+        self._ready: Deque[int] = deque()  # Пользователи с ожидающими запросами в порядке обхода
+        self._queued = 0
+        self._has_jobs = asyncio.Event()
+        self._workers: list = []
+        
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.expired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    @property
+    def queued(self) -> int:
+        """Количество запросов, ожидающих в очереди."""
+        return self._queued
+    
+    async def submit(self, user_id: int, factory: Callable[[], Awaitable[T]],
+                     deadline: Optional[float] = None, limit_per_user: bool = True) -> T:
+        """
+        Поставить запрос в очередь и дождаться результата.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            factory: Функция, создающая корутину запроса при начале выполнения
+            deadline: Максимальное время ожидания в очереди (сек), по умолчанию queue_deadline
+            limit_per_user: Применять ограничение max_queue_per_user (False - для частей уже
+                принятого запроса, например частей длинного текста)
+        
+        Returns:
+            Результат выполнения запроса
+        
+        Raises:
+            SchedulerBusyError: Очередь переполнена
+            RequestExpiredError: Запрос не дождался выполнения за отведённое время
+        """
+        self._ensure_started()
+        
+        user_queue = self._queues.get(user_id)
+        if self._queued >= self.max_queue_size or (
+            limit_per_user and user_queue is not None and len(user_queue) >= self.max_queue_per_user
+        ):
+            self.rejected += 1
+            raise SchedulerBusyError()
+        
+        wait_limit = deadline if deadline is not None else self.queue_deadline
+        job = _Job(user_id, factory, asyncio.get_running_loop().create_future(),
+                   time.monotonic() + wait_limit)
+        if user_queue is None:
+            user_queue = self._queues[user_id] = deque()
+            self._ready.append(user_id)
+        user_queue.append(job)
+        self._queued += 1
+        self._has_jobs.set()
+        
+        # Крайний срок отсчитывается и тогда, когда все обработчики заняты и очередь не разбирается
+        try:
+            return await asyncio.wait_for(asyncio.shield(job.future), wait_limit)
+        except asyncio.TimeoutError:
+            if job.started:
+                # Запрос уже выполняется: крайний срок относится только к ожиданию в очереди
+                return await job.future
+            self._discard(job)
+            self.expired += 1
+            raise RequestExpiredError()
+        except asyncio.CancelledError:
+            # Выполняемый запрос отменяется обработчиком, ожидающий - убирается из очереди
+            self._discard(job)
+            raise
+    
+    def stats(self) -> Dict[str, float]:
+        """
+        Получить статистику планировщика.
+        
+        Returns:
+            Словарь с глубиной очереди, количеством выполняемых запросов и временем ожидания
+        """
+        started = self.completed + self.in_flight
+        return {
+            "queued": self._queued,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "avg_wait": self.total_wait / started if started else 0.0,
+            "max_wait": self.max_wait,
+        }
+    
+    async def stop(self) -> None:
+        """Остановить обработчики очереди и отменить ожидающие запросы."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for user_queue in self._queues.values():
+            for job in user_queue:
+                job.future.cancel()
+        self._queues.clear()
+        self._ready.clear()
+        self._queued = 0
+    
+    def _ensure_started(self) -> None:
+        """Запускает обработчики очереди при первом запросе."""
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)
+            ]
+    
+    def _discard(self, job: _Job) -> None:
+        """Отменяет запрос, который больше не ждут, и убирает его из очереди, если он ещё не начат."""
+        job.future.cancel()
+        user_queue = self._queues.get(job.user_id)
+        if user_queue is None or job not in user_queue:
+            return
+        user_queue.remove(job)
+        self._queued -= 1
+        if not user_queue:
+            del self._queues[job.user_id]
+            self._ready.remove(job.user_id)
+    
+    def _next_job(self) -> Optional[_Job]:
+        """Берёт следующий запрос, обходя очереди пользователей по кругу."""
+        while self._ready:
+            user_id = self._ready.popleft()
+            user_queue = self._queues[user_id]
+            job = user_queue.popleft()
+            self._queued -= 1
+            if user_queue:
+                self._ready.append(user_id)
+            else:
+                del self._queues[user_id]
+            
+            if job.future.done():
+                # Вызывающий код уже перестал ждать результат
+                continue
+            if time.monotonic() > job.deadline:
+                self.expired += 1
+                job.future.set_exception(RequestExpiredError())
+                continue
+            return job
+        
+        self._has_jobs.clear()
+        return None
+    
+    async def _worker(self) -> None:
+        """Обработчик очереди: выполняет запросы по одному."""
+        while True:
+            job = self._next_job()
+            if job is None:
+                await self._has_jobs.wait()
+                continue
+            
+            wait = time.monotonic() - job.enqueued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            # Ожидание в очереди попадает в трассу обновления, отправившего запрос
+            job.context.run(tracing.record_span, "scheduler.queue", wait, user_id=job.user_id)
+            
+            job.started = True
+            self.in_flight += 1
+            task = job.context.run(lambda: asyncio.ensure_future(job.factory()))
+            # Если вызывающий код отменён, отменяем и выполняемый запрос
+            job.future.add_done_callback(lambda future, task=task: task.cancel() if future.cancelled() else None)
+            try:
+                await asyncio.wait({task})
+            except asyncio.CancelledError:
+                # Планировщик останавливается
+                task.cancel()
+                raise
+            finally:
+                self.in_flight -= 1
+                self.completed += 1
+            
+            if task.cancelled():
+                if not job.future.done():
+                    job.future.cancel()
+                continue
+            error = task.exception()
+            if job.future.done():
+                continue
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(task.result())
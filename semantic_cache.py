@@ -0,0 +1,253 @@
+"""Приближённый кэш ответов для перефразированных вопросов на локальных векторах."""
+import logging
+import re
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Слова, числа и знаки операций; остальная пунктуация отбрасывается
+_TOKEN_RE = re.compile(r"\d+(?:[.,]\d+)*|[+\-*/=<>%^×÷]|[^\W\d_]+")
+# Отрицания, меняющие смысл вопроса при почти том же тексте
+_NEGATIONS = frozenset({"не", "нет", "ни", "нельзя", "без", "no", "not", "never", "without", "nor"})
+
+
+def _tokenize(text: str) -> List[str]:
+    """Разбивает текст на слова, числа и знаки операций в нижнем регистре."""
+    return _TOKEN_RE.findall(text.casefold().replace("n't", " not"))
+
+
+def _signature(tokens: List[str]) -> Tuple[str, ...]:
+    """
+    Числа, знаки операций и отрицания вопроса по порядку.
+    
+    Вопросы, различающиеся только ими ("2+2" и "2*2", "напиши" и "не пиши"),
+    почти совпадают по n-граммам, но требуют разных ответов, поэтому ответ
+    из кэша выдаётся только при точном совпадении этой части.
+    """
+    return tuple(token for token in tokens if not token.isalpha() or token in _NEGATIONS)
+
+
+def _char_ngrams(tokens: List[str], ngram_range=(3, 5)) -> List[str]:
+    """
+    Разбивает текст на символьные n-граммы.
+    
+    Регистр и пунктуация игнорируются, числа и знаки операций остаются
+    отдельными словами, к словам добавляются границы, поэтому
+    перефразировки и опечатки дают близкие наборы n-грамм.
+    
+    Args:
+        tokens: Слова текста (см. _tokenize)
+        ngram_range: Минимальная и максимальная длина n-граммы
+    
+    Returns:
+        Список n-грамм
+    """
+    normalized = f" {' '.join(tokens)} " if tokens else ""
+    ngrams = []
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        ngrams.extend(normalized[i:i + n] for i in range(len(normalized) - n + 1))
+    return ngrams
+
+
+class _Namespace:
+    """Векторы и ответы одного пространства имён (например, одного промпта)."""
+    
+    # Начальное количество строк матрицы; матрица растёт удвоением до capacity
+    INITIAL_ROWS = 64
+    
+    def __init__(self, dim: int, capacity: int):
+        """
+        Инициализация пустого пространства имён.
+        
+        Args:
+            dim: Размерность векторов
+            capacity: Максимальное количество записей
+        """
+        self.capacity = capacity
+        self.vectors = np.zeros((min(self.INITIAL_ROWS, capacity), dim), dtype=np.float32)
+        self.last_used = np.zeros(self.vectors.shape[0], dtype=np.int64)
+        self.answers: List[Optional[str]] = [None] * self.vectors.shape[0]
+        self.signatures: List[Optional[Tuple[str, ...]]] = [None] * self.vectors.shape[0]
+        self.size = 0
+        # Документная частота хэшированных n-грамм сохранённых вопросов для весов IDF
+        self.doc_freq = np.zeros(dim, dtype=np.float32)
+        self.documents = 0
+        # Веса IDF и нормы взвешенных строк, посчитанные для текущего набора записей
+        self.idf: Optional[np.ndarray] = None
+        self.norms: Optional[np.ndarray] = None
+    
+    def weights(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Веса IDF и нормы строк матрицы с этими весами.
+        
+        Пересчитываются только после изменения записей, поэтому повторные
+        поиски в неизменном пространстве имён обходятся одним умножением.
+        
+        Returns:
+            Кортеж (веса IDF, нормы строк)
+        """
+        if self.idf is None:
+            self.idf = (np.log((1.0 + self.documents) / (1.0 + self.doc_freq)) + 1.0).astype(np.float32)
+            self.norms = np.sqrt(np.square(self.vectors[:self.size]) @ np.square(self.idf))
+        return self.idf, self.norms
+    
+    def slot_for_insert(self) -> int:
+        """Возвращает свободную строку матрицы (расширяя её при необходимости) или -1, если места нет."""
+        if self.size < self.vectors.shape[0]:
+            self.size += 1
+            return self.size - 1
+        if self.vectors.shape[0] < self.capacity:
+            rows = min(self.vectors.shape[0] * 2, self.capacity)
+            self.vectors = np.resize(self.vectors, (rows, self.vectors.shape[1]))
+            self.vectors[self.size:] = 0
+            self.last_used = np.resize(self.last_used, rows)
+            self.answers.extend([None] * (rows - len(self.answers)))
+            self.signatures.extend([None] * (rows - len(self.signatures)))
+            self.size += 1
+            return self.size - 1
+        return -1
+
+
+class SemanticCache:
+    """Кэш ответов, находящий близкие по смыслу вопросы по косинусной близости.
+    
+    Вопросы превращаются в векторы TF-IDF по хэшированным символьным n-граммам
+    без обращения к внешним сервисам эмбеддингов. Сохраняются частоты TF, а
+    текущие веса IDF применяются к обеим сторонам при поиске, поэтому
+    близость повторённого вопроса не падает по мере заполнения кэша. Поиск -
+    одно векторизованное умножение матрицы сохранённых векторов на вектор
+    запроса. Числа, знаки операций и отрицания близкого вопроса должны
+    совпадать с запросом точно.
+    """
+    
+    def __init__(self, threshold: float = 0.95, capacity: int = 1000, dim: int = 1024):
+        """
+        Инициализация кэша.
+        
+        Args:
+            threshold: Минимальная косинусная близость для ответа из кэша
+            capacity: Максимальное количество записей в одном пространстве имён
+            dim: Размерность хэшированных векторов
+        """
+        self.threshold = threshold
+        self.capacity = capacity
+        self.dim = dim
+        self._namespaces: Dict[str, _Namespace] = {}
+        self._clock = 0  # Счётчик обращений для вытеснения давно не использованных записей
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def lookup(self, namespace: str, question: str) -> Optional[str]:
+        """
+        Найти ответ на близкий вопрос.
+        
+        Args:
+            namespace: Пространство имён (например, промпт и модель)
+            question: Текст вопроса пользователя
+        
+        Returns:
+            Сохранённый ответ или None, если близкого вопроса нет
+        """
+        space = self._namespaces.get(namespace)
+        if space is None or space.size == 0:
+            self.misses += 1
+            return None
+        
+        tokens = _tokenize(question)
+        counts = self._hash_counts(tokens)
+        if counts is None:
+            self.misses += 1
+            return None
+        idf, norms = space.weights()
+        query = _sublinear_tf(counts) * idf
+        query_norm = float(np.linalg.norm(query))
+        signature = _signature(tokens)
+        
+        similarities = (space.vectors[:space.size] @ (query * idf)) / np.maximum(norms * query_norm, 1e-12)
+        # Самый близкий вопрос с теми же числами, знаками операций и отрицаниями
+        candidates = np.flatnonzero(similarities >= self.threshold)
+        best = next(
+            (int(i) for i in candidates[np.argsort(-similarities[candidates])] if space.signatures[i] == signature),
+            None
+        )
+        if best is None:
+            self.misses += 1
+            return None
+        
+        self._clock += 1
+        space.last_used[best] = self._clock
+        self.hits += 1
+        logger.debug("Семантический кэш: попадание в %s, близость %.3f", namespace, similarities[best])
+        return space.answers[best]
+    
+    def add(self, namespace: str, question: str, answer: str) -> None:
+        """
+        Сохранить ответ на вопрос.
+        
+        Args:
+            namespace: Пространство имён (например, промпт и модель)
+            question: Текст вопроса пользователя
+            answer: Ответ модели
+        """
+        tokens = _tokenize(question)
+        counts = self._hash_counts(tokens)
+        if counts is None:
+            return
+        space = self._namespaces.get(namespace)
+        if space is None:
+            space = self._namespaces[namespace] = _Namespace(self.dim, self.capacity)
+        
+        slot = space.slot_for_insert()
+        if slot < 0:
+            # Вытесняем запись, к которой дольше всего не обращались, вместе с её вкладом в IDF
+            slot = int(np.argmin(space.last_used[:space.size]))
+            space.doc_freq -= space.vectors[slot] > 0
+            space.documents -= 1
+            self.evictions += 1
+        
+        tf = _sublinear_tf(counts)
+        space.doc_freq += tf > 0
+        space.documents += 1
+        space.idf = space.norms = None
+        
+        self._clock += 1
+        space.vectors[slot] = tf
+        space.last_used[slot] = self._clock
+        space.answers[slot] = answer
+        space.signatures[slot] = _signature(tokens)
+    
+    def stats(self) -> Dict[str, int]:
+        """
+        Получить счётчики кэша.
+        
+        Returns:
+            Словарь с количеством попаданий, промахов, вытеснений и размером кэша
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": sum(space.size for space in self._namespaces.values()),
+        }
+    
+    def _hash_counts(self, tokens: List[str]) -> Optional[np.ndarray]:
+        """Возвращает вектор частот хэшированных n-грамм или None для пустого текста."""
+        ngrams = _char_ngrams(tokens)
+        if not ngrams:
+            return None
+        indices = np.fromiter(
+            (zlib.crc32(ngram.encode("utf-8")) % self.dim for ngram in ngrams),
+            dtype=np.int64, count=len(ngrams)
+        )
+        return np.bincount(indices, minlength=self.dim).astype(np.float32)
+
+
+
+def _sublinear_tf(counts: np.ndarray) -> np.ndarray:
+    """Сублинейный TF: 1 + log(частота) для встретившихся n-грамм."""
+    return np.where(counts > 0, 1.0 + np.log(np.maximum(counts, 1.0)), 0.0).astype(np.float32)
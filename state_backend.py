@@ -0,0 +1,396 @@
+"""Хранилища состояния пользователей: контекст диалога, выбранный промпт и состояние FSM."""
+import asyncio
+import hashlib
+import json
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import unquote, urlsplit
+
+from conversation_store import SQLiteConversationStore
+
+logger = logging.getLogger(__name__)
+
+# Запись пользователя с версией: (версия, данные или None, если записи нет)
+VersionedRecord = Tuple[int, Optional[Dict]]
+
+
+class StateBackend(ABC):
+    """Интерфейс хранилища состояния пользователей с оптимистичными версиями.
+    
+    У каждой записи есть версия, которая растёт при каждом сохранении.
+    Новое состояние сохраняется, только если версия в хранилище совпадает
+    с версией, от которой оно было получено; иначе запись изменил кто-то
+    другой (например, другой экземпляр бота) и сохранение отклоняется.
+    """
+    
+    # Хранилище разделяют несколько экземпляров бота: копию записи в памяти
+    # нужно сверять с хранилищем перед обработкой каждого сообщения
+    shared = False
+    # Записи сохраняются между перезапусками процесса
+    persistent = True
+    
+    @abstractmethod
+    async def load(self, user_id: int, known_version: Optional[int] = None) -> Optional[VersionedRecord]:
+        """
+        Загрузить запись пользователя.
+        
+        Args:
+            user_id: ID пользователя Telegram
+            known_version: Версия копии записи в памяти (None - копии нет)
+        
+        Returns:
+            None, если запись не изменилась с known_version, иначе (версия, данные);
+            данные равны None, если записи нет
+        """
+    
+    @abstractmethod
+    async def save_many(self, changes: Dict[int, VersionedRecord]) -> Dict[int, Optional[int]]:
+        """
+        Сохранить пачку записей за одно обращение к хранилищу.
+        
+        Args:
+            changes: Словарь user_id -> (ожидаемая версия, новые данные или None для удаления)
+        
+        Returns:
+            Словарь user_id -> новая версия или None, если версия в хранилище
+            не совпала с ожидаемой (конфликт) и запись не сохранена
+        """
+    
+    def export_records(self) -> Iterator[Tuple[int, VersionedRecord]]:
+        """Записи, которые будут потеряны при остановке процесса (для снимка состояния)."""
+        return iter(())
+    
+    async def close(self) -> None:
+        """Закрыть соединения с хранилищем."""
+
+
+class MemoryStateBackend(StateBackend):
+    """Хранилище в памяти процесса (без сохранения между перезапусками)."""
+    
+    persistent = False
+    
+    def __init__(self):
+        """Инициализация пустого хранилища."""
+        self._records: Dict[int, VersionedRecord] = {}
+    
+    def export_records(self) -> Iterator[Tuple[int, VersionedRecord]]:
+        """Все непустые записи хранилища (см. StateBackend.export_records)."""
+        return ((user_id, record) for user_id, record in self._records.items() if record[1] is not None)
+    
+    async def load(self, user_id: int, known_version: Optional[int] = None) -> Optional[VersionedRecord]:
+        """Загрузить запись пользователя (см. StateBackend.load)."""
+        record = self._records.get(user_id, (0, None))
+        return None if record[0] == known_version else record
+    
+    async def save_many(self, changes: Dict[int, VersionedRecord]) -> Dict[int, Optional[int]]:
+        """Сохранить пачку записей (см. StateBackend.save_many)."""
+        results: Dict[int, Optional[int]] = {}
+        for user_id, (expected, data) in changes.items():
+            version = self._records.get(user_id, (0, None))[0]
+            if version != expected:
+                results[user_id] = None
+                continue
+            # Удалённая запись остаётся с новой версией, чтобы версии не повторялись
+            self._records[user_id] = (version + 1, data)
+            results[user_id] = version + 1
+        return results
+
+
+class SQLiteStateBackend(StateBackend):
+    """Хранилище в локальном файле SQLite (для одного экземпляра бота)."""
+    
+    def __init__(self, db_path: str = "contexts.db"):
+        """
+        Инициализация хранилища.
+        
+        Args:
+            db_path: Путь к файлу базы данных SQLite
+        """
+        self.store = SQLiteConversationStore(db_path)
+    
+    async def load(self, user_id: int, known_version: Optional[int] = None) -> Optional[VersionedRecord]:
+        """Загрузить запись пользователя (см. StateBackend.load)."""
+        record = await asyncio.to_thread(self.store.load, user_id) or (0, None)
+        return None if record[0] == known_version else record
+    
+    async def save_many(self, changes: Dict[int, VersionedRecord]) -> Dict[int, Optional[int]]:
+        """Сохранить пачку записей одной транзакцией (см. StateBackend.save_many)."""
+        return await asyncio.to_thread(self.store.save_many, changes)
+    
+    async def close(self) -> None:
+        """Закрыть соединение с базой данных."""
+        self.store.close()
+
+
+class RespError(Exception):
+    """Ошибка, которую вернул сервер Redis."""
+
+
+def _encode_command(args: Sequence) -> bytes:
+    """Кодирует команду в формате RESP (массив строк)."""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    """Читает один ответ RESP; ошибка сервера возвращается как объект RespError."""
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Соединение закрыто сервером")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode("utf-8")
+    if kind == b"-":
+        return RespError(payload.decode("utf-8"))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Неизвестный тип ответа RESP: {line[:32]!r}")
+
+
+class RespClient:
+    """Минимальный асинхронный клиент протокола Redis (RESP) с конвейерной отправкой.
+    
+    Все запросы идут через одно соединение: команды отправляются сразу,
+    не дожидаясь ответов на предыдущие, а ответы сопоставляются с запросами
+    по порядку. Пачка команд отправляется одной записью и стоит одно обращение к серверу.
+    """
+    
+    def __init__(self, host: str = "127.0.0.1", port: int = 6379,
+                 password: Optional[str] = None, db: int = 0,
+                 connect_timeout: float = 5.0):
+        """
+        Инициализация клиента (соединение устанавливается при первом запросе).
+        
+        Args:
+            host: Адрес сервера
+            port: Порт сервера
+            password: Пароль (None - без авторизации)
+            db: Номер базы данных
+            connect_timeout: Таймаут установки соединения (сек)
+        """
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.connect_timeout = connect_timeout
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._connect_lock = asyncio.Lock()
+    
+    async def execute(self, *commands: Sequence) -> List:
+        """
+        Выполнить пачку команд за одно обращение к серверу.
+        
+        Args:
+            *commands: Команды в виде последовательностей аргументов
+        
+        Returns:
+            Список ответов в порядке команд (ошибки сервера - объекты RespError)
+        
+        Raises:
+            ConnectionError: Соединение с сервером недоступно или разорвано
+        """
+        writer = await self._connection()
+        futures = self._send(writer, commands)
+        replies = await asyncio.gather(writer.drain(), *futures)
+        return replies[1:]
+    
+    async def close(self) -> None:
+        """Закрыть соединение."""
+        writer, self._writer = self._writer, None
+        if self._read_task is not None:
+            self._read_task.cancel()
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self._fail_waiters(ConnectionError("Клиент закрыт"))
+    
+    def _send(self, writer: asyncio.StreamWriter, commands: Sequence[Sequence]) -> List[asyncio.Future]:
+        """Отправляет команды и возвращает ожидания ответов на них."""
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in commands]
+        # Ожидания ставятся в очередь в том же порядке, в котором команды уходят в сокет
+        self._waiters.extend(futures)
+        writer.write(b"".join(_encode_command(command) for command in commands))
+        return futures
+    
+    async def _connection(self) -> asyncio.StreamWriter:
+        """Возвращает открытое соединение, устанавливая его при необходимости."""
+        if self._writer is not None and not self._writer.is_closing():
+            return self._writer
+        async with self._connect_lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return self._writer
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.connect_timeout
+            )
+            self._read_task = asyncio.create_task(self._read_loop(reader, writer))
+            
+            setup = []
+            if self.password:
+                setup.append(("AUTH", self.password))
+            if self.db:
+                setup.append(("SELECT", self.db))
+            if setup:
+                for reply in await asyncio.gather(*self._send(writer, setup)):
+                    if isinstance(reply, RespError):
+                        writer.close()
+                        raise ConnectionError(f"Ошибка подключения к хранилищу состояния: {reply}")
+            
+            self._writer = writer
+            logger.info(f"Подключено хранилище состояния {self.host}:{self.port}/{self.db}")
+            return writer
+    
+    async def _read_loop(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Читает ответы сервера и передаёт их ожидающим запросам по порядку."""
+        try:
+            while True:
+                reply = await _read_reply(reader)
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(reply)
+        except asyncio.CancelledError:
+            raise
+        except (ConnectionError, OSError, ValueError, IndexError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"Соединение с хранилищем состояния разорвано: {e}")
+            writer.close()
+            if self._writer is writer:
+                self._writer = None
+            self._fail_waiters(ConnectionError(f"Соединение с хранилищем состояния разорвано: {e}"))
+    
+    def _fail_waiters(self, error: Exception) -> None:
+        """Завершает все ожидающие запросы ошибкой."""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(error)
+
+
+# Загрузка записи: данные передаются, только если версия отличается от известной клиенту
+_LOAD_SCRIPT = """
+local version = redis.call('HGET', KEYS[1], 'v')
+if not version then return {0} end
+if version == ARGV[1] then return {tonumber(version)} end
+return {tonumber(version), redis.call('HGET', KEYS[1], 'd')}
+"""
+
+# Сохранение записи, если её версия не изменилась; пустые данные означают удаление
+_SAVE_SCRIPT = """
+local version = tonumber(redis.call('HGET', KEYS[1], 'v') or '0')
+if version ~= tonumber(ARGV[1]) then return -1 end
+redis.call('HSET', KEYS[1], 'v', version + 1, 'd', ARGV[2])
+if tonumber(ARGV[3]) > 0 then redis.call('EXPIRE', KEYS[1], ARGV[3]) end
+return version + 1
+"""
+
+
+class RedisStateBackend(StateBackend):
+    """Хранилище в сервере с протоколом Redis, общее для нескольких экземпляров бота.
+    
+    Запись пользователя - хэш с полями v (версия) и d (данные в JSON).
+    Загрузка и проверка версии при сохранении выполняются Lua-скриптами на
+    сервере, поэтому каждая операция - одна команда, а пачка сохранений -
+    одно обращение к серверу.
+    """
+    
+    shared = True
+    
+    def __init__(self, url: str = "redis://127.0.0.1:6379/0", key_prefix: str = "bot:",
+                 ttl: int = 0):
+        """
+        Инициализация хранилища.
+        
+        Args:
+            url: Адрес сервера вида redis://[:пароль@]хост[:порт][/база]
+            key_prefix: Префикс ключей записей
+            ttl: Время жизни записи без изменений в секундах (0 - без ограничения)
+        """
+        parts = urlsplit(url)
+        self.client = RespClient(
+            host=parts.hostname or "127.0.0.1",
+            port=parts.port or 6379,
+            password=unquote(parts.password) if parts.password else None,
+            db=int(parts.path.lstrip("/") or 0),
+        )
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self._scripts = {
+            script: hashlib.sha1(script.encode("utf-8")).hexdigest()
+            for script in (_LOAD_SCRIPT, _SAVE_SCRIPT)
+        }
+    
+    async def load(self, user_id: int, known_version: Optional[int] = None) -> Optional[VersionedRecord]:
+        """Загрузить запись пользователя одной командой (см. StateBackend.load)."""
+        known = "" if known_version is None else str(known_version)
+        reply = (await self._eval(_LOAD_SCRIPT, [(self._key(user_id), known)]))[0]
+        version = reply[0]
+        if len(reply) == 1:
+            # Данные не переданы: записи нет или версия совпала с известной
+            return None if version == known_version else (version, None)
+        data = reply[1]
+        return version, (json.loads(data) if data else None)
+    
+    async def save_many(self, changes: Dict[int, VersionedRecord]) -> Dict[int, Optional[int]]:
+        """Сохранить пачку записей за одно обращение к серверу (см. StateBackend.save_many)."""
+        user_ids = list(changes)
+        calls = [
+            (
+                self._key(user_id),
+                changes[user_id][0],
+                json.dumps(changes[user_id][1], ensure_ascii=False) if changes[user_id][1] is not None else "",
+                self.ttl,
+            )
+            for user_id in user_ids
+        ]
+        replies = await self._eval(_SAVE_SCRIPT, calls)
+        return {user_id: (reply if reply >= 0 else None) for user_id, reply in zip(user_ids, replies)}
+    
+    async def close(self) -> None:
+        """Закрыть соединение с сервером."""
+        await self.client.close()
+    
+    def _key(self, user_id: int) -> str:
+        """Ключ записи пользователя."""
+        return f"{self.key_prefix}user:{user_id}"
+    
+    async def _eval(self, script: str, calls: List[Tuple]) -> List:
+        """
+        Выполнить скрипт для каждого набора аргументов (ключ, аргументы...) одной пачкой.
+        
+        Скрипт вызывается по хэшу; если сервер его ещё не знает (после
+        перезапуска), вызовы повторяются с полным текстом скрипта.
+        """
+        sha = self._scripts[script]
+        replies = await self.client.execute(*(("EVALSHA", sha, 1) + call for call in calls))
+        missing = [
+            index for index, reply in enumerate(replies)
+            if isinstance(reply, RespError) and str(reply).startswith("NOSCRIPT")
+        ]
+        if missing:
+            retried = await self.client.execute(*(("EVAL", script, 1) + calls[index] for index in missing))
+            for index, reply in zip(missing, retried):
+                replies[index] = reply
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
@@ -0,0 +1,225 @@
+"""Потоковая выдача ответа модели в Telegram с редактированием сообщения."""
+import logging
+import time
+from typing import List, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+import metrics
+from telegram_sender import TELEGRAM_MAX_LENGTH, TelegramSender
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingReply:
+    """Ответ, который постепенно дописывается в сообщения Telegram по мере генерации."""
+    
+    def __init__(self, message: Message, sender: TelegramSender, edit_interval: float = 1.0,
+                 placeholder: str = "⏳", max_length: int = TELEGRAM_MAX_LENGTH):
+        """
+        Инициализация потокового ответа.
+        
+        Args:
+            message: Сообщение пользователя, на которое отвечаем
+            sender: Очередь отправки с ограничением частоты
+            edit_interval: Минимальный интервал между редактированиями (сек)
+            placeholder: Текст сообщения-заглушки до появления первых токенов
+            max_length: Максимальная длина одного сообщения
+        """
+        self.message = message
+        self.sender = sender
+        self.edit_interval = edit_interval
+        self.placeholder = placeholder
+        self.max_length = max_length
+        
+        self._parts: List[str] = []  # Полученные фрагменты ответа
+        self._text = ""  # Текст текущего (последнего) сообщения
+        self._shown = ""  # Текст, который сейчас отображается в текущем сообщении
+        self._current: Optional[Message] = None
+        self._next_edit_at = 0.0
+    
+    @property
+    def text(self) -> str:
+        """Полный текст ответа, полученный на данный момент."""
+        return "".join(self._parts)
+    
+    async def start(self) -> None:
+        """Отправляет сообщение-заглушку, которое будет заменяться текстом ответа."""
+        self._current = await self._send_new(self.placeholder)
+        self._next_edit_at = time.monotonic() + self.edit_interval
+    
+    async def append(self, delta: str) -> None:
+        """
+        Добавляет фрагмент ответа и при необходимости обновляет сообщение.
+        
+        Редактирование выполняется не чаще одного раза в edit_interval секунд,
+        чтобы не превышать лимиты Telegram на редактирование сообщений.
+        
+        Args:
+            delta: Новый фрагмент текста от модели
+        """
+        if not delta:
+            return
+        self._parts.append(delta)
+        self._text += delta
+        
+        if len(self._text) > self.max_length:
+            await self._roll_over()
+        elif time.monotonic() >= self._next_edit_at:
+            await self._edit(self._text)
+    
+    async def finish(self) -> str:
+        """
+        Отправляет окончательный текст ответа.
+        
+        Returns:
+            Полный текст ответа
+        """
+        if self._text and self._text != self._shown:
+            await self._edit(self._text, force=True)
+        return self.text
+    
+    async def abort(self, note: str = "⚠️ Ответ прерван") -> None:
+        """
+        Завершает ответ при ошибке генерации.
+        
+        Если текст ещё не появился, сообщение-заглушка удаляется, иначе
+        к уже показанному тексту добавляется пометка о прерывании.
+        
+        Args:
+            note: Пометка, добавляемая к частично показанному ответу
+        """
+        if self._current is None:
+            return
+        try:
+            if not self._text:
+                await self._current.delete()
+                self._current = None
+            else:
+                await self._edit(f"{self._text}\n\n{note}"[-self.max_length:], force=True)
+        except Exception as e:
+            logger.warning(f"Не удалось завершить прерванный ответ: {e}")
+    
+    async def _roll_over(self) -> None:
+        """Завершает переполненное сообщение и переносит остаток текста в новое."""
+        while len(self._text) > self.max_length:
+            cut = self._find_cut(self._text)
+            head, rest = self._text[:cut], self._text[cut:]
+            # Разделитель (перенос строки или пробел) в начало нового сообщения не переносим
+            self._text = rest[1:] if rest[:1] in ("\n", " ") else rest
+            await self._edit(head, force=True)
+            self._current = await self._send_new(self._text[:self.max_length] or self.placeholder)
+            self._shown = self._text[:self.max_length]
+        self._next_edit_at = time.monotonic() + self.edit_interval
+    
+    def _find_cut(self, text: str) -> int:
+        """Находит место разрыва не дальше max_length: перенос строки, пробел или жёсткий разрез."""
+        for separator in ("\n", " "):
+            cut = text.rfind(separator, 0, self.max_length)
+            if cut > 0:
+                return cut
+        return self.max_length
+    
+    async def _send_new(self, text: str) -> Message:
+        """Отправляет новое сообщение через очередь отправки с учётом ограничения частоты Telegram."""
+        return await self.sender.call(
+            self.message.chat.id, lambda: self.message.answer(text, parse_mode=None)
+        )
+    
+    async def _edit(self, text: str, force: bool = False) -> None:
+        """
+        Редактирует текущее сообщение.
+        
+        Args:
+            text: Новый текст сообщения
+            force: Дождаться возможности редактирования при ограничении частоты,
+                а не пропускать обновление
+        """
+        if self._current is None or text == self._shown:
+            return
+        chat_id = self.message.chat.id
+        current = self._current
+        try:
+            if force:
+                await self.sender.call(chat_id, lambda: current.edit_text(text, parse_mode=None))
+            elif self.sender.try_acquire(chat_id):
+                started = time.monotonic()
+                await current.edit_text(text, parse_mode=None)
+                metrics.TELEGRAM_SEND_LATENCY.observe(time.monotonic() - started)
+            else:
+                # Лимит отправки исчерпан - промежуточное обновление пропускаем
+                return
+            self._shown = text
+        except TelegramRetryAfter as e:
+            # Промежуточное обновление просто откладываем
+            self.sender.pause(chat_id, e.retry_after)
+            self._next_edit_at = time.monotonic() + e.retry_after
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+            self._shown = text
+        self._next_edit_at = time.monotonic() + self.edit_interval
+
+
+class ProgressMessage:
+    """Сообщение о ходе длительной обработки, которое обновляется не чаще edit_interval."""
+    
+    def __init__(self, message: Message, sender: TelegramSender, edit_interval: float = 1.0):
+        """
+        Инициализация сообщения о ходе обработки.
+        
+        Args:
+            message: Сообщение пользователя, на которое отвечаем
+            sender: Очередь отправки с ограничением частоты
+            edit_interval: Минимальный интервал между редактированиями (сек)
+        """
+        self.message = message
+        self.sender = sender
+        self.edit_interval = edit_interval
+        self._current: Optional[Message] = None
+        self._shown = ""
+        self._next_edit_at = 0.0
+    
+    async def start(self, text: str) -> None:
+        """Отправляет сообщение с начальным текстом."""
+        self._current = await self.sender.call(
+            self.message.chat.id, lambda: self.message.answer(text, parse_mode=None)
+        )
+        self._shown = text
+        self._next_edit_at = time.monotonic() + self.edit_interval
+    
+    async def update(self, text: str) -> None:
+        """
+        Обновляет текст сообщения.
+        
+        Обновление пропускается, если с прошлого прошло меньше edit_interval
+        или лимит отправки в чат исчерпан: важен только последний текст.
+        
+        Args:
+            text: Новый текст сообщения
+        """
+        if self._current is None or text == self._shown or time.monotonic() < self._next_edit_at:
+            return
+        chat_id = self.message.chat.id
+        if not self.sender.try_acquire(chat_id):
+            return
+        try:
+            await self._current.edit_text(text, parse_mode=None)
+            self._shown = text
+        except TelegramRetryAfter as e:
+            self.sender.pause(chat_id, e.retry_after)
+        except TelegramBadRequest as e:
+            logger.warning(f"Не удалось обновить сообщение о ходе обработки: {e}")
+        self._next_edit_at = time.monotonic() + self.edit_interval
+    
+    async def delete(self) -> None:
+        """Удаляет сообщение (ошибки удаления не прерывают обработку)."""
+        if self._current is None:
+            return
+        try:
+            await self._current.delete()
+        except Exception as e:
+            logger.warning(f"Не удалось удалить сообщение о ходе обработки: {e}")
+        self._current = None
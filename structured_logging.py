@@ -0,0 +1,221 @@
+"""Неблокирующее логирование: очередь с фоновой записью, JSON-записи, идентификаторы запросов и выборка."""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+import zlib
+from contextvars import ContextVar, Token
+from typing import Dict, Mapping, Optional, TextIO
+
+# Идентификатор обрабатываемого обновления: попадает во все записи, сделанные при его обработке
+_correlation_id: ContextVar[Optional[str]] = ContextVar("correlation_id", default=None)
+
+# Атрибуты, которые есть у любой записи; остальные переданы через extra и выводятся в JSON
+_STANDARD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message", "asctime", "correlation_id",
+}
+
+# Формат текстовых записей
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s"
+
+
+def set_correlation_id(value: Optional[str]) -> Token:
+    """
+    Задать идентификатор запроса для текущей задачи asyncio и порождённых ею задач.
+    
+    Args:
+        value: Идентификатор (например, номер обновления Telegram)
+    
+    Returns:
+        Токен для восстановления прежнего значения
+    """
+    return _correlation_id.set(value)
+
+
+def get_correlation_id() -> Optional[str]:
+    """Идентификатор запроса текущей задачи или None."""
+    return _correlation_id.get()
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет к записи идентификатор запроса и отбрасывает часть частых записей.
+    
+    Выборка применяется только к записям ниже WARNING. Решение принимается
+    по идентификатору запроса, поэтому для выбранного запроса сохраняются
+    все его записи, а для отброшенного - ни одной.
+    """
+    
+    def __init__(self, sample_rates: Optional[Mapping[str, float]] = None):
+        """
+        Инициализация фильтра.
+        
+        Args:
+            sample_rates: Доля сохраняемых записей (0.0-1.0) по имени логгера;
+                правило для "aiogram" действует и на "aiogram.event"
+        """
+        super().__init__()
+        self.sample_rates = dict(sample_rates or {})
+        self.sampled_out = 0  # Записи, отброшенные выборкой
+        self._rates: Dict[str, float] = {}  # Доля для каждого встреченного имени логгера
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        correlation_id = _correlation_id.get()
+        record.correlation_id = correlation_id or "-"
+        if record.levelno >= logging.WARNING or not self.sample_rates:
+            return True
+        rate = self._rates.get(record.name)
+        if rate is None:
+            rate = self._rates[record.name] = self._resolve_rate(record.name)
+        if rate >= 1.0:
+            return True
+        if correlation_id is not None:
+            keep = zlib.crc32(correlation_id.encode()) % 10000 < rate * 10000
+        else:
+            keep = random.random() < rate
+        if not keep:
+            self.sampled_out += 1
+        return keep
+    
+    def _resolve_rate(self, name: str) -> float:
+        """Доля для логгера: правило для самого длинного совпадающего префикса имени."""
+        while name:
+            if name in self.sample_rates:
+                return self.sample_rates[name]
+            name = name.rpartition(".")[0]
+        return 1.0
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Передаёт записи в ограниченную очередь, не форматируя их и не блокируясь.
+    
+    Сообщение собирается из шаблона и аргументов только в фоновом потоке
+    записи, поэтому аргументы вызова логгера не должны меняться после
+    вызова (строки, числа и другие неизменяемые значения). Если очередь
+    заполнена, запись отбрасывается и учитывается в счётчике.
+    """
+    
+    def __init__(self, record_queue: queue.Queue):
+        """Инициализация обработчика для очереди record_queue."""
+        super().__init__(record_queue)
+        self.dropped = 0  # Записи, отброшенные из-за переполнения очереди
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+    
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """Фоновый поток записи; при остановке ждёт места в очереди для сигнала завершения."""
+    
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись как одну строку JSON."""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+                    + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        correlation_id = getattr(record, "correlation_id", "-")
+        if correlation_id != "-":
+            entry["correlation_id"] = correlation_id
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LoggingPipeline:
+    """Очередь записей и фоновый поток, записывающий их в поток вывода."""
+    
+    def __init__(self, handler: DroppingQueueHandler, context_filter: ContextFilter,
+                 output: logging.Handler):
+        """Инициализация по готовым обработчику очереди, фильтру и обработчику вывода."""
+        self.handler = handler
+        self.filter = context_filter
+        self.output = output
+        self.listener = _QueueListener(handler.queue, output)
+        self._running = False
+    
+    @property
+    def dropped(self) -> int:
+        """Записи, отброшенные из-за переполнения очереди."""
+        return self.handler.dropped
+    
+    @property
+    def sampled_out(self) -> int:
+        """Записи, отброшенные выборкой."""
+        return self.filter.sampled_out
+    
+    def start(self) -> None:
+        """Направить записи корневого логгера в очередь и запустить фоновый поток."""
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(self.handler)
+        self.listener.start()
+        self._running = True
+    
+    def stop(self) -> None:
+        """Записать оставшиеся записи и остановить фоновый поток; дальнейшие записи пишутся сразу."""
+        if not self._running:
+            return
+        self._running = False
+        root = logging.getLogger()
+        root.removeHandler(self.handler)
+        self.output.addFilter(self.filter)
+        root.addHandler(self.output)
+        self.listener.stop()
+
+
+def setup_logging(level: str = "INFO", json_format: bool = False, queue_size: int = 10000,
+                  sample_rates: Optional[Mapping[str, float]] = None,
+                  stream: Optional[TextIO] = None) -> LoggingPipeline:
+    """
+    Настроить корневой логгер: записи передаются через очередь в фоновый поток.
+    
+    Вызов логгера в обработчике только кладёт запись в очередь, поэтому
+    медленный диск или stdout не задерживают цикл событий. Оставшиеся
+    записи дописываются при завершении процесса.
+    
+    Args:
+        level: Уровень логирования
+        json_format: Писать записи в JSON (иначе текстом)
+        queue_size: Максимальное количество записей в очереди
+        sample_rates: Доля сохраняемых записей ниже WARNING по имени логгера
+        stream: Поток вывода (по умолчанию stderr)
+    
+    Returns:
+        Настроенный конвейер логирования
+    """
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    
+    handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    context_filter = ContextFilter(sample_rates)
+    handler.addFilter(context_filter)
+    
+    logging.getLogger().setLevel(level)
+    pipeline = LoggingPipeline(handler, context_filter, output)
+    pipeline.start()
+    atexit.register(pipeline.stop)
+    return pipeline
@@ -0,0 +1,146 @@
+"""Фоновое сжатие длинных диалогов: старые сообщения заменяются кратким содержанием."""
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+import metrics
+from api_client import OpenAIClient
+from context_manager import ContextManager, ContextMessage
+
+logger = logging.getLogger(__name__)
+
+# Заголовок системного сообщения с кратким содержанием в контексте
+SUMMARY_HEADER = "Краткое содержание предыдущей части диалога:\n"
+
+# Инструкция модели, составляющей краткое содержание
+_INSTRUCTION = (
+    "Ты сжимаешь историю диалога пользователя с ассистентом. Составь краткое содержание, "
+    "из которого ассистент сможет продолжить разговор: факты о пользователе и его задаче, "
+    "принятые решения, важные детали (имена, числа, код, ссылки) и открытые вопросы. "
+    "Если дано прежнее краткое содержание, объедини его с новыми сообщениями. "
+    "Пиши на языке диалога, не длиннее {max_words} слов, без вступлений."
+)
+
+# Подписи ролей в тексте диалога, передаваемом модели
+_ROLE_NAMES = {"user": "Пользователь", "assistant": "Ассистент"}
+
+
+def format_transcript(messages: List[ContextMessage]) -> str:
+    """
+    Преобразовать сообщения контекста в текст диалога для сжатия.
+    
+    Args:
+        messages: Сообщения контекста (прежнее краткое содержание - системное сообщение)
+    
+    Returns:
+        Текст диалога
+    """
+    parts = []
+    for message in messages:
+        if message.role == "system":
+            parts.append(message.content)
+        else:
+            parts.append(f"{_ROLE_NAMES.get(message.role, message.role)}: {message.content}")
+    return "\n\n".join(parts)
+
+
+class ConversationSummarizer:
+    """Сжимает контексты, превысившие порог, в фоновых задачах.
+    
+    Старые сообщения (вместе с прежним кратким содержанием) отправляются
+    более дешёвой модели, а её ответ становится системным сообщением в
+    начале контекста. Сжатие выполняется после отправки ответа, вне
+    планировщика запросов пользователей, поэтому не задерживает ответы.
+    Если сжатие не удалось, контекст сокращается как обычно - удалением
+    самых старых сообщений.
+    """
+    
+    def __init__(self, context_manager: ContextManager, client: OpenAIClient, model: str,
+                 trigger_messages: int = 14, trigger_tokens: Optional[int] = None,
+                 keep_messages: int = 6, max_words: int = 250, max_concurrency: int = 2,
+                 timeout: float = 60.0):
+        """
+        Инициализация сжатия.
+        
+        Args:
+            context_manager: Менеджер контекста
+            client: Клиент API
+            model: Модель, составляющая краткое содержание
+            trigger_messages: Сжимать контекст, в котором больше сообщений
+            trigger_tokens: Сжимать контекст, размер которого больше (в токенах; None - не учитывать)
+            keep_messages: Количество последних сообщений, которые остаются без сжатия
+            max_words: Максимальная длина краткого содержания (слов)
+            max_concurrency: Максимальное количество одновременных запросов на сжатие
+            timeout: Таймаут запроса на сжатие (сек)
+        """
+        self.context_manager = context_manager
+        self.client = client
+        self.model = model
+        self.trigger_messages = trigger_messages
+        self.trigger_tokens = trigger_tokens
+        self.keep_messages = keep_messages
+        self.max_words = max_words
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: Dict[int, asyncio.Task] = {}
+    
+    def maybe_compact(self, user_id: int) -> bool:
+        """
+        Запустить сжатие контекста пользователя в фоне, если он превысил порог.
+        
+        Args:
+            user_id: ID пользователя Telegram
+        
+        Returns:
+            True, если сжатие запущено
+        """
+        if user_id in self._tasks:
+            return False
+        length = self.context_manager.get_context_length(user_id)
+        tokens = self.context_manager.get_context_tokens(user_id)
+        if length <= self.trigger_messages and (self.trigger_tokens is None or tokens <= self.trigger_tokens):
+            return False
+        task = asyncio.create_task(self._compact(user_id))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(user_id, None))
+        return True
+    
+    async def close(self) -> None:
+        """Отменить незавершённые сжатия (контексты остаются без изменений)."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def _compact(self, user_id: int) -> None:
+        """Составляет краткое содержание старых сообщений и заменяет их им."""
+        async with self._semaphore:
+            candidate = self.context_manager.get_compaction_candidate(user_id, self.keep_messages)
+            if candidate is None:
+                return
+            context, head = candidate
+            summary = await self.client.get_response(
+                [
+                    {"role": "system", "content": _INSTRUCTION.format(max_words=self.max_words)},
+                    {"role": "user", "content": format_transcript(head)},
+                ],
+                timeout=self.timeout,
+                prompt_id="summary",
+                model=self.model,
+                tier="summary",
+                user_id=user_id,
+            )
+        if not summary:
+            metrics.CONTEXT_COMPACTIONS.labels("failed").inc()
+            logger.warning(f"Пользователь {user_id}: не удалось сжать контекст")
+            return
+        if not self.context_manager.apply_summary(user_id, context, head, SUMMARY_HEADER + summary.strip()):
+            # Пока шло сжатие, контекст очищен или заменён
+            metrics.CONTEXT_COMPACTIONS.labels("discarded").inc()
+            return
+        metrics.CONTEXT_COMPACTIONS.labels("applied").inc()
+        logger.info(
+            f"Пользователь {user_id}: {len(head)} сообщений контекста заменены кратким содержанием. "
+            f"Контекст: {self.context_manager.get_context_length(user_id)} сообщений "
+            f"({self.context_manager.get_context_tokens(user_id)} токенов)"
+        )
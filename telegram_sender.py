@@ -0,0 +1,332 @@
+"""Отправка сообщений в Telegram с учётом ограничений частоты и разбиение длинных текстов."""
+import asyncio
+import logging
+import re
+import time
+from typing import Awaitable, Callable, Dict, List, TypeVar
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Message
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Максимальная длина сообщения в Telegram
+TELEGRAM_MAX_LENGTH = 4096
+
+# Строка, открывающая или закрывающая блок кода (```python, ```)
+_FENCE_RE = re.compile(r"^[ \t]*```.*$", re.MULTILINE)
+_FENCE_CLOSE = "\n```"
+# Максимальная длина строки открытия блока, переносимой в следующую часть
+_FENCE_MAX_LENGTH = 32
+
+
+def split_message(text: str, max_length: int = TELEGRAM_MAX_LENGTH) -> List[str]:
+    """
+    Разбить текст на части не длиннее max_length.
+    
+    Разрыв выбирается по переносу строки, затем по пробелу и только потом
+    посреди слова. Если разрыв попадает внутрь блока кода (```), блок
+    закрывается в конце части и открывается заново в начале следующей.
+    Каждый символ просматривается ограниченное число раз, поэтому время
+    работы линейно от длины текста.
+    
+    Args:
+        text: Исходный текст
+        max_length: Максимальная длина одной части
+    
+    Returns:
+        Список частей текста
+    """
+    parts: List[str] = []
+    start, length = 0, len(text)
+    fence = ""  # Строка открытия блока кода, продолжающегося из предыдущей части
+    
+    while start < length:
+        prefix = f"{fence}\n" if fence else ""
+        room = max_length - len(prefix)
+        if length - start <= room:
+            parts.append(prefix + text[start:])
+            break
+        
+        # Оставляем место, чтобы закрыть блок кода, если часть закончится внутри него
+        room = max(1, room - len(_FENCE_CLOSE))
+        cut = _find_cut(text, start, start + room)
+        chunk = text[start:cut]
+        fence = _open_fence_after(chunk, fence)
+        parts.append(prefix + chunk + (_FENCE_CLOSE if fence else ""))
+        
+        # Разделитель (перенос строки или пробел) в начало следующей части не переносим
+        start = cut + 1 if cut < length and text[cut] in "\n " else cut
+    
+    return parts
+
+
+def _find_cut(text: str, start: int, end: int) -> int:
+    """Находит место разрыва в text[start:end]: перенос строки, пробел или жёсткий разрез.
+    
+    Разрыв ищется только во второй половине окна, поэтому каждая часть
+    занимает не меньше половины допустимой длины.
+    """
+    lower = start + (end - start) // 2
+    for separator in ("\n", " "):
+        cut = text.rfind(separator, lower, end)
+        if cut > start:
+            return cut
+    return end
+
+
+def _open_fence_after(chunk: str, fence: str) -> str:
+    """Возвращает строку открытия блока кода, незакрытого в конце chunk, или пустую строку."""
+    for match in _FENCE_RE.finditer(chunk):
+        fence = "" if fence else match.group().strip()[:_FENCE_MAX_LENGTH]
+    return fence
+
+
+class TokenBucket:
+    """Ограничитель частоты «корзина токенов» с резервированием в долг.
+    
+    Каждый запрос забирает токен сразу, даже если корзина пуста, и получает
+    время ожидания до своей очереди: ожидающие обслуживаются в порядке
+    обращения без отдельной задачи-обработчика.
+    """
+    
+    __slots__ = ("rate", "capacity", "_tokens", "_updated")
+    
+    def __init__(self, rate: float, capacity: float):
+        """
+        Инициализация корзины.
+        
+        Args:
+            rate: Скорость пополнения (токенов в секунду)
+            capacity: Максимальное количество накопленных токенов (допустимый всплеск)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+    
+    def reserve(self) -> float:
+        """
+        Забрать токен.
+        
+        Returns:
+            Время (сек), которое нужно подождать перед отправкой
+        """
+        self._refill()
+        self._tokens -= 1
+        return -self._tokens / self.rate if self._tokens < 0 else 0.0
+    
+    def try_acquire(self) -> bool:
+        """Забрать токен, только если он доступен прямо сейчас."""
+        if not self.ready():
+            return False
+        self._tokens -= 1
+        return True
+    
+    def ready(self) -> bool:
+        """Проверить, доступен ли токен прямо сейчас."""
+        self._refill()
+        return self._tokens >= 1
+    
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены ближайшие seconds секунд (например, после ответа 429)."""
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+    
+    def is_full(self) -> bool:
+        """Проверить, что корзина полностью пополнилась (состояние неотличимо от новой)."""
+        self._refill()
+        return self._tokens >= self.capacity
+    
+    def _refill(self) -> None:
+        """Добавляет токены, накопившиеся с момента последнего обращения."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class _ChatState:
+    """Ограничитель частоты и очередь отправки одного чата."""
+    
+    __slots__ = ("bucket", "lock", "users")
+    
+    def __init__(self, bucket: TokenBucket):
+        """Создаёт состояние чата с заданной корзиной токенов."""
+        self.bucket = bucket
+        self.lock = asyncio.Lock()  # Очередь многочастных ответов: части разных ответов не перемешиваются
+        self.users = 0  # Количество отправок, ожидающих или выполняющих lock
+
+
+class TelegramSender:
+    """Очередь исходящих сообщений Telegram.
+    
+    Частота отправки ограничивается корзинами токенов для каждого чата
+    и для бота в целом; ответ 429 (flood wait) приостанавливает отправку
+    в чат на указанное Telegram время, после чего запрос повторяется.
+    Части одного ответа отправляются строго по порядку.
+    """
+    
+    # Как часто (в отправках) удалять состояния неактивных чатов
+    PRUNE_EVERY = 1000
+    
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0,
+                 group_rate: float = 20 / 60, chat_burst: float = 3,
+                 max_retries: int = 5):
+        """
+        Инициализация очереди отправки.
+        
+        Args:
+            global_rate: Максимальная частота отправки для всего бота (сообщений в секунду)
+            chat_rate: Максимальная частота отправки в личный чат (сообщений в секунду)
+            group_rate: Максимальная частота отправки в группу (сообщений в секунду)
+            chat_burst: Количество сообщений, которое можно отправить в чат без ожидания
+            max_retries: Максимальное количество повторов после ответа 429
+        """
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, _ChatState] = {}
+        self._calls = 0
+        
+        self.sent = 0
+        self.flood_waits = 0
+        self.total_delay = 0.0
+    
+    async def call(self, chat_id: int, request: Callable[[], Awaitable[T]]) -> T:
+        """
+        Выполнить запрос к Telegram с учётом ограничений частоты.
+        
+        Args:
+            chat_id: ID чата, в который отправляется сообщение
+            request: Функция, создающая корутину запроса (вызывается при каждой попытке)
+        
+        Returns:
+            Результат запроса
+        
+        Raises:
+            TelegramRetryAfter: Ограничение частоты не снято после max_retries повторов
+        """
+        chat = self._chat(chat_id)
+        attempt = 0
+        while True:
+            delay = chat.bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            global_delay = self._global.reserve()
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+            self.total_delay += delay + global_delay
+            metrics.TELEGRAM_SEND_WAIT.observe(delay + global_delay)
+            
+            started = time.monotonic()
+            try:
+                result = await request()
+            except TelegramRetryAfter as e:
+                self.flood_waits += 1
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logger.warning(f"Чат {chat_id}: ограничение частоты Telegram, повтор через {e.retry_after} сек")
+                chat.bucket.pause(e.retry_after)
+                continue
+            
+            metrics.TELEGRAM_SEND_LATENCY.observe(time.monotonic() - started)
+            self.sent += 1
+            self._calls += 1
+            if self._calls % self.PRUNE_EVERY == 0:
+                self._prune()
+            return result
+    
+    def try_acquire(self, chat_id: int) -> bool:
+        """
+        Занять место для необязательной отправки (например, промежуточного
+        редактирования), только если лимиты позволяют сделать это сразу.
+        
+        Args:
+            chat_id: ID чата
+        
+        Returns:
+            True, если отправку можно выполнить без ожидания
+        """
+        chat = self._chat(chat_id)
+        if not (chat.bucket.ready() and self._global.ready()):
+            return False
+        chat.bucket.try_acquire()
+        self._global.try_acquire()
+        return True
+    
+    def pause(self, chat_id: int, seconds: float) -> None:
+        """
+        Приостановить отправку в чат (после ответа 429, полученного вне очереди).
+        
+        Args:
+            chat_id: ID чата
+            seconds: Длительность паузы (сек)
+        """
+        self._chat(chat_id).bucket.pause(seconds)
+    
+    async def send_text(self, message: Message, text: str) -> List[Message]:
+        """
+        Отправить ответ на сообщение, разбив его на части при необходимости.
+        
+        Части отправляются по порядку; другие ответы в этот же чат
+        ждут, пока будут отправлены все части.
+        
+        Args:
+            message: Сообщение пользователя, на которое отвечаем
+            text: Текст ответа
+        
+        Returns:
+            Список отправленных сообщений
+        """
+        chat_id = message.chat.id
+        chat = self._chat(chat_id)
+        chat.users += 1
+        try:
+            async with chat.lock:
+                sent = []
+                for part in split_message(text):
+                    sent.append(await self.call(
+                        chat_id, lambda part=part: message.answer(part, parse_mode=None)
+                    ))
+                return sent
+        finally:
+            chat.users -= 1
+    
+    def stats(self) -> Dict[str, float]:
+        """
+        Получить статистику отправки.
+        
+        Returns:
+            Словарь с количеством отправленных сообщений, ответов 429 и суммарным ожиданием
+        """
+        return {
+            "sent": self.sent,
+            "flood_waits": self.flood_waits,
+            "total_delay": self.total_delay,
+            "chats": len(self._chats),
+        }
+    
+    def _chat(self, chat_id: int) -> _ChatState:
+        """Возвращает состояние чата, создавая его при первом обращении."""
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            # Отрицательные ID принадлежат группам и каналам с более строгим лимитом
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            chat = self._chats[chat_id] = _ChatState(TokenBucket(rate, self.chat_burst))
+        return chat
+    
+    def _prune(self) -> None:
+        """Удаляет состояния чатов, которые не используются и полностью восстановили лимит."""
+        idle = [
+            chat_id for chat_id, chat in self._chats.items()
+            if chat.users == 0 and chat.bucket.is_full()
+        ]
+        for chat_id in idle:
+            del self._chats[chat_id]
@@ -0,0 +1,62 @@
+"""Подсчёт токенов в тексте сообщений."""
+import logging
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - библиотека необязательна
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Кодировка токенизатора моделей семейства o4/gpt-4o
+ENCODING_NAME = "o200k_base"
+
+# Служебные токены, которые API добавляет к каждому сообщению (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """Возвращает токенизатор или None, если tiktoken недоступен."""
+    if tiktoken is None:
+        logger.warning("Библиотека tiktoken не установлена, используется приблизительный подсчёт токенов")
+        return None
+    try:
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить токенизатор {ENCODING_NAME}: {e}. "
+                       f"Используется приблизительный подсчёт токенов")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Подсчитать количество токенов в тексте.
+    
+    Args:
+        text: Текст для подсчёта
+    
+    Returns:
+        Количество токенов (точное при наличии tiktoken, иначе оценка сверху)
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # Для кириллицы токен в среднем короче 3 символов, поэтому оценка с запасом
+    return (len(text) + 2) // 3
+
+
+def count_message_tokens(content: str) -> int:
+    """
+    Подсчитать количество токенов, которое сообщение занимает в запросе к API.
+    
+    Args:
+        content: Текст сообщения
+    
+    Returns:
+        Количество токенов с учётом служебных токенов сообщения
+    """
+    return count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
@@ -0,0 +1,350 @@
+"""Трассировка обработки обновлений: вложенные интервалы (span) и выгрузка в формате OTLP JSON."""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Имя сервиса в выгружаемых трассах
+SERVICE_NAME = "vpf02-telegram-bot"
+
+# Виды интервалов OTLP: внутренний, обработка входящего запроса, исходящий запрос
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+# Статусы OTLP
+_STATUS_OK, _STATUS_ERROR = 1, 2
+
+
+class Span:
+    """Интервал трассы: имя, время начала и окончания, атрибуты и статус."""
+    
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "kind", "start_ns", "end_ns",
+                 "attributes", "error")
+    
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], kind: str,
+                 attributes: Dict[str, Any]):
+        """
+        Инициализация начатого интервала.
+        
+        Args:
+            name: Имя интервала (этап обработки)
+            trace_id: ID трассы (32 шестнадцатеричных символа)
+            parent_id: ID родительского интервала или None для корня трассы
+            kind: Вид интервала ("internal", "server" или "client")
+            attributes: Атрибуты интервала
+        """
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+    
+    def set_attribute(self, key: str, value: Any) -> None:
+        """Задать атрибут интервала."""
+        self.attributes[key] = value
+    
+    def record_error(self, error: BaseException) -> None:
+        """Отметить интервал как завершившийся ошибкой."""
+        self.error = f"{type(error).__name__}: {error}"
+
+
+class _NoopSpan:
+    """Интервал, который не записывается (трассировка выключена или обновление не попало в выборку)."""
+    
+    __slots__ = ()
+    
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+    
+    def record_error(self, error: BaseException) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+# Текущий интервал задачи: родитель для интервалов, открытых в ней и в порождённых задачах
+_current_span: ContextVar[Union[Span, _NoopSpan, None]] = ContextVar("current_span", default=None)
+
+
+def _encode_value(value: Any) -> Dict[str, Any]:
+    """Значение атрибута в формате OTLP JSON."""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def encode_spans(spans: List[Span], service_name: str = SERVICE_NAME) -> Dict[str, Any]:
+    """
+    Пачка интервалов в формате OTLP JSON (ExportTraceServiceRequest).
+    
+    Args:
+        spans: Завершённые интервалы
+        service_name: Имя сервиса
+    
+    Returns:
+        Словарь, готовый к сериализации в JSON
+    """
+    encoded = []
+    for span in spans:
+        item = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": SPAN_KINDS.get(span.kind, 1),
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": key, "value": _encode_value(value)} for key, value in span.attributes.items()],
+            "status": {"code": _STATUS_ERROR, "message": span.error} if span.error else {"code": _STATUS_OK},
+        }
+        if span.parent_id is not None:
+            item["parentSpanId"] = span.parent_id
+        encoded.append(item)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{"scope": {"name": "bot"}, "spans": encoded}],
+        }]
+    }
+
+
+class FileSpanExporter:
+    """Выгрузка трасс в файл: по одной пачке OTLP JSON на строку (как файловый экспорт OpenTelemetry Collector)."""
+    
+    def __init__(self, path: str = "traces.jsonl"):
+        """
+        Инициализация выгрузки.
+        
+        Args:
+            path: Путь к файлу трасс
+        """
+        self.path = path
+    
+    async def export(self, spans: List[Span]) -> None:
+        """Дописать пачку интервалов в файл (в пуле потоков)."""
+        line = (json.dumps(encode_spans(spans), ensure_ascii=False) + "\n").encode("utf-8")
+        await asyncio.to_thread(self._write, line)
+    
+    def _write(self, line: bytes) -> None:
+        """Дописывает строку в файл одной записью, чтобы строки процессов-обработчиков не перемешивались."""
+        with open(self.path, "ab", buffering=0) as f:
+            f.write(line)
+    
+    async def close(self) -> None:
+        """Файл открывается на время записи, закрывать нечего."""
+
+
+class OtlpHttpExporter:
+    """Выгрузка трасс в коллектор по протоколу OTLP/HTTP с телом в JSON."""
+    
+    def __init__(self, endpoint: str, timeout: float = 10.0):
+        """
+        Инициализация выгрузки.
+        
+        Args:
+            endpoint: Адрес приёма трасс (например, http://127.0.0.1:4318/v1/traces)
+            timeout: Таймаут запроса (сек)
+        """
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+    
+    async def export(self, spans: List[Span]) -> None:
+        """Отправить пачку интервалов в коллектор."""
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        async with self._session.post(self.endpoint, json=encode_spans(spans)) as response:
+            if response.status >= 300:
+                raise RuntimeError(f"коллектор ответил {response.status}: {(await response.text())[:200]}")
+    
+    async def close(self) -> None:
+        """Закрыть HTTP-сессию."""
+        if self._session is not None:
+            await self._session.close()
+
+
+class Tracer:
+    """Создание интервалов и их выгрузка пачками в фоне.
+    
+    Интервал открывается блоком with и становится родителем для интервалов,
+    открытых внутри блока, в том числе в задачах, созданных в нём.
+    Завершённые интервалы копятся в памяти и выгружаются фоновой задачей,
+    поэтому трассировка не добавляет записи на диск или в сеть в обработчики.
+    Решение о выборке принимается для корня трассы и действует на всю трассу.
+    """
+    
+    def __init__(self, exporter: Union[FileSpanExporter, OtlpHttpExporter, None] = None,
+                 sample_rate: float = 1.0, max_pending: int = 10000):
+        """
+        Инициализация трассировщика.
+        
+        Args:
+            exporter: Выгрузка трасс (None - трассировка выключена)
+            sample_rate: Доля трассируемых корневых интервалов (0.0-1.0)
+            max_pending: Максимальное количество интервалов, ожидающих выгрузки;
+                лишние отбрасываются
+        """
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.max_pending = max_pending
+        self.dropped = 0  # Интервалы, отброшенные из-за переполнения или ошибки выгрузки
+        self._finished: List[Span] = []
+        self._flush_lock = asyncio.Lock()
+    
+    @property
+    def enabled(self) -> bool:
+        """Трассировка включена."""
+        return self.exporter is not None
+    
+    @contextlib.contextmanager
+    def span(self, name: str, kind: str = "internal", **attributes: Any) -> Iterator[Union[Span, _NoopSpan]]:
+        """
+        Открыть интервал на время выполнения блока with.
+        
+        Исключение, вышедшее из блока, отмечается в статусе интервала.
+        
+        Args:
+            name: Имя интервала
+            kind: Вид интервала ("internal", "server" или "client")
+            **attributes: Атрибуты интервала
+        
+        Yields:
+            Интервал (или заглушка, если он не записывается)
+        """
+        parent = _current_span.get()
+        if self.exporter is None or parent is NOOP_SPAN:
+            yield NOOP_SPAN
+            return
+        if parent is None and random.random() >= self.sample_rate:
+            # Трасса не попала в выборку: вложенные интервалы тоже не записываются
+            token = _current_span.set(NOOP_SPAN)
+            try:
+                yield NOOP_SPAN
+            finally:
+                _current_span.reset(token)
+            return
+        
+        if parent is None:
+            span = Span(name, f"{random.getrandbits(128):032x}", None, kind, attributes)
+        else:
+            span = Span(name, parent.trace_id, parent.span_id, kind, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except asyncio.CancelledError:
+            span.attributes["cancelled"] = True
+            raise
+        except Exception as e:
+            span.record_error(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end_ns = time.time_ns()
+            self._finish(span)
+    
+    def record_span(self, name: str, duration: float, **attributes: Any) -> None:
+        """
+        Записать уже прошедший интервал, закончившийся сейчас (например, ожидание в очереди).
+        
+        Args:
+            name: Имя интервала
+            duration: Длительность интервала (сек)
+            **attributes: Атрибуты интервала
+        """
+        parent = _current_span.get()
+        if self.exporter is None or not isinstance(parent, Span):
+            return
+        span = Span(name, parent.trace_id, parent.span_id, "internal", attributes)
+        span.end_ns = time.time_ns()
+        span.start_ns = span.end_ns - int(duration * 1e9)
+        self._finish(span)
+    
+    async def flush(self) -> None:
+        """Выгрузить накопленные интервалы одной пачкой."""
+        async with self._flush_lock:
+            batch = self._finished
+            if not batch or self.exporter is None:
+                return
+            self._finished = []
+            try:
+                await self.exporter.export(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                logger.warning(f"Не удалось выгрузить интервалы трассировки ({len(batch)}): {e}")
+    
+    async def run(self, interval: float) -> None:
+        """
+        Фоновая задача: периодическая выгрузка интервалов.
+        
+        Args:
+            interval: Интервал между выгрузками в секундах
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+    
+    async def close(self) -> None:
+        """Выгрузить оставшиеся интервалы и закрыть выгрузку."""
+        if self.exporter is None:
+            return
+        await self.flush()
+        await self.exporter.close()
+    
+    def _finish(self, span: Span) -> None:
+        """Добавляет завершённый интервал в очередь выгрузки."""
+        if len(self._finished) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._finished.append(span)
+
+
+# Трассировщик процесса; по умолчанию выключен
+_tracer = Tracer()
+
+
+def setup_tracing(enabled: bool, path: str = "traces.jsonl", endpoint: str = "",
+                  sample_rate: float = 1.0, max_pending: int = 10000) -> Tracer:
+    """
+    Настроить трассировщик процесса.
+    
+    Args:
+        enabled: Включить трассировку
+        path: Файл трасс (если не задан endpoint)
+        endpoint: Адрес коллектора OTLP/HTTP (пусто - запись в файл)
+        sample_rate: Доля трассируемых обновлений
+        max_pending: Максимальное количество интервалов, ожидающих выгрузки
+    
+    Returns:
+        Настроенный трассировщик
+    """
+    global _tracer
+    exporter = None
+    if enabled:
+        exporter = OtlpHttpExporter(endpoint) if endpoint else FileSpanExporter(path)
+        logger.info(f"Трассировка включена: {endpoint or os.path.abspath(path)}, доля {sample_rate}")
+    _tracer = Tracer(exporter, sample_rate=sample_rate, max_pending=max_pending)
+    return _tracer
+
+
+def span(name: str, kind: str = "internal", **attributes: Any):
+    """Открыть интервал трассировщика процесса (см. Tracer.span)."""
+    return _tracer.span(name, kind, **attributes)
+
+
+def record_span(name: str, duration: float, **attributes: Any) -> None:
+    """Записать прошедший интервал трассировщиком процесса (см. Tracer.record_span)."""
+    _tracer.record_span(name, duration, **attributes)
@@ -0,0 +1,270 @@
+"""Учёт израсходованных токенов по пользователям, промптам и моделям и дневные лимиты."""
+import asyncio
+import html
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Ключ счётчика: (день, пользователь, промпт, модель)
+UsageKey = Tuple[int, Optional[int], str, str]
+
+# Поля счётчика: запросы, токены запроса, из кэша, ответа, стоимость
+_REQUESTS, _PROMPT, _CACHED, _COMPLETION, _COST = range(5)
+
+
+def current_day() -> int:
+    """Номер текущего дня по UTC (дни от начала эпохи)."""
+    return int(time.time() // 86400)
+
+
+def day_to_date(day: int) -> str:
+    """Дата дня в формате ГГГГ-ММ-ДД."""
+    return time.strftime("%Y-%m-%d", time.gmtime(day * 86400))
+
+
+class UsageLedger:
+    """Счётчики израсходованных токенов с записью в SQLite пачками.
+    
+    Каждый ответ модели увеличивает счётчики в памяти (одно обращение к
+    словарю), а фоновая задача периодически добавляет накопленное в базу
+    одной транзакцией. Дневной расход пользователей тоже хранится в памяти,
+    поэтому проверка лимита перед постановкой запроса в очередь не обращается
+    к базе. Отчёты для администраторов читают базу через отдельное
+    соединение в пуле потоков.
+    """
+    
+    def __init__(self, db_path: str = "usage.db", daily_user_tokens: Optional[int] = None,
+                 exempt_users: Iterable[int] = ()):
+        """
+        Инициализация учёта.
+        
+        Args:
+            db_path: Путь к файлу базы данных SQLite
+            daily_user_tokens: Дневной лимит токенов (запрос и ответ) на пользователя
+                (None - без ограничения)
+            exempt_users: Пользователи без лимита (например, администраторы)
+        """
+        self.db_path = db_path
+        self.daily_user_tokens = daily_user_tokens
+        self.exempt_users = frozenset(exempt_users)
+        self.rejected = 0  # Запросы, отклонённые из-за лимита
+        
+        self._pending: Dict[UsageKey, List[float]] = {}
+        self._day = current_day()
+        self._user_today: Dict[int, int] = {}
+        self._flush_lock = asyncio.Lock()
+        
+        # Соединение для записи используется из пула потоков, доступ сериализуется блокировкой
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            "day TEXT NOT NULL, "
+            "user_id INTEGER NOT NULL, "
+            "prompt_id TEXT NOT NULL, "
+            "model TEXT NOT NULL, "
+            "requests INTEGER NOT NULL, "
+            "prompt_tokens INTEGER NOT NULL, "
+            "cached_tokens INTEGER NOT NULL, "
+            "completion_tokens INTEGER NOT NULL, "
+            "cost REAL NOT NULL, "
+            "PRIMARY KEY (day, user_id, prompt_id, model))"
+        )
+        # Расход за сегодня, записанный до перезапуска, продолжает учитываться в лимите
+        for user_id, tokens in self._conn.execute(
+            "SELECT user_id, SUM(prompt_tokens + completion_tokens) FROM usage WHERE day = ? GROUP BY user_id",
+            (day_to_date(self._day),)
+        ):
+            self._user_today[user_id] = tokens
+        logger.info(f"Учёт расхода токенов: {db_path}")
+    
+    def record(self, user_id: Optional[int], prompt_id: Union[int, str, None], model: str,
+               prompt_tokens: int, cached_tokens: int, completion_tokens: int,
+               cost: Optional[float] = None) -> None:
+        """
+        Учесть ответ модели.
+        
+        Args:
+            user_id: ID пользователя Telegram (None - служебный запрос без пользователя)
+            prompt_id: ID промпта или назначение запроса, например "summary"
+            model: Модель, давшая ответ
+            prompt_tokens: Токены запроса (включая взятые из кэша)
+            cached_tokens: Токены запроса из кэша промптов провайдера
+            completion_tokens: Токены ответа
+            cost: Стоимость запроса (None - цена модели неизвестна)
+        """
+        day = self._roll_day()
+        key = (day, user_id, "" if prompt_id is None else str(prompt_id), model)
+        counters = self._pending.get(key)
+        if counters is None:
+            counters = self._pending[key] = [0, 0, 0, 0, 0.0]
+        counters[_REQUESTS] += 1
+        counters[_PROMPT] += prompt_tokens
+        counters[_CACHED] += cached_tokens
+        counters[_COMPLETION] += completion_tokens
+        counters[_COST] += cost or 0.0
+        if user_id is not None:
+            self._user_today[user_id] = self._user_today.get(user_id, 0) + prompt_tokens + completion_tokens
+    
+    def check(self, user_id: int) -> bool:
+        """
+        Проверить дневной лимит пользователя перед постановкой запроса в очередь.
+        
+        Args:
+            user_id: ID пользователя Telegram
+        
+        Returns:
+            True, если запрос можно выполнять; False - лимит исчерпан (запрос учитывается как отклонённый)
+        """
+        if self.daily_user_tokens is None or user_id in self.exempt_users:
+            return True
+        self._roll_day()
+        if self._user_today.get(user_id, 0) < self.daily_user_tokens:
+            return True
+        self.rejected += 1
+        return False
+    
+    def used_today(self, user_id: int) -> int:
+        """Токены, израсходованные пользователем за сегодня."""
+        self._roll_day()
+        return self._user_today.get(user_id, 0)
+    
+    async def flush(self) -> None:
+        """Записать накопленные счётчики в базу одной транзакцией."""
+        async with self._flush_lock:
+            batch = self._pending
+            if not batch:
+                return
+            self._pending = {}
+            try:
+                await asyncio.to_thread(self._write, batch)
+                logger.debug(f"Записано счётчиков расхода: {len(batch)}")
+            except Exception as e:
+                logger.error(f"Ошибка при записи расхода токенов: {e}", exc_info=True)
+                # Возвращаем неудачную пачку, добавляя её к накопленному за это время
+                for key, counters in batch.items():
+                    pending = self._pending.setdefault(key, [0, 0, 0, 0, 0.0])
+                    for index, value in enumerate(counters):
+                        pending[index] += value
+    
+    async def run(self, interval: float) -> None:
+        """
+        Фоновая задача: периодическая запись счётчиков в базу.
+        
+        Args:
+            interval: Интервал между записями в секундах
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+    
+    async def report(self, days: int = 1, limit: int = 10) -> Dict[str, List[Tuple]]:
+        """
+        Сводка расхода за последние дни для администраторов.
+        
+        Перед чтением накопленные счётчики записываются в базу, запросы
+        выполняются в пуле потоков через отдельное соединение.
+        
+        Args:
+            days: Количество дней, включая сегодняшний
+            limit: Максимальное количество строк в каждом разделе
+        
+        Returns:
+            Словарь с разделами "users", "prompts" и "models": строки
+            (ключ, запросы, токены, стоимость), по убыванию токенов
+        """
+        await self.flush()
+        since = day_to_date(current_day() - max(1, days) + 1)
+        return await asyncio.to_thread(self._read_report, since, limit)
+    
+    async def close(self) -> None:
+        """Записать оставшиеся счётчики и закрыть базу."""
+        await self.flush()
+        with self._lock:
+            self._conn.close()
+    
+    def _roll_day(self) -> int:
+        """Начинает новый день: дневной расход пользователей обнуляется."""
+        day = current_day()
+        if day != self._day:
+            self._day = day
+            self._user_today = {}
+        return day
+    
+    def _write(self, batch: Dict[UsageKey, List[float]]) -> None:
+        """Добавляет пачку счётчиков к строкам базы."""
+        rows = [
+            (day_to_date(day), user_id if user_id is not None else 0, prompt_id, model, *counters)
+            for (day, user_id, prompt_id, model), counters in batch.items()
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO usage (day, user_id, prompt_id, model, requests, prompt_tokens, "
+                    "cached_tokens, completion_tokens, cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (day, user_id, prompt_id, model) DO UPDATE SET "
+                    "requests = requests + excluded.requests, "
+                    "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                    "cached_tokens = cached_tokens + excluded.cached_tokens, "
+                    "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                    "cost = cost + excluded.cost",
+                    rows
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+    
+    def _read_report(self, since: str, limit: int) -> Dict[str, List[Tuple]]:
+        """Выполняет запросы отчёта через отдельное соединение только для чтения."""
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        try:
+            return {
+                section: conn.execute(
+                    f"SELECT {column}, SUM(requests), SUM(prompt_tokens + completion_tokens), SUM(cost) "
+                    f"FROM usage WHERE day >= ? GROUP BY {column} "
+                    f"ORDER BY SUM(prompt_tokens + completion_tokens) DESC LIMIT ?",
+                    (since, limit)
+                ).fetchall()
+                for section, column in (("users", "user_id"), ("prompts", "prompt_id"), ("models", "model"))
+            }
+        finally:
+            conn.close()
+
+
+def format_usage_report(report: Dict[str, List[Tuple]], days: int,
+                        prompt_names: Optional[Dict[str, str]] = None) -> str:
+    """
+    Текст сводки расхода для сообщения в Telegram.
+    
+    Args:
+        report: Результат UsageLedger.report
+        days: Количество дней в сводке
+        prompt_names: Названия промптов по ID (строкой)
+    
+    Returns:
+        Текст сводки
+    """
+    prompt_names = prompt_names or {}
+    titles = {"users": "Пользователи", "prompts": "Промпты", "models": "Модели"}
+    lines = [f"📊 Расход токенов за {days} дн.:"]
+    for section, rows in report.items():
+        lines.append(f"\n<b>{titles[section]}</b>")
+        if not rows:
+            lines.append("нет данных")
+        for key, requests, tokens, cost in rows:
+            if section == "users":
+                name = str(key) if key else "служебные запросы"
+            elif section == "prompts":
+                name = prompt_names.get(key, key) if key else "обычный режим"
+            else:
+                name = key
+            lines.append(f"{html.escape(str(name))}: {tokens} токенов, {requests} запросов, ${cost:.4f}")
+    return "\n".join(lines)
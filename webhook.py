@@ -0,0 +1,222 @@
+"""Приём обновлений Telegram через webhook и распределение их по процессам-обработчикам."""
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+from typing import Callable, List, Optional, Set, Tuple
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram передаёт секрет webhook
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def route_key(update: dict) -> int:
+    """
+    Получить ключ распределения обновления: ID пользователя, иначе ID чата.
+    
+    Args:
+        update: Обновление Telegram в виде словаря
+    
+    Returns:
+        Ключ, по которому выбирается процесс-обработчик
+    """
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return update.get("update_id", 0)
+
+
+class BackgroundUpdates:
+    """Обработка обновлений в фоновых задачах текущего процесса."""
+    
+    def __init__(self, bot: Bot, dispatcher: Dispatcher, max_pending: int = 1000):
+        """
+        Инициализация обработчика.
+        
+        Args:
+            bot: Экземпляр бота
+            dispatcher: Диспетчер aiogram
+            max_pending: Максимальное количество одновременно обрабатываемых обновлений
+        """
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.max_pending = max_pending
+        self._tasks: Set[asyncio.Task] = set()
+    
+    @property
+    def pending(self) -> int:
+        """Количество обновлений в обработке."""
+        return len(self._tasks)
+    
+    def submit(self, update: dict) -> bool:
+        """
+        Запустить обработку обновления, не дожидаясь её окончания.
+        
+        Args:
+            update: Обновление Telegram в виде словаря
+        
+        Returns:
+            False, если обработчик перегружен и обновление не принято
+        """
+        if len(self._tasks) >= self.max_pending:
+            return False
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+    
+    async def drain(self) -> None:
+        """Дождаться окончания обработки всех принятых обновлений."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+    
+    async def _process(self, update: dict) -> None:
+        """Передаёт обновление диспетчеру и логирует ошибки обработки."""
+        try:
+            await self.dispatcher.feed_raw_update(self.bot, update)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке обновления {update.get('update_id')}: {e}", exc_info=True)
+
+
+async def run_webhook_server(bot: Bot, accept: Callable[[bytes], bool], url: str,
+                             path: str, host: str, port: int,
+                             secret: Optional[str] = None) -> None:
+    """
+    Запустить HTTP-сервер webhook и зарегистрировать его в Telegram.
+    
+    Ответ Telegram отправляется сразу после приёма обновления, обработка
+    выполняется в фоне. Если обработчик перегружен, возвращается 503 и
+    Telegram повторит доставку позже. Работает до отмены задачи.
+    
+    Args:
+        bot: Экземпляр бота (для регистрации webhook)
+        accept: Функция, принимающая тело запроса; возвращает False при перегрузке
+        url: Публичный адрес сервера (без пути)
+        path: Путь webhook
+        host: Адрес, на котором слушает сервер
+        port: Порт сервера
+        secret: Секрет, который Telegram передаёт в заголовке каждого запроса
+    """
+    async def handle(request: web.Request) -> web.Response:
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=401)
+        try:
+            accepted = accept(await request.read())
+        except ValueError:
+            # Некорректное тело запроса: повторная доставка не поможет
+            logger.warning("Получено обновление с некорректным JSON")
+            return web.Response(status=400)
+        return web.Response() if accepted else web.Response(status=503)
+    
+    app = web.Application()
+    app.router.add_post(path, handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        await bot.set_webhook(f"{url.rstrip('/')}{path}", secret_token=secret or None)
+        logger.info(f"Webhook запущен: {host}:{port}{path}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def start_workers(count: int, target: Callable, queue_size: int
+                  ) -> Tuple[List[multiprocessing.Process], List[multiprocessing.Queue]]:
+    """
+    Запустить процессы-обработчики обновлений.
+    
+    Процессы создаются методом spawn: каждый заново импортирует модули
+    и получает собственные экземпляры бота, диспетчера и менеджеров.
+    
+    Args:
+        count: Количество процессов
+        target: Функция процесса, принимающая (очередь обновлений, номер процесса)
+        queue_size: Максимальное количество обновлений в очереди одного процесса
+    
+    Returns:
+        Кортеж (список процессов, список их очередей)
+    """
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=queue_size) for _ in range(count)]
+    processes = [
+        context.Process(target=target, args=(update_queue, index), name=f"bot-worker-{index}")
+        for index, update_queue in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+    return processes, queues
+
+
+def route_to_workers(queues: List[multiprocessing.Queue]) -> Callable[[bytes], bool]:
+    """
+    Создать функцию приёма обновлений, распределяющую их по процессам.
+    
+    Все обновления одного пользователя попадают в один процесс, поэтому
+    его сообщения обрабатываются по порядку и с одним и тем же контекстом.
+    
+    Args:
+        queues: Очереди процессов-обработчиков
+    
+    Returns:
+        Функция, принимающая тело запроса и возвращающая False при переполнении очереди
+    """
+    def accept(body: bytes) -> bool:
+        update = json.loads(body)
+        try:
+            queues[route_key(update) % len(queues)].put_nowait(update)
+        except queue.Full:
+            return False
+        return True
+    return accept
+
+
+def stop_workers(processes: List[multiprocessing.Process], queues: List[multiprocessing.Queue],
+                 timeout: float = 30.0) -> None:
+    """
+    Остановить процессы-обработчики, дав им завершить принятые обновления.
+    
+    Args:
+        processes: Процессы-обработчики
+        queues: Их очереди обновлений
+        timeout: Время ожидания завершения каждого процесса (сек)
+    """
+    for update_queue in queues:
+        update_queue.put(None)
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            logger.warning(f"Процесс {process.name} не завершился вовремя и будет остановлен")
+            process.terminate()
+
+
+async def consume_updates(updates: BackgroundUpdates, update_queue: multiprocessing.Queue) -> None:
+    """
+    Обрабатывать обновления из очереди процесса до получения сигнала остановки (None).
+    
+    Принятые обновления продолжают обрабатываться после возврата: их
+    окончания дожидается код остановки процесса.
+    
+    Args:
+        updates: Фоновый обработчик обновлений
+        update_queue: Очередь обновлений этого процесса
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        update = await loop.run_in_executor(None, update_queue.get)
+        if update is None:
+            break
+        while not updates.submit(update):
+            # Обработчик перегружен: ждём, не теряя порядок обновлений
+            await asyncio.sleep(0.05)